@@ -0,0 +1,90 @@
+"""Benchmarks of gopublish, run against a real database (ie in the test containers)
+
+Each benchmark writes its results as JSON, to compare them between commits
+"""
+import json
+import platform
+import subprocess
+import sys
+from datetime import datetime
+
+
+def add_common_arguments(parser):
+    parser.add_argument("--run-mode", default="test", help="Configuration used to create the app (default: test)")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed")
+    parser.add_argument("--output", help="Write the results to this JSON file (default: stdout)")
+    parser.add_argument("--compare", help="Previous results (JSON file) to compare with")
+
+
+def create_benchmark_app(args):
+    from gopublish.app import create_app, create_celery
+
+    app = create_app(config=getattr(args, "config", None), run_mode=args.run_mode)
+    create_celery(app)
+    return app
+
+
+def summarize(values, scale=1):
+    """count, mean, min, max and percentiles of values (multiplied by scale)"""
+
+    values = sorted(value * scale for value in values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "min": values[0],
+        "p50": percentile(values, 0.5),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": values[-1]
+    }
+
+
+def percentile(values, fraction):
+    # values must be sorted. Linear interpolation between the closest ranks
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def metadata(app=None, **params):
+    meta = {
+        "date": datetime.utcnow().isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": params
+    }
+    if app:
+        from gopublish.extensions import db
+        with app.app_context():
+            meta["database"] = db.engine.dialect.name
+    return meta
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(results, output=None):
+    content = json.dumps(results, indent=2, sort_keys=True)
+    if output:
+        with open(output, "w") as f:
+            f.write(content + "\n")
+    else:
+        print(content)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def log(message, *args):
+    # Progress and summaries go to stderr, so that the JSON results can be piped
+    print(message % args if args else message, file=sys.stderr)
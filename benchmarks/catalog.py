@@ -0,0 +1,297 @@
+"""Latency and query counts of the read endpoints on a large catalog
+
+Seeds a configurable number of files (with tags, digests and version chains) through bulk inserts, then calls
+list_files, search, list_tags, view_file and download_file through the Flask test client
+
+    python -m benchmarks.catalog --files 100000 --output catalog.json
+    python -m benchmarks.catalog --files 100000 --compare catalog.json
+
+The database must be empty (seeded rows are deleted at the end), unless --reuse is set: the existing files
+(ie kept from a previous run with --keep) are then benchmarked as is
+"""
+import argparse
+import hashlib
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from benchmarks import add_common_arguments, create_benchmark_app, load_results, log, metadata, summarize, write_results
+
+from gopublish.db_models import FileDigest, PublishedFile, Tag, TagCount, junction_table
+from gopublish.extensions import db
+from gopublish.model.tags import rebuild_tag_counts
+
+from sqlalchemy import delete, event, text
+
+WORDS = ["genome", "assembly", "reads", "annotation", "variants", "proteome", "sample", "contigs", "alignment", "expression",
+         "transcripts", "scaffolds", "methylation", "markers", "coverage", "peaks"]
+EXTENSIONS = ["fasta", "fastq.gz", "bam", "vcf.gz", "gff3", "tsv", "bed", "h5"]
+OWNERS = ["root", "alice", "bob", "carol", "dave"]
+
+BATCH_SIZE = 10000
+
+# Size of the files created in the public folder for download_file
+DOWNLOAD_SIZE = 64 * 1024
+
+
+class QueryCounter():
+    """Count the SQL statements sent to the database"""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._increment)
+
+    def _increment(self, *args, **kwargs):
+        self.count += 1
+
+
+def seed(repo_path, files, tags, tags_per_file, versioned, rng):
+    """Bulk insert files, tags, file_tag and digests. Returns the number of rows of each table"""
+
+    tag_rows = [{"id": index + 1, "tag": "tag%05d" % index} for index in range(tags)]
+    for batch in _batches(tag_rows):
+        db.session.execute(Tag.__table__.insert(), batch)
+
+    # A few tags are on most files: rank r is picked with a weight of 1 / (r + 1)
+    tag_ids = [row["id"] for row in tag_rows]
+    cum_weights = []
+    total = 0
+    for rank in range(len(tag_ids)):
+        total += 1 / (rank + 1)
+        cum_weights.append(total)
+
+    now = datetime.utcnow()
+    mains = []
+    versions = {}
+    counts = {"files": 0, "file_tag": 0, "file_digest": 0}
+    file_rows, tag_links, digest_rows = [], [], []
+
+    for index in range(files):
+        file_id = uuid.uuid4()
+        digest = hashlib.md5(file_id.bytes).hexdigest()
+        row = {
+            "id": file_id,
+            "file_name": "%s_%s_%s.%s" % (rng.choice(WORDS), rng.choice(WORDS), index, rng.choice(EXTENSIONS)),
+            "version": 1,
+            "version_of_id": None,
+            "repo_path": repo_path,
+            "hash": digest,
+            "status": _random_status(rng),
+            "publishing_date": now - timedelta(seconds=rng.randint(0, 3 * 365 * 86400)),
+            "size": rng.randint(1, 10 * 1024 ** 3),
+            "owner": rng.choice(OWNERS),
+            "contact": None,
+            "downloads": rng.randint(0, 100),
+            "task_id": None,
+            "error": None
+        }
+
+        if mains and rng.random() < versioned:
+            main = rng.choice(mains)
+            versions[main["id"]] = versions.get(main["id"], 1) + 1
+            row.update(file_name=main["file_name"], version=versions[main["id"]], version_of_id=main["id"])
+        else:
+            mains.append(row)
+
+        file_rows.append(row)
+        digest_rows.append({"file_id": file_id, "algorithm": "md5", "digest": digest})
+        if tag_ids and tags_per_file:
+            for tag_id in set(rng.choices(tag_ids, cum_weights=cum_weights, k=rng.randint(1, tags_per_file))):
+                tag_links.append({"file_id": file_id, "tag_id": tag_id})
+
+        if len(file_rows) >= BATCH_SIZE:
+            _flush(file_rows, tag_links, digest_rows, counts)
+
+    _flush(file_rows, tag_links, digest_rows, counts)
+
+    rebuild_tag_counts()
+    db.session.commit()
+
+    if db.engine.dialect.name == "postgresql":
+        # Planner statistics, as on a long-lived database
+        with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            connection.execute(text("ANALYZE"))
+
+    counts["tag"] = len(tag_rows)
+    return counts
+
+
+def clean(created_files):
+    for path in created_files:
+        if os.path.exists(path):
+            os.remove(path)
+
+    db.session.execute(delete(junction_table))
+    db.session.execute(delete(FileDigest.__table__))
+    db.session.execute(delete(TagCount.__table__))
+    db.session.execute(delete(Tag.__table__))
+    # Versions first: no ON DELETE on version_of_id
+    db.session.execute(delete(PublishedFile.__table__).where(PublishedFile.version_of_id.isnot(None)))
+    db.session.execute(delete(PublishedFile.__table__))
+    db.session.commit()
+
+
+def scenarios(rng, samples):
+    """{name: [urls]} of the benchmarked requests"""
+
+    tags = [tag.tag for tag in Tag.query.order_by(Tag.id).limit(20)]
+    view_ids = [str(row.id) for row in db.session.query(PublishedFile.id).filter(PublishedFile.status != "unpublished").order_by(PublishedFile.id).limit(samples * 20)]
+    view_ids = rng.sample(view_ids, min(samples, len(view_ids)))
+    versioned_ids = [str(row.id) for row in db.session.query(PublishedFile.id).filter(PublishedFile.version_of_id.isnot(None)).limit(samples)]
+
+    return {
+        "list_files": ["/api/list?limit=10"],
+        "list_files_no_count": ["/api/list?limit=10&count=none"],
+        "list_files_offset": ["/api/list?limit=10&offset=1000"],
+        "list_files_tag": ["/api/list?limit=10&tags=%s" % tag for tag in tags[:5]],
+        "search_substring": ["/api/search?file=%s&limit=10" % word for word in WORDS],
+        "search_fuzzy": ["/api/search?file=%s&mode=fuzzy&limit=10" % word[:-1] for word in WORDS],
+        "search_relevance": ["/api/search?file=%s&order=relevance&limit=10" % word for word in WORDS],
+        "search_tags": ["/api/search?tags=%s&tags=%s&limit=10" % (tags[i], tags[i + 1]) for i in range(min(5, len(tags) - 1))],
+        "list_tags": ["/api/tag/list"],
+        "list_tags_prefix": ["/api/tag/list?prefix=tag000&limit=10"],
+        "view_file": ["/api/view/%s" % file_id for file_id in view_ids],
+        "view_file_versions": ["/api/view/%s" % file_id for file_id in versioned_ids],
+        "view_files_batch": [("POST", "/api/view", {"files": view_ids[:100]})],
+        "download_file": ["/api/download/%s" % file_id for file_id in view_ids],
+    }
+
+
+def run_scenario(client, counter, urls, repeat, warmup):
+    latencies = []
+    queries = []
+    statuses = {}
+    for iteration in range(warmup + repeat):
+        for url in urls:
+            method, path, body = url if isinstance(url, tuple) else ("GET", url, None)
+            before = counter.count
+            start = time.perf_counter()
+            response = client.open(path, method=method, json=body)
+            response.get_data()
+            elapsed = time.perf_counter() - start
+            response.close()
+            if iteration < warmup:
+                continue
+            latencies.append(elapsed)
+            queries.append(counter.count - before)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    return {
+        "latency_ms": summarize(latencies, scale=1000),
+        "queries": summarize(queries),
+        "status_codes": {str(code): count for code, count in sorted(statuses.items())}
+    }
+
+
+def compare(results, baseline):
+    log("%-22s %12s %12s %8s %10s", "scenario", "p50 (ms)", "baseline", "ratio", "queries")
+    for name, result in results["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        p50 = result["latency_ms"].get("p50")
+        if not previous or not previous["latency_ms"].get("p50"):
+            log("%-22s %12.2f %12s %8s %10s", name, p50, "-", "-", "-")
+            continue
+        old_p50 = previous["latency_ms"]["p50"]
+        log("%-22s %12.2f %12.2f %7.2fx %4d -> %-4d", name, p50, old_p50, p50 / old_p50, previous["queries"]["max"], result["queries"]["max"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the read endpoints on a large catalog")
+    add_common_arguments(parser)
+    parser.add_argument("--config", help="Additional configuration file")
+    parser.add_argument("--files", type=int, default=10000, help="Number of files to seed")
+    parser.add_argument("--tags", type=int, default=500, help="Number of tags to seed")
+    parser.add_argument("--tags-per-file", type=int, default=4, help="Maximum number of tags of each file")
+    parser.add_argument("--versioned", type=float, default=0.2, help="Fraction of the files which are a new version of another file")
+    parser.add_argument("--samples", type=int, default=50, help="Number of files viewed and downloaded")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of measured calls of each url")
+    parser.add_argument("--warmup", type=int, default=1, help="Number of unmeasured calls of each url")
+    parser.add_argument("--reuse", action="store_true", help="Benchmark the files already in the database, without seeding")
+    parser.add_argument("--keep", action="store_true", help="Keep the seeded files at the end (for a later --reuse)")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    app = create_benchmark_app(args)
+    created_files = []
+
+    with app.app_context():
+        db.create_all()
+        repo = next(iter(app.repos.repos.values()))
+
+        seeded = None
+        has_files = db.session.query(PublishedFile.id).first() is not None
+        if not args.reuse:
+            if has_files:
+                parser.error("The database already contains files: use --reuse to benchmark them, or empty it")
+            log("Seeding %s files and %s tags in %s", args.files, args.tags, repo.local_path)
+            start = time.perf_counter()
+            seeded = seed(repo.local_path, args.files, args.tags, args.tags_per_file, args.versioned, rng)
+            seeded["seconds"] = time.perf_counter() - start
+            log("Seeded in %.1fs: %s", seeded["seconds"], seeded)
+        elif not has_files:
+            parser.error("--reuse is set, but the database contains no files")
+
+        urls = scenarios(rng, args.samples)
+
+        # Files to download: the sampled ones, if missing
+        os.makedirs(repo.public_folder, exist_ok=True)
+        for url in urls["download_file"]:
+            path = os.path.join(repo.public_folder, url.split("/")[-1])
+            if not os.path.exists(path):
+                with open(path, "wb") as f:
+                    f.write(os.urandom(DOWNLOAD_SIZE))
+                created_files.append(path)
+
+        counter = QueryCounter(db.engine)
+        db.session.remove()
+
+    results = {"meta": metadata(app, **vars(args)), "seeded": seeded, "results": {}}
+    try:
+        with app.test_client() as client:
+            for name, scenario_urls in urls.items():
+                if not scenario_urls:
+                    continue
+                result = run_scenario(client, counter, scenario_urls, args.repeat, args.warmup)
+                results["results"][name] = result
+                log("%-22s p50 %8.2fms  p95 %8.2fms  queries %s-%s  %s", name, result["latency_ms"]["p50"], result["latency_ms"]["p95"],
+                    result["queries"]["min"], result["queries"]["max"], result["status_codes"])
+    finally:
+        with app.app_context():
+            if args.keep or args.reuse:
+                for path in created_files:
+                    os.remove(path)
+            else:
+                log("Deleting the seeded files")
+                clean(created_files)
+
+    write_results(results, args.output)
+    if args.compare:
+        compare(results, load_results(args.compare))
+
+
+def _flush(file_rows, tag_links, digest_rows, counts):
+    for rows, table, key in ((file_rows, PublishedFile.__table__, "files"), (tag_links, junction_table, "file_tag"), (digest_rows, FileDigest.__table__, "file_digest")):
+        for batch in _batches(rows):
+            db.session.execute(table.insert(), batch)
+        counts[key] += len(rows)
+        rows.clear()
+
+
+def _batches(rows):
+    for index in range(0, len(rows), BATCH_SIZE):
+        yield rows[index:index + BATCH_SIZE]
+
+
+def _random_status(rng):
+    value = rng.random()
+    if value < 0.02:
+        return "unpublished"
+    if value < 0.03:
+        return "unavailable"
+    return "available"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""Throughput of the publish task across file sizes, publish modes, buffer sizes and concurrency
+
+The 'publish' task runs in-process (eager, no broker), in a pool of forked processes as in a prefork celery worker
+
+    python -m benchmarks.pipeline --sizes 1K,1M,64M,1G --concurrency 1,4 --output pipeline.json
+    python -m benchmarks.pipeline --workdir /nfs/scratch --cross-fs-dir /dev/shm --chunk-sizes 1M,8M,32M
+
+It uses the same configuration as the celery worker (local.cfg). Files are published in temporary repositories
+created in --workdir (to put on the storage to measure), and deleted with their database rows at the end
+Source files are written just before being published, so they are likely in the page cache: use files larger
+than the memory to measure the disks. Files of at least --sparse-from bytes are sparse (quick to create, but not
+read from the disk)
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks import add_common_arguments, load_results, log, metadata, summarize, write_results
+
+import yaml
+
+MODES = ["copy", "move", "move-cross-fs"]
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+# Block repeated to write the source files
+BLOCK_SIZE = 8 * 1024 * 1024
+
+# Set in main(): the tasks module creates the app when imported
+tasks = None
+
+
+def parse_size(value):
+    value = value.strip().upper()
+    if value and value[-1] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(value)
+
+
+def parse_list(value, parse=int):
+    return [parse(item) for item in value.split(",") if item.strip()]
+
+
+def setup_repos(app, workdir):
+    """Replace the configured repositories by one copy and one move repository in workdir"""
+
+    conf = {}
+    for mode, copy_files in (("copy", True), ("move", False)):
+        path = os.path.join(workdir, mode)
+        os.makedirs(os.path.join(path, "public"))
+        os.makedirs(os.path.join(path, "source"))
+        conf[path] = {"public_folder": os.path.join(path, "public"), "copy_files": copy_files, "has_baricadr": False}
+    app.repos.read_conf_from_str(yaml.safe_dump(conf))
+    return {mode: app.repos.get_repo(os.path.join(workdir, mode)) for mode in ("copy", "move")}
+
+
+def create_source(path, size, sparse, block):
+    with open(path, "wb") as f:
+        if sparse:
+            f.truncate(size)
+            return
+        written = 0
+        while written < size:
+            written += f.write(block[:size - written])
+
+
+def run_case(app, repo, source_dir, size, files, concurrency, chunk_size, sparse, block):
+    from gopublish.db_models import FileDigest, PublishedFile, PublishMetrics
+    from gopublish.extensions import db
+
+    jobs = []
+    for index in range(files):
+        path = os.path.join(source_dir, "file_%s.bin" % index)
+        create_source(path, size, sparse, block)
+        p_file = PublishedFile(file_name=os.path.basename(path), repo_path=repo.local_path, size=size, owner="benchmark", status="creating")
+        db.session.add(p_file)
+        jobs.append((p_file, path))
+    db.session.commit()
+    ids = [p_file.id for p_file, path in jobs]
+    jobs = [(str(p_file.id), path) for p_file, path in jobs]
+
+    # Inherited by the forked processes
+    app.config["PUBLISH_CHUNK_SIZE"] = chunk_size
+    db.session.remove()
+
+    with ProcessPoolExecutor(max_workers=concurrency, mp_context=multiprocessing.get_context("fork"), initializer=_init_worker) as pool:
+        # Start the processes before measuring
+        list(pool.map(_noop, range(concurrency)))
+        start = time.perf_counter()
+        results = list(pool.map(_publish, jobs))
+        seconds = time.perf_counter() - start
+
+    metrics = PublishMetrics.query.filter(PublishMetrics.file_id.in_(ids)).all()
+    methods = {}
+    for metric in metrics:
+        methods[metric.method] = methods.get(metric.method, 0) + 1
+
+    case = {
+        "files": files,
+        "failed": len([result for result in results if result["error"]]),
+        "errors": sorted(set(result["error"] for result in results if result["error"]))[:5],
+        "seconds": seconds,
+        "files_per_second": files / seconds,
+        "mb_per_second": files * size / seconds / 1024 ** 2,
+        "task_seconds": summarize([result["seconds"] for result in results]),
+        "peak_rss_mb": max(result["peak_rss_mb"] for result in results),
+        "methods": methods,
+        "phases": {phase: summarize([getattr(metric, phase) for metric in metrics if getattr(metric, phase) is not None])
+                   for phase in ("transfer_seconds", "hash_seconds", "chmod_seconds")}
+    }
+
+    # Published copies, symlinks and sources
+    for file_id, path in jobs:
+        for leftover in (os.path.join(repo.public_folder, file_id), path):
+            if os.path.lexists(leftover):
+                os.remove(leftover)
+    PublishMetrics.query.filter(PublishMetrics.file_id.in_(ids)).delete(synchronize_session=False)
+    FileDigest.query.filter(FileDigest.file_id.in_(ids)).delete(synchronize_session=False)
+    PublishedFile.query.filter(PublishedFile.id.in_(ids)).delete(synchronize_session=False)
+    db.session.commit()
+
+    return case
+
+
+def compare(results, baseline):
+    previous = {_case_key(case): case for case in baseline.get("results", [])}
+    log("%-40s %10s %10s %8s", "case", "MB/s", "baseline", "ratio")
+    for case in results["results"]:
+        key = _case_key(case)
+        old = previous.get(key)
+        if not old or not old["mb_per_second"]:
+            log("%-40s %10.1f %10s %8s", key, case["mb_per_second"], "-", "-")
+            continue
+        log("%-40s %10.1f %10.1f %7.2fx", key, case["mb_per_second"], old["mb_per_second"], case["mb_per_second"] / old["mb_per_second"])
+
+
+def main():
+    global tasks
+
+    parser = argparse.ArgumentParser(description="Benchmark the publish task")
+    add_common_arguments(parser)
+    parser.add_argument("--sizes", default="1K,1M,64M,256M", help="File sizes (K, M and G suffixes)")
+    parser.add_argument("--sparse-from", default="1G", help="Create sparse files from this size")
+    parser.add_argument("--files", type=int, default=4, help="Number of files published in each case (at least the concurrency)")
+    parser.add_argument("--modes", default="copy,move", help="Publish modes among %s (move-cross-fs requires --cross-fs-dir)" % ", ".join(MODES))
+    parser.add_argument("--cross-fs-dir", help="Directory on another filesystem than --workdir, for the move-cross-fs mode")
+    parser.add_argument("--concurrency", default="1,4", help="Numbers of worker processes")
+    parser.add_argument("--chunk-sizes", help="Buffer sizes (K, M and G suffixes). Default: PUBLISH_CHUNK_SIZE")
+    parser.add_argument("--workdir", help="Directory of the temporary repositories (default: the system temporary directory)")
+    parser.add_argument("--verbose", action="store_true", help="Log each published file")
+    args = parser.parse_args()
+
+    modes = parse_list(args.modes, str)
+    if args.cross_fs_dir and "move-cross-fs" not in modes:
+        modes.append("move-cross-fs")
+    for mode in modes:
+        if mode not in MODES:
+            parser.error("Unknown mode %s" % mode)
+    if "move-cross-fs" in modes and not args.cross_fs_dir:
+        parser.error("The move-cross-fs mode requires --cross-fs-dir")
+
+    os.environ["GOPUBLISH_RUN_MODE"] = args.run_mode
+    from gopublish import tasks as tasks_module
+    from gopublish.extensions import db
+    tasks = tasks_module
+    app = tasks.app
+    tasks.celery.conf.task_always_eager = True
+    if not args.verbose:
+        app.logger.setLevel(logging.WARNING)
+    db.create_all()
+
+    sizes = parse_list(args.sizes, parse_size)
+    sparse_from = parse_size(args.sparse_from)
+    concurrencies = parse_list(args.concurrency)
+    chunk_sizes = parse_list(args.chunk_sizes, parse_size) if args.chunk_sizes else [app.config["PUBLISH_CHUNK_SIZE"]]
+    block = random.Random(args.seed).randbytes(BLOCK_SIZE) if hasattr(random.Random, "randbytes") else os.urandom(BLOCK_SIZE)
+
+    workdir = tempfile.mkdtemp(prefix="gopublish_benchmark_", dir=args.workdir)
+    cross_dir = tempfile.mkdtemp(prefix="gopublish_benchmark_", dir=args.cross_fs_dir) if args.cross_fs_dir else None
+    if cross_dir and os.stat(cross_dir).st_dev == os.stat(workdir).st_dev:
+        log("Warning: %s and %s are on the same filesystem, move-cross-fs will rename the files", cross_dir, workdir)
+
+    results = {"meta": metadata(**vars(args)), "results": []}
+    try:
+        repos = setup_repos(app, workdir)
+        for size in sizes:
+            for mode in modes:
+                repo = repos["copy" if mode == "copy" else "move"]
+                source_dir = cross_dir if mode == "move-cross-fs" else os.path.join(repo.local_path, "source")
+                for chunk_size in chunk_sizes:
+                    for concurrency in concurrencies:
+                        files = max(args.files, concurrency)
+                        case = run_case(app, repo, source_dir, size, files, concurrency, chunk_size, size >= sparse_from, block)
+                        case.update(size=size, mode=mode, chunk_size=chunk_size, concurrency=concurrency, sparse=size >= sparse_from)
+                        results["results"].append(case)
+                        log("%-40s %8.1f files/s %10.1f MB/s  peak RSS %7.1f MB  %s%s", _case_key(case), case["files_per_second"], case["mb_per_second"],
+                            case["peak_rss_mb"], case["methods"], "  %s failed: %s" % (case["failed"], case["errors"]) if case["failed"] else "")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        if cross_dir:
+            shutil.rmtree(cross_dir, ignore_errors=True)
+
+    results["meta"]["peak_rss_mb"] = _peak_rss_mb()
+    write_results(results, args.output)
+    if args.compare:
+        compare(results, load_results(args.compare))
+
+
+def _init_worker():
+    from gopublish.extensions import db
+    # Connections of the parent process must not be used after the fork
+    db.engine.dispose(close=False)
+
+
+def _noop(value):
+    return value
+
+
+def _publish(job):
+    file_id, path = job
+    start = time.perf_counter()
+    result = tasks.publish_file.apply(args=(file_id, path, ""))
+    return {
+        "seconds": time.perf_counter() - start,
+        "error": None if result.successful() else str(result.result),
+        "peak_rss_mb": _peak_rss_mb()
+    }
+
+
+def _peak_rss_mb():
+    # Kilobytes on linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def _case_key(case):
+    return "%s %s chunk=%s x%s" % (_format_size(case["size"]), case["mode"], _format_size(case["chunk_size"]), case["concurrency"])
+
+
+def _format_size(size):
+    for unit in ("G", "M", "K"):
+        if size >= UNITS[unit] and not size % UNITS[unit]:
+            return "%s%s" % (size // UNITS[unit], unit)
+    return str(size)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ I did this because Celery worker's "--autoreload" option seems not working for a
 '''
 
 import os
+import shutil
 import subprocess
 import time
 
@@ -15,7 +16,7 @@ from watchdog.observers import Observer
 
 code_dir_to_monitor = "/gopublish/"
 celery_working_dir = code_dir_to_monitor
-celery_cmdline = '/usr/bin/celery -A gopublish.tasks.celery worker --loglevel=info'.split(" ")
+celery_cmdline = '/usr/bin/celery -A gopublish.tasks.celery worker -Q celery,mail --loglevel=info'.split(" ")
 
 
 class MyHandler(PatternMatchingEventHandler):
@@ -49,6 +50,11 @@ class MyHandler(PatternMatchingEventHandler):
 
 def run_worker():
 
+    # Metrics of the pool processes: the files of the previous worker must be removed
+    metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/gopublish_metrics")
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
     print("Ready to call {} ".format(celery_cmdline))
     os.chdir(celery_working_dir)
     subprocess.Popen(celery_cmdline)
@@ -1,18 +1,25 @@
+import glob
+import hashlib
 import os
-
-from collections import defaultdict
+import re
+import stat
 
 from email_validator import EmailNotValidError, validate_email
 
-from flask import (Blueprint, current_app, jsonify, make_response, request, session, send_file)
+from flask import (Blueprint, abort, current_app, jsonify, make_response, request)
 
-from gopublish.db_models import PublishedFile, Tag
+from gopublish.db_models import FileDigest, PublishedFile, Tag
+from gopublish.dispatch import send_task_on_commit
+from gopublish.download import send_published_file, send_x_accel
 from gopublish.extensions import db
-from gopublish.utils import get_celery_worker_status, is_valid_uuid, get_or_create
-
-from gopublish.decorators import token_required, admin_required, is_valid_uid
+from gopublish.model.files import get_files_details
+from gopublish.model.listing import COUNT_MODES, SEARCH_MODES, SEARCH_ORDERS, count_files, file_name_relevance, get_files_page, search_filters
+from gopublish.model.tags import add_file_tags, get_or_create_tags, remove_file_tags, update_tag_counts
+from gopublish.model.timings import publish_percentiles
+from gopublish.pipeline import DIGESTS
+from gopublish.utils import broadcast_repos_reload, decode_cursor, is_valid_uuid
 
-from sqlalchemy import desc, func
+from gopublish.decorators import get_current_user, token_required, admin_required, is_valid_uid
 
 
 file = Blueprint('file', __name__, url_prefix='/')
@@ -22,7 +29,21 @@ file = Blueprint('file', __name__, url_prefix='/')
 def status():
     mode = current_app.config.get("GOPUBLISH_RUN_MODE")
     version = current_app.config.get("GOPUBLISH_VERSION", "0.0.1")
-    return make_response(jsonify({'version': version, 'mode': mode}), 200)
+    workers = current_app.worker_tracker.snapshot(current_app.celery)
+    return make_response(jsonify({'version': version, 'mode': mode, 'workers': workers}), 200)
+
+
+@file.route('/api/repos/reload', methods=['POST'])
+@token_required
+@admin_required
+def reload_repos():
+    try:
+        current_app.repos.reload(force=True)
+    except Exception as err:
+        return make_response(jsonify({'error': 'Could not reload repositories: %s' % err}), 400)
+
+    broadcast_repos_reload(current_app, force=True)
+    return make_response(jsonify({'message': 'Repositories reloaded', 'repos': list(current_app.repos.repos)}), 200)
 
 
 @file.route('/api/endpoints', methods=['GET'])
@@ -60,119 +81,124 @@ def list_files():
     if tags:
         tag_list = Tag.query.filter(Tag.tag.in_(tags)).all()
 
-    files = PublishedFile().query.filter(*[PublishedFile.tags.contains(t) for t in tag_list], PublishedFile.status != "unpublished").order_by(desc(PublishedFile.publishing_date))
-    total = files.count()
-    files = files.limit(limit).offset(offset)
-    data = []
-
-    tags_dict = defaultdict(lambda: 0)
+    cursor = request.args.get("cursor")
+    if cursor:
+        cursor = decode_cursor(cursor)
+        if not cursor:
+            return make_response(jsonify({'error': 'Invalid cursor'}), 400)
 
-    for file in files:
-        file_tag_list = []
-        for tag in file.tags:
-            file_tag_list.append(tag.tag)
-            tags_dict[tag.tag] += 1
+    count_mode = request.args.get("count", "exact")
+    if count_mode not in COUNT_MODES:
+        return make_response(jsonify({'error': 'count must be one of exact, estimate or none'}), 400)
 
-        data.append({
-            'uri': file.id,
-            'file_name': file.file_name,
-            'size': file.size,
-            'version': file.version,
-            'status': file.status,
-            'downloads': file.downloads,
-            'publishing_date': file.publishing_date.strftime('%Y-%m-%d'),
-            'tags': file_tag_list
-        })
+    filters = [*[PublishedFile.tags.contains(t) for t in tag_list], PublishedFile.status != "unpublished"]
+    page = get_files_page(filters, limit, offset=offset, cursor=cursor, count_mode=count_mode)
 
-    all_tags_list = [{"tag": key, "count": count} for key, count in tags_dict.items()]
-
-    return make_response(jsonify({'files': data, 'total': total, 'tags': all_tags_list}), 200)
+    return make_response(jsonify({'files': _serialize_rows(page['files']), 'total': page['total'], 'tags': page['tags'], 'next_cursor': page['next_cursor']}), 200)
 
 
 @file.route('/api/tag/add/<file_id>', methods=['PUT'])
 @token_required
 @is_valid_uid
 def tag_file(file_id):
+    return _change_file_tags(file_id, add=True)
 
-    if not request.get_json(silent=True):
-        return make_response(jsonify({'error': 'Missing body'}), 400)
-
-    tags = request.json.get('tags', [])
 
-    if tags:
-        if not isinstance(tags, list):
-            if isinstance(tags, str):
-                tags = [tags]
-            else:
-                return make_response(jsonify({'error': 'tags is neither a list nor a string'}), 400)
-    else:
-        return make_response(jsonify({"error": "Missing tags"}), 400)
+@file.route('/api/tag/remove/<file_id>', methods=['PUT'])
+@token_required
+@is_valid_uid
+def untag_file(file_id):
+    return _change_file_tags(file_id, add=False)
 
-    tags = [t.strip().lower() for t in tags]
 
-    datafile = PublishedFile().query.get_or_404(file_id)
+@file.route('/api/tag/batch', methods=['PUT'])
+@token_required
+def batch_tag_files():
+    # Add and remove tags on a list of files, or on all the files matching a search, in one transaction
 
-    if not (datafile.owner == session['user']["username"] or session['user']["is_admin"]):
-        return make_response(jsonify({}), 401)
+    body = request.get_json(silent=True)
+    if not body:
+        return make_response(jsonify({'error': 'Missing body'}), 400)
 
-    missing_tags = set(tags) - set([tag.tag for tag in datafile.tags])
-    if missing_tags:
-        tag_entities = [get_or_create(db.session, Tag, tag=tag) for tag in missing_tags]
-        db.session.commit()
-        for tag in tag_entities:
-            datafile.tags.append(tag)
-        db.session.commit()
+    add_tags = _parse_tags(body.get('add', []))
+    remove_tags = _parse_tags(body.get('remove', []))
+    if add_tags is None or remove_tags is None:
+        return make_response(jsonify({'error': 'tags is neither a list nor a string'}), 400)
+    if not (add_tags or remove_tags):
+        return make_response(jsonify({"error": "Missing tags"}), 400)
+    if add_tags & remove_tags:
+        return make_response(jsonify({"error": "Tags %s cannot be both added and removed" % ", ".join(sorted(add_tags & remove_tags))}), 400)
+
+    file_ids = None
+    if body.get('files'):
+        file_ids = body['files']
+        if not isinstance(file_ids, list) or not all(isinstance(file_id, str) and is_valid_uuid(file_id) for file_id in file_ids):
+            return make_response(jsonify({'error': 'files must be a list of file ids'}), 400)
+        file_ids = set(file_ids)
+        filters = [PublishedFile.id.in_(file_ids)]
+    elif body.get('query'):
+        query = body['query']
+        if not isinstance(query, dict):
+            return make_response(jsonify({'error': 'Malformed query'}), 400)
+        file_name = query.get('file', '')
+        query_tags = _parse_tags(query.get('tags', []))
+        mode = query.get('mode', 'substring')
+        if not isinstance(file_name, str) or query_tags is None:
+            return make_response(jsonify({'error': 'Malformed query'}), 400)
+        if mode not in SEARCH_MODES:
+            return make_response(jsonify({'error': 'mode must be one of substring or fuzzy'}), 400)
+        if not (file_name or query_tags):
+            return make_response(jsonify({'error': 'Empty query'}), 400)
+        tag_list = Tag.query.filter(Tag.tag.in_(query_tags)).all() if query_tags else []
+        if len(tag_list) < len(query_tags):
+            # An unknown tag matches no file
+            return make_response(jsonify({'files': 0, 'added': {}, 'removed': {}}), 200)
+        filters = search_filters(file_name, tag_list, mode)
+    else:
+        return make_response(jsonify({'error': 'Missing files or query'}), 400)
+
+    user = get_current_user()
+    if not user["is_admin"]:
+        filters.append(PublishedFile.owner == user["username"])
+
+    data = {}
+    if file_ids is not None:
+        found = set(str(file_id) for file_id, in db.session.query(PublishedFile.id).filter(*filters))
+        data['files'] = len(found)
+        # Not found, or not owned by the user
+        data['missing'] = sorted(file_ids - found)
+    else:
+        data['files'] = count_files(filters)
 
-    data = {
-        "file": {
-            "contact": datafile.contact,
-            "owner": datafile.owner,
-            "status": datafile.status,
-            "file_name": datafile.file_name,
-            "version": datafile.version,
-            "size": datafile.size,
-            "hash": datafile.hash,
-            "publishing_date": datafile.publishing_date.strftime('%Y-%m-%d'),
-            'tags': [tag.tag for tag in datafile.tags]
-        }
-    }
+    data['added'], data['removed'] = _apply_tag_changes(filters, add_tags, remove_tags)
+    db.session.commit()
 
     return make_response(jsonify(data), 200)
 
 
-@file.route('/api/tag/remove/<file_id>', methods=['PUT'])
-@token_required
-@is_valid_uid
-def untag_file(file_id):
+def _change_file_tags(file_id, add):
 
     if not request.get_json(silent=True):
         return make_response(jsonify({'error': 'Missing body'}), 400)
 
     tags = request.json.get('tags', [])
-
-    if tags:
-        if not isinstance(tags, list):
-            if isinstance(tags, str):
-                tags = [tags]
-            else:
-                return make_response(jsonify({'error': 'tags is neither a list nor a string'}), 400)
-    else:
+    if not tags:
         return make_response(jsonify({"error": "Missing tags"}), 400)
 
+    tags = _parse_tags(tags)
+    if tags is None:
+        return make_response(jsonify({'error': 'tags is neither a list nor a string'}), 400)
+
     datafile = PublishedFile().query.get_or_404(file_id)
 
-    if not (datafile.owner == session['user']["username"] or session['user']["is_admin"]):
+    user = get_current_user()
+    if not (datafile.owner == user["username"] or user["is_admin"]):
         return make_response(jsonify({}), 401)
 
-    tags_to_remove = set(tags).intersection(set([tag.tag for tag in datafile.tags]))
-
-    for tag in datafile.tags:
-        if tag.tag in tags_to_remove:
-            if len(tag.files) == 1:
-                db.session.delete(tag)
-            else:
-                datafile.tags.remove(tag)
-
+    if add:
+        _apply_tag_changes([PublishedFile.id == datafile.id], tags, set())
+    else:
+        _apply_tag_changes([PublishedFile.id == datafile.id], set(), tags)
     db.session.commit()
 
     data = {
@@ -192,94 +218,122 @@ def untag_file(file_id):
     return make_response(jsonify(data), 200)
 
 
+def _apply_tag_changes(filters, add_tags, remove_tags):
+    # Returns the number of files tagged and untagged, for each tag name
+    added = {}
+    if add_tags:
+        tag_names = dict((tag.id, tag.tag) for tag in get_or_create_tags(add_tags))
+        added = dict((tag_names[tag_id], count) for tag_id, count in add_file_tags(filters, tag_names.keys()).items())
+
+    removed = {}
+    if remove_tags:
+        tag_names = dict(db.session.query(Tag.id, Tag.tag).filter(Tag.tag.in_(remove_tags)))
+        for tag_id, count in remove_file_tags(filters, tag_names.keys()).items():
+            # Older databases may have duplicate tags
+            removed[tag_names[tag_id]] = removed.get(tag_names[tag_id], 0) + count
+
+    return added, removed
+
+
 @file.route('/api/view/<file_id>', methods=['GET'])
 @is_valid_uid
 def view_file(file_id):
-    datafile = PublishedFile().query.get_or_404(file_id)
+    current_app.logger.info("API call: Getting file %s", file_id)
 
-    repo = current_app.repos.get_repo(datafile.repo_path)
-    path = os.path.join(repo.public_folder, str(datafile.id))
-    current_app.logger.info("API call: Getting file %s" % file_id)
-    if os.path.exists(path):
-        # We don't know the status of Baricadr, so, check the size for completion
-        if datafile.status == "pulling" and os.path.getsize(path) == datafile.size:
-            datafile.status = "available"
-            db.session.commit()
-        # Should not happen: for testing/dev purposes
-        if datafile.status == "unavailable":
-            datafile.status = "available"
-            db.session.commit()
-    elif datafile.status == "available":
-        if repo.has_baricadr:
-            # TODO : Add baricadr check if the file exists
-            datafile.status = "pullable"
-        else:
-            datafile.status = "unavailable"
-        db.session.commit()
+    details = get_files_details([file_id])
+    if not details:
+        abort(404)
 
     # TODO : How do we check the baricadr process? Store the task ID?
 
-    siblings = []
+    return make_response(jsonify({"file": next(iter(details.values()))}), 200)
 
-    if datafile.version_of:
-        main_file = datafile.version_of
-        siblings.append({"uri": main_file.id, "version": main_file.version, "status": main_file.status, "publishing_date": main_file.publishing_date.strftime('%Y-%m-%d')})
-        for file in datafile.version_of.subversions:
-            if not file.id == datafile.id:
-                siblings.append({"uri": file.id, "version": file.version, "status": file.status, "publishing_date": file.publishing_date.strftime('%Y-%m-%d')})
-    elif datafile.subversions:
-        for file in datafile.subversions:
-            if not file.id == datafile.id:
-                siblings.append({"uri": file.id, "version": file.version, "status": file.status, "publishing_date": file.publishing_date.strftime('%Y-%m-%d')})
 
-    data = {
-        "file": {
-            "contact": datafile.contact,
-            "owner": datafile.owner,
-            "status": datafile.status,
-            "path": path,
-            "file_name": datafile.file_name,
-            "version": datafile.version,
-            "size": datafile.size,
-            "hash": datafile.hash,
-            "publishing_date": datafile.publishing_date.strftime('%Y-%m-%d'),
-            "siblings": siblings,
-            'tags': [tag.tag for tag in datafile.tags]
-        }
-    }
+@file.route('/api/view', methods=['POST'])
+def view_files():
+    # Details of several files at once, in the format of /api/view/<file_id>
 
-    return make_response(jsonify(data), 200)
+    body = request.get_json(silent=True)
+    if not body or not body.get('files'):
+        return make_response(jsonify({'error': 'Missing files'}), 400)
+
+    file_ids = body['files']
+    if not isinstance(file_ids, list) or not all(isinstance(file_id, str) and is_valid_uuid(file_id) for file_id in file_ids):
+        return make_response(jsonify({'error': 'files must be a list of file ids'}), 400)
+
+    file_ids = set(file_id.lower() for file_id in file_ids)
+    if len(file_ids) > current_app.config['VIEW_BATCH_MAX']:
+        return make_response(jsonify({'error': 'Too many files (%s), the maximum is %s' % (len(file_ids), current_app.config['VIEW_BATCH_MAX'])}), 400)
+
+    current_app.logger.info("API call: Getting %s files", len(file_ids))
+    details = get_files_details(file_ids, max_workers=current_app.config['VIEW_BATCH_THREADS'])
+
+    return make_response(jsonify({'files': details, 'missing': sorted(file_ids - set(details))}), 200)
+
+
+@file.route('/api/digest/<algorithm>/<digest>', methods=['GET'])
+def lookup_digest(algorithm, digest):
+
+    if algorithm not in DIGESTS:
+        return make_response(jsonify({'error': 'algorithm must be one of %s' % ", ".join(DIGESTS)}), 400)
+
+    digest = digest.lower()
+    if not re.fullmatch("[0-9a-f]{%s}" % (hashlib.new(algorithm).digest_size * 2), digest):
+        return make_response(jsonify({'error': 'Malformed digest'}), 400)
+
+    offset = request.args.get('offset', 0)
+
+    try:
+        offset = int(offset)
+    except ValueError:
+        offset = 0
+
+    limit = request.args.get('limit', 10)
+
+    try:
+        limit = int(limit)
+    except ValueError:
+        limit = 0
+
+    # Served by ix_file_digest_algorithm_digest
+    matching = db.session.query(FileDigest.file_id).filter(FileDigest.algorithm == algorithm, FileDigest.digest == digest)
+    filters = [PublishedFile.id.in_(matching), PublishedFile.status != "unpublished"]
+    page = get_files_page(filters, limit, offset=offset, facets=False)
+
+    return make_response(jsonify({'files': _serialize_rows(page['files']), 'total': page['total']}), 200)
 
 
 @file.route('/api/download/<file_id>', methods=['GET'])
 @is_valid_uid
 def download_file(file_id):
-    current_app.logger.info("API call: Download file %s" % file_id)
+    current_app.logger.info("API call: Download file %s", file_id)
     datafile = PublishedFile().query.get_or_404(file_id)
 
-    repo = current_app.repos.get_repo(datafile.repo_path)
-    path = os.path.join(repo.public_folder, str(datafile.id))
-
     if datafile.status == "unpublished":
         return make_response(jsonify({}), 404)
 
-    if os.path.exists(path):
-        datafile.downloads = datafile.downloads + 1
-        db.session.commit()
-        res = send_file(path, as_attachment=True)
-
-        if current_app.config.get("USE_X_SENDFILE"):
-            res.headers['X-Accel-Redirect'] = path
-            res.headers['X-Accel-Buffering'] = "no"
-        return res
+    repo = current_app.repos.get_repo(datafile.repo_path)
+
+    if current_app.config.get("USE_X_SENDFILE"):
+        # nginx sends the file: no file access here
+        if not datafile.status == "available":
+            return make_response(jsonify({'error': 'Missing file'}), 404)
+        res, is_download = send_x_accel(datafile, repo.x_accel_location(datafile.id))
     else:
-        return make_response(jsonify({'error': 'Missing file'}), 404)
+        path = os.path.join(repo.public_folder, str(datafile.id))
+        if not os.path.exists(path):
+            return make_response(jsonify({'error': 'Missing file'}), 404)
+        res, is_download = send_published_file(path, datafile)
+
+    if is_download:
+        current_app.download_counter.increment(datafile.id)
+    return res
 
 
 @file.route('/api/pull/<file_id>', methods=['POST'])
 @is_valid_uid
 def pull_file(file_id):
-    current_app.logger.info("API call: Getting file %s" % file_id)
+    current_app.logger.info("API call: Getting file %s", file_id)
     datafile = PublishedFile().query.get_or_404(file_id)
 
     if datafile.status == "unpublished":
@@ -301,7 +355,9 @@ def pull_file(file_id):
         return make_response(jsonify({'message': 'File already available'}), 200)
     else:
         if repo.has_baricadr:
-            current_app.celery.send_task("pull", (datafile.id, email))
+            datafile.status = "pulling"
+            send_task_on_commit("pull", (datafile.id, email))
+            db.session.commit()
             return make_response(jsonify({'message': 'Ok'}), 200)
         else:
             return make_response(jsonify({'message': 'Not managed by Baricadr'}), 400)
@@ -327,16 +383,9 @@ def publish_file():
     if not repo:
         return make_response(jsonify({'error': 'File %s is not in any publishable repository' % request.json['path']}), 400)
 
-    tags = request.json.get('tags', [])
-
-    if tags:
-        if not isinstance(tags, list):
-            if isinstance(tags, str):
-                tags = [tags]
-            else:
-                return make_response(jsonify({'error': 'tags is neither a list nor a string'}), 400)
-    tags = [t.strip().lower() for t in tags]
-    tags = set(tags)
+    tags = _parse_tags(request.json.get('tags', []))
+    if tags is None:
+        return make_response(jsonify({'error': 'tags is neither a list nor a string'}), 400)
     version = 1
 
     linked_to = request.json.get('linked_to')
@@ -363,14 +412,13 @@ def publish_file():
 
         version = len(linked_datafile.subversions) + 2
 
-    checks = repo.check_publish_file(request.json['path'], user_data=session['user'])
+    checks = repo.check_publish_file(request.json['path'], user_data=get_current_user())
 
     if checks["error"]:
         return make_response(jsonify({'error': 'Error checking file : %s' % checks["error"]}), 400)
 
-    celery_status = get_celery_worker_status(current_app.celery)
-    if celery_status['availability'] is None:
-        current_app.logger.error("Received publish request on path '%s', but no Celery worker available to process the request. Aborting." % request.json['path'])
+    if not current_app.worker_tracker.is_available(current_app.celery):
+        current_app.logger.error("Received publish request on path '%s', but no Celery worker available to process the request. Aborting.", request.json['path'])
         return jsonify({'error': 'No Celery worker available to process the request'}), 400
 
     email = None
@@ -391,26 +439,153 @@ def publish_file():
         except EmailNotValidError as e:
             return make_response(jsonify({'error': str(e)}), 400)
 
-    file_id = repo.publish_file(request.json['path'], session['user'], version=version, email=email, contact=contact, linked_to=linked_datafile, tags=tags)
+    file_id = repo.publish_file(request.json['path'], get_current_user(), version=version, email=email, contact=contact, linked_to=linked_datafile, tags=tags)
 
     res = "File registering. An email will be sent to you when the file is ready." if email else "File registering. It should be ready soon"
 
     return make_response(jsonify({'message': res, 'file_id': file_id, 'version': version}), 200)
 
 
+@file.route('/api/publish/bulk', methods=['POST'])
+@token_required
+def publish_files():
+    # Publish a list of files, or the files matching a glob pattern in a directory
+
+    body = request.get_json(silent=True)
+    if not body:
+        return make_response(jsonify({'error': 'Missing body'}), 400)
+
+    if body.get('paths'):
+        paths = body['paths']
+        if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+            return make_response(jsonify({'error': 'paths must be a list of paths'}), 400)
+    elif body.get('directory'):
+        directory = body['directory']
+        pattern = body.get('glob', '*')
+        if not isinstance(directory, str) or not os.path.isdir(directory):
+            return make_response(jsonify({'error': 'Folder not found at path %s' % directory}), 400)
+        if not isinstance(pattern, str) or os.path.isabs(pattern) or '..' in pattern.split(os.sep):
+            return make_response(jsonify({'error': 'glob must be a relative pattern'}), 400)
+        paths = sorted(glob.glob(os.path.join(directory, pattern), recursive=True))
+    else:
+        return make_response(jsonify({'error': 'Missing paths or directory'}), 400)
+
+    # Remove duplicates, keeping the order
+    paths = list(dict.fromkeys(paths))
+
+    if not paths:
+        return make_response(jsonify({'error': 'No file to publish'}), 400)
+
+    if len(paths) > current_app.config['PUBLISH_BULK_MAX']:
+        return make_response(jsonify({'error': 'Too many files (%s), the maximum is %s' % (len(paths), current_app.config['PUBLISH_BULK_MAX'])}), 400)
+
+    tags = _parse_tags(body.get('tags', []))
+    if tags is None:
+        return make_response(jsonify({'error': 'tags is neither a list nor a string'}), 400)
+
+    email = None
+    if body.get('email'):
+        try:
+            email = [validate_email(body['email'])["email"]]
+        except EmailNotValidError as e:
+            return make_response(jsonify({'error': str(e)}), 400)
+
+    contact = None
+    if body.get('contact'):
+        try:
+            contact = validate_email(body['contact'])["email"]
+        except EmailNotValidError as e:
+            return make_response(jsonify({'error': str(e)}), 400)
+
+    user_data = get_current_user()
+    results = []
+    files = []
+    # Access only depends on the repository and the owner of the file: check each pair once
+    checks = {}
+    for path in paths:
+        result = {'path': path}
+        results.append(result)
+
+        try:
+            file_stat = os.lstat(path)
+        except OSError:
+            result['error'] = 'File not found at path %s' % path
+            continue
+
+        if not stat.S_ISREG(file_stat.st_mode):
+            result['error'] = 'Path must not be a folder or a symlink'
+            continue
+
+        repo = current_app.repos.get_repo(path)
+        if not repo:
+            result['error'] = 'File %s is not in any publishable repository' % path
+            continue
+
+        # A directory may include the public folder of its repository
+        if path.startswith(os.path.join(repo.public_folder, "")):
+            result['error'] = 'File %s is already in the public folder of the repository' % path
+            continue
+
+        key = (repo.local_path, file_stat.st_uid)
+        if key not in checks:
+            checks[key] = repo.check_publish_access(str(file_stat.st_uid), user_data)
+        if checks[key]["error"]:
+            result['error'] = 'Error checking file : %s' % checks[key]["error"]
+            continue
+
+        files.append((repo, path, file_stat.st_size, result))
+
+    if not files:
+        return make_response(jsonify({'error': 'No file can be published', 'results': results}), 400)
+
+    if not current_app.worker_tracker.is_available(current_app.celery):
+        current_app.logger.error("Received bulk publish request on %s files, but no Celery worker available to process the request. Aborting.", len(files))
+        return jsonify({'error': 'No Celery worker available to process the request'}), 400
+
+    file_ids = current_app.repos.publish_files([(repo, path, size) for repo, path, size, result in files], user_data, email=email, contact=contact, tags=tags)
+    for (repo, path, size, result), file_id in zip(files, file_ids):
+        result['file_id'] = file_id
+
+    res = "%s files registering. An email will be sent to you when they are ready." if email else "%s files registering. They should be ready soon"
+
+    return make_response(jsonify({'message': res % len(files), 'results': results}), 200)
+
+
+@file.route('/api/publish/metrics', methods=['GET'])
+@token_required
+@admin_required
+def publish_metrics():
+    # Percentiles of the publish timings, by repository and publish method (over the last 'days' days, 0 for all)
+
+    repo_path = request.args.get('repo')
+    days = request.args.get('days', 30)
+    try:
+        days = int(days)
+    except ValueError:
+        return make_response(jsonify({'error': 'days must be a positive integer'}), 400)
+    if days < 0:
+        return make_response(jsonify({'error': 'days must be a positive integer'}), 400)
+
+    return make_response(jsonify({'days': days, 'repos': publish_percentiles(repo_path=repo_path, days=days)}), 200)
+
+
 @file.route('/api/unpublish/<file_id>', methods=['DELETE'])
 @is_valid_uid
 @token_required
 def unpublish_file(file_id):
     datafile = PublishedFile().query.get_or_404(file_id)
 
-    if not (datafile.owner == session['user']["username"] or session['user']["is_admin"]):
+    user = get_current_user()
+    if not (datafile.owner == user["username"] or user["is_admin"]):
         return make_response(jsonify({}), 401)
 
+    if not datafile.status == "unpublished":
+        update_tag_counts([tag.id for tag in datafile.tags], -1)
+
     datafile.status = "unpublished"
+    send_task_on_commit("unpublish", (datafile.id,))
     db.session.commit()
 
-    current_app.celery.send_task("unpublish", (datafile.id,))
     return make_response(jsonify({'message': 'File unpublished'}), 200)
 
 
@@ -424,7 +599,10 @@ def delete_file(file_id):
     repo = current_app.repos.get_repo(datafile.repo_path)
     path = os.path.join(repo.public_folder, str(datafile.id))
 
-    current_app.celery.send_task("delete", (path,))
+    send_task_on_commit("delete", (path,))
+
+    if not datafile.status == "unpublished":
+        update_tag_counts([tag.id for tag in datafile.tags], -1)
 
     db.session.delete(datafile)
     db.session.commit()
@@ -460,38 +638,57 @@ def search():
         tag_list = Tag.query.filter(Tag.tag.in_(tags)).all()
 
     if not (file_name or tag_list):
-        return make_response(jsonify({'files': [], 'total': 0}), 200)
+        return make_response(jsonify({'files': [], 'total': 0, 'next_cursor': None}), 200)
 
-    if file_name and is_valid_uuid(file_name):
-        files = PublishedFile().query.order_by(desc(PublishedFile.publishing_date)).filter(*[PublishedFile.tags.contains(t) for t in tag_list], PublishedFile.id != file_name, PublishedFile.status != "unpublished")
-    else:
-        files = PublishedFile().query.order_by(desc(PublishedFile.publishing_date)).filter(*[PublishedFile.tags.contains(t) for t in tag_list], func.lower(PublishedFile.file_name).contains(file_name.lower()), PublishedFile.status != "unpublished")
+    cursor = request.args.get("cursor")
+    if cursor:
+        cursor = decode_cursor(cursor)
+        if not cursor:
+            return make_response(jsonify({'error': 'Invalid cursor'}), 400)
 
-    total = files.count()
+    count_mode = request.args.get("count", "exact")
+    if count_mode not in COUNT_MODES:
+        return make_response(jsonify({'error': 'count must be one of exact, estimate or none'}), 400)
 
-    files = files.limit(limit).offset(offset)
+    mode = request.args.get("mode", "substring")
+    if mode not in SEARCH_MODES:
+        return make_response(jsonify({'error': 'mode must be one of substring or fuzzy'}), 400)
 
-    data = []
+    order = request.args.get("order", "date")
+    if order not in SEARCH_ORDERS:
+        return make_response(jsonify({'error': 'order must be one of date or relevance'}), 400)
 
-    tags_dict = defaultdict(lambda: 0)
+    filters = search_filters(file_name, tag_list, mode)
+    order_by = None
+    if file_name and not is_valid_uuid(file_name) and order == "relevance":
+        order_by = [file_name_relevance(file_name)]
 
-    for file in files:
-        file_tag_list = []
-        for tag in file.tags:
-            file_tag_list.append(tag.tag)
-            tags_dict[tag.tag] += 1
+    page = get_files_page(filters, limit, offset=offset, cursor=cursor, count_mode=count_mode, order_by=order_by)
 
-        data.append({
-            'uri': file.id,
-            'file_name': file.file_name,
-            'size': file.size,
-            'version': file.version,
-            'status': file.status,
-            'downloads': file.downloads,
-            "publishing_date": file.publishing_date.strftime('%Y-%m-%d'),
-            'tags': file_tag_list
-        })
+    return make_response(jsonify({'files': _serialize_rows(page['files']), 'total': page['total'], 'tags': page['tags'], 'next_cursor': page['next_cursor']}), 200)
 
-    all_tags_list = [{"tag": key, "count": count} for key, count in tags_dict.items()]
 
-    return make_response(jsonify({'files': data, 'total': total, 'tags': all_tags_list}), 200)
+def _parse_tags(tags):
+    # Returns None if tags is neither a list nor a string
+    if tags:
+        if not isinstance(tags, list):
+            if isinstance(tags, str):
+                tags = [tags]
+            else:
+                return None
+    return set(t.strip().lower() for t in tags)
+
+
+def _serialize_rows(rows):
+    # Add the download counts not yet written to the database
+    pending = current_app.download_counter.pending([row.uri for row in rows])
+    return [{
+        'uri': row.uri,
+        'file_name': row.file_name,
+        'size': row.size,
+        'version': row.version,
+        'status': row.status,
+        'downloads': (row.downloads or 0) + pending.get(str(row.uri), 0),
+        'publishing_date': row.publishing_date.strftime('%Y-%m-%d'),
+        'tags': row.tags
+    } for row in rows]
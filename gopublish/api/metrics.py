@@ -0,0 +1,16 @@
+from flask import (Blueprint, current_app, jsonify, make_response)
+
+from gopublish.metrics import render_metrics
+
+metrics = Blueprint('metrics', __name__, url_prefix='/')
+
+
+@metrics.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus text exposition format
+
+    if not current_app.config.get("METRICS_ENABLED"):
+        return make_response(jsonify({'error': 'Metrics are disabled'}), 404)
+
+    output, content_type = render_metrics(current_app)
+    return make_response(output, 200, {'Content-Type': content_type})
@@ -1,12 +1,22 @@
-from flask import (Blueprint, jsonify, make_response)
+from flask import (Blueprint, jsonify, make_response, request)
 
-from gopublish.db_models import Tag
+from gopublish.model.tags import get_tag_counts
 
 tag = Blueprint('tag', __name__, url_prefix='/')
 
 
 @tag.route('/api/tag/list', methods=['GET'])
 def list_tags():
-    tag_list = [{"tag": tag.tag, "count": len(tag.files)} for tag in Tag.query.all()]
+
+    limit = request.args.get('limit')
+
+    try:
+        limit = int(limit) if limit else None
+    except ValueError:
+        limit = None
+
+    prefix = request.args.get('prefix', '')
+
+    tag_list = get_tag_counts(limit=limit, prefix=prefix)
 
     return make_response(jsonify({'tags': tag_list}), 200)
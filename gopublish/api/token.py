@@ -20,7 +20,7 @@ def create_token():
 
     # Only check ldap in prod
     if current_app.config['GOPUBLISH_RUN_MODE'] == "prod":
-        if not authenticate_user(request.json.get("username"), request.json.get("password"), request.json.get("api_key"), current_app.config):
+        if not authenticate_user(request.json.get("username"), request.json.get("password"), request.json.get("api_key"), current_app.config, current_app.ldap):
             return make_response(jsonify({'error': 'Incorrect credentials'}), 401)
 
     expire_date = datetime.utcnow() + timedelta(hours=current_app.config.get('TOKEN_DURATION'))
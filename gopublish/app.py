@@ -5,25 +5,34 @@ from celery import Celery
 from flask import Flask, g
 
 from gopublish.api.file import file
+from gopublish.api.metrics import metrics
 from gopublish.api.tag import tag
 from gopublish.api.token import token
 from gopublish.api.view import view
 
-from ldap3 import Connection, NONE, Server
-
 import requests
 
 # Import model classes for flaks migrate
 from .db_models import PublishedFile, Tag  # noqa: F401
 from .extensions import (celery, db, mail, migrate)
+from .logs import DigestSMTPHandler, setup_queue_logging
+from .metrics import init_metrics
 from .middleware import PrefixMiddleware
-from .model.repos import Repos
+from .model.cache import TTLCache
+from .model.downloads import DownloadCounter
+from .model.ldap_client import LdapClient
+from .model.mails import MailQueue
+from .model.repos import Repos, ReposWatcher
+from .model.workers import WorkerTracker
+from .pipeline import CHUNK_SIZE
+from .utils import broadcast_repos_reload
 
 
 __all__ = ('create_app', 'create_celery', )
 
 BLUEPRINTS = (
     file,
+    metrics,
     token,
     view,
     tag
@@ -34,6 +43,7 @@ CONFIG_KEYS = (
     'GOPUBLISH_REPOS_CONF',
     'MAIL_SENDER',
     'MAIL_ADMIN',
+    'LOG_MAIL_WINDOW',
     'BASE_URL',
     'TASK_LOG_DIR',
     'DEBUG',
@@ -60,10 +70,36 @@ CONFIG_KEYS = (
     'LDAP_HOST',
     'LDAP_PORT',
     'LDAP_BASE_QUERY',
+    'LDAP_POOL_SIZE',
+    'LDAP_CACHE_TTL',
+    'LDAP_NEGATIVE_CACHE_TTL',
     'TOKEN_DURATION',
+    'TOKEN_CACHE_SIZE',
     'ADMIN_USERS',
     'PROXY_PREFIX',
-    'ADMIN_API_KEYS'
+    'ADMIN_API_KEYS',
+    'DOWNLOAD_COUNTER_URL',
+    'DOWNLOAD_FLUSH_INTERVAL',
+    'DOWNLOAD_MAX_AGE',
+    'X_ACCEL_LOCATION',
+    'REPOS_RELOAD_INTERVAL',
+    'WORKER_STATUS_URL',
+    'WORKER_HEARTBEAT_TTL',
+    'WORKER_STATUS_CACHE',
+    'PUBLISH_BULK_MAX',
+    'PUBLISH_CHUNK_SIZE',
+    'VIEW_BATCH_MAX',
+    'VIEW_BATCH_THREADS',
+    'STATUS_RECONCILE_INTERVAL',
+    'PULLING_STAT_CACHE',
+    'TAG_COUNT_CACHE',
+    'MAIL_QUEUE',
+    'MAIL_QUEUE_URL',
+    'MAIL_BATCH_WINDOW',
+    'MAIL_MAX_RETRIES',
+    'MAIL_RETRY_DELAY',
+    'METRICS_ENABLED',
+    'METRICS_WORKER_PORT'
 )
 
 
@@ -113,6 +149,15 @@ def create_app(config=None, app_name='gopublish', blueprints=None, run_mode=None
 
         app.config["TOKEN_DURATION"] = token_duration
 
+        try:
+            token_cache_size = int(app.config.get("TOKEN_CACHE_SIZE", 1024))
+        except ValueError:
+            raise ValueError("Malformed configuration for TOKEN_CACHE_SIZE : must be a positive integer")
+        app.config["TOKEN_CACHE_SIZE"] = token_cache_size
+
+        # Verified tokens, until they expire
+        app.token_cache = TTLCache(max_size=token_cache_size, ttl=token_duration * 3600)
+
         admin_users = app.config.get("ADMIN_USERS", [])
         if not type(admin_users) == list:
             raise ValueError("ADMIN_USERS variable is not a list")
@@ -136,7 +181,28 @@ def create_app(config=None, app_name='gopublish', blueprints=None, run_mode=None
                 raise Exception("Missing LDAP_HOST in conf")
             if not app.config.get("LDAP_BASE_QUERY"):
                 raise Exception("Missing LDAP_BASE_QUERY in conf")
-            if not check_ldap(app.config):
+
+        # Pooled LDAP connections, with cached user lookups
+        app.ldap = None
+        if app.config.get("LDAP_HOST"):
+            ldap_conf = {}
+            for key in ["LDAP_POOL_SIZE", "LDAP_CACHE_TTL", "LDAP_NEGATIVE_CACHE_TTL"]:
+                try:
+                    ldap_conf[key] = int(app.config.get(key))
+                except (TypeError, ValueError):
+                    raise ValueError("Malformed configuration for %s : must be a positive integer" % key)
+                app.config[key] = ldap_conf[key]
+            app.ldap = LdapClient(
+                app.config.get("LDAP_HOST"),
+                port=app.config.get("LDAP_PORT", 389),
+                base_query=app.config.get("LDAP_BASE_QUERY"),
+                pool_size=ldap_conf["LDAP_POOL_SIZE"],
+                cache_ttl=ldap_conf["LDAP_CACHE_TTL"],
+                negative_ttl=ldap_conf["LDAP_NEGATIVE_CACHE_TTL"]
+            )
+
+        if config_mode == "prod":
+            if not app.ldap.check():
                 raise Exception("Could not connect to the LDAP")
 
         app.baricadr_enabled = False
@@ -152,6 +218,71 @@ def create_app(config=None, app_name='gopublish', blueprints=None, run_mode=None
             repos_file = os.getenv('GOPUBLISH_REPOS_CONF', '/etc/gopublish/repos.yml')
         app.repos = Repos(repos_file)
 
+        # Reload the repositories when the file changes. Web processes poll it, and notify the workers
+        try:
+            reload_interval = int(app.config.get("REPOS_RELOAD_INTERVAL", 10))
+        except ValueError:
+            raise ValueError("Malformed configuration for REPOS_RELOAD_INTERVAL : must be a positive integer")
+        app.config["REPOS_RELOAD_INTERVAL"] = reload_interval
+        app.repos_watcher = ReposWatcher(app, interval=reload_interval, on_reload=None if app.is_worker else broadcast_repos_reload)
+        if not app.is_worker:
+            app.before_request(app.repos_watcher.ensure_started)
+
+        try:
+            publish_bulk_max = int(app.config.get("PUBLISH_BULK_MAX", 1000))
+        except ValueError:
+            raise ValueError("Malformed configuration for PUBLISH_BULK_MAX : must be a positive integer")
+        if publish_bulk_max < 1:
+            raise ValueError("Malformed configuration for PUBLISH_BULK_MAX : must be a positive integer")
+        app.config["PUBLISH_BULK_MAX"] = publish_bulk_max
+
+        for key, default in [("STATUS_RECONCILE_INTERVAL", 60), ("PULLING_STAT_CACHE", 5), ("DOWNLOAD_MAX_AGE", 31536000)]:
+            try:
+                app.config[key] = int(app.config.get(key, default))
+            except ValueError:
+                raise ValueError("Malformed configuration for %s : must be a positive integer" % key)
+        app.pulling_cache = TTLCache(max_size=4096, ttl=app.config["PULLING_STAT_CACHE"])
+
+        app.config["TAG_COUNT_CACHE"] = _get_bool(app, "TAG_COUNT_CACHE")
+
+        for key, default in [("VIEW_BATCH_MAX", 5000), ("VIEW_BATCH_THREADS", 16), ("PUBLISH_CHUNK_SIZE", CHUNK_SIZE)]:
+            try:
+                app.config[key] = int(app.config.get(key, default))
+            except ValueError:
+                raise ValueError("Malformed configuration for %s : must be a positive integer" % key)
+            if app.config[key] < 1:
+                raise ValueError("Malformed configuration for %s : must be a positive integer" % key)
+
+        # Buffer download counts in redis if available, else in each process
+        try:
+            flush_interval = int(app.config.get("DOWNLOAD_FLUSH_INTERVAL", 30))
+        except ValueError:
+            raise ValueError("Malformed configuration for DOWNLOAD_FLUSH_INTERVAL : must be a positive integer")
+        app.config["DOWNLOAD_FLUSH_INTERVAL"] = flush_interval
+        app.download_counter = DownloadCounter(app, _get_redis_url(app, "DOWNLOAD_COUNTER_URL"), flush_interval=flush_interval)
+        if not app.is_worker:
+            app.before_request(app.download_counter.ensure_started)
+
+        # Worker heartbeats in redis if available, else ping the workers
+        for key, default in [("WORKER_HEARTBEAT_TTL", 30), ("WORKER_STATUS_CACHE", 5)]:
+            try:
+                app.config[key] = int(app.config.get(key, default))
+            except ValueError:
+                raise ValueError("Malformed configuration for %s : must be a positive integer" % key)
+        app.worker_tracker = WorkerTracker(_get_redis_url(app, "WORKER_STATUS_URL"), ttl=app.config["WORKER_HEARTBEAT_TTL"], cache_ttl=app.config["WORKER_STATUS_CACHE"])
+
+        # Notifications are sent in batches by the 'send_mails' task
+        for key, default in [("MAIL_BATCH_WINDOW", 30), ("MAIL_MAX_RETRIES", 5), ("MAIL_RETRY_DELAY", 60)]:
+            try:
+                app.config[key] = int(app.config.get(key, default))
+            except ValueError:
+                raise ValueError("Malformed configuration for %s : must be a positive integer" % key)
+        app.mail_queue = MailQueue(_get_redis_url(app, "MAIL_QUEUE_URL"), queue=app.config.get("MAIL_QUEUE", "mail"), window=app.config["MAIL_BATCH_WINDOW"])
+
+        # Request, task and database pool metrics (queue lengths are read from the broker, if it is redis)
+        broker_url = app.config.get("CELERY_BROKER_URL", "")
+        init_metrics(app, broker_url=broker_url if broker_url.startswith("redis") else None)
+
         if blueprints is None:
             blueprints = BLUEPRINTS
 
@@ -205,14 +336,15 @@ def gvars(app):
 
 
 def configure_logging(app):
-    """Configure file(info) and email(error) logging."""
+    """Configure file(info) and email(error) logging, handled on a background thread"""
 
     if app.debug or app.testing:
         # Skip debug and test mode. Just check standard output.
         return
 
+    import atexit
     import logging
-    from logging.handlers import SMTPHandler
+    from logging.handlers import RotatingFileHandler
 
     # Set log level
     if app.config['GOPUBLISH_RUN_MODE'] == 'test':
@@ -221,13 +353,12 @@ def configure_logging(app):
         app.logger.setLevel(logging.INFO)
 
     info_log = os.path.join(app.config['LOG_FOLDER'], 'info.log')
-    info_file_handler = logging.handlers.RotatingFileHandler(info_log, maxBytes=100000, backupCount=10)
+    info_file_handler = RotatingFileHandler(info_log, maxBytes=100000, backupCount=10)
     info_file_handler.setLevel(logging.INFO)
     info_file_handler.setFormatter(logging.Formatter(
         '%(asctime)s %(levelname)s: %(message)s '
         '[in %(pathname)s:%(lineno)d]')
     )
-    app.logger.addHandler(info_file_handler)
 
     credentials = None
     if app.config.get("MAIL_PASSWORD"):
@@ -235,17 +366,22 @@ def configure_logging(app):
     mailhost = app.config['MAIL_SERVER']
     if 'MAIL_PORT' in app.config:
         mailhost = (app.config['MAIL_SERVER'], app.config['MAIL_PORT'])
-    mail_handler = SMTPHandler(mailhost,
-                               app.config['MAIL_SENDER'],
-                               app.config['MAIL_ADMIN'],
-                               'GOPUBLISH failed!',
-                               credentials)
+    # At most one email (then one digest) for each error location every LOG_MAIL_WINDOW seconds
+    mail_handler = DigestSMTPHandler(mailhost,
+                                     app.config['MAIL_SENDER'],
+                                     app.config['MAIL_ADMIN'],
+                                     'GOPUBLISH failed!',
+                                     credentials,
+                                     window=int(app.config.get('LOG_MAIL_WINDOW', 600)))
     mail_handler.setLevel(logging.ERROR)
     mail_handler.setFormatter(logging.Formatter(
         '%(asctime)s %(levelname)s: %(message)s '
         '[in %(pathname)s:%(lineno)d]')
     )
-    app.logger.addHandler(mail_handler)
+
+    # Logging calls only enqueue the records: file writes and SMTP are done on a background thread
+    listener = setup_queue_logging(app.logger, [info_file_handler, mail_handler])
+    atexit.register(listener.stop)
 
 
 def _merge_conf_with_env_vars(config):
@@ -258,6 +394,26 @@ def _merge_conf_with_env_vars(config):
     return config
 
 
+def _get_redis_url(app, key):
+    # Default to the celery broker if it is redis. "" disables redis
+    url = app.config.get(key)
+    if url is None and app.config.get("CELERY_BROKER_URL", "").startswith("redis"):
+        url = app.config.get("CELERY_BROKER_URL")
+    return url
+
+
+def _get_bool(app, key, default=False):
+    # Environment values are strings
+    value = app.config.get(key, default)
+    if isinstance(value, str):
+        if value.strip().lower() in ("1", "true", "yes", "on"):
+            return True
+        if value.strip().lower() in ("", "0", "false", "no", "off"):
+            return False
+        raise ValueError("Malformed configuration for %s : must be a boolean" % key)
+    return bool(value)
+
+
 def check_baricadr(config):
     baricadr_enabled = False
     if (config.get("BARICADR_URL") and config.get("BARICADR_USER") and config.get("BARICADR_PASSWORD")):
@@ -267,12 +423,3 @@ def check_baricadr(config):
         if res.status_code == 200 and "version" in res.json():
             baricadr_enabled = True
     return baricadr_enabled
-
-
-def check_ldap(config):
-    server = Server(config.get("LDAP_HOST"), config.get("LDAP_PORT", 389), get_info=NONE)
-    conn = Connection(server, auto_bind=True)
-    # Basic query to see if it works
-    has_ldap = conn.bind()
-    conn.unbind()
-    return has_ldap
@@ -19,14 +19,83 @@ class BaseConfig(object):
     SQLALCHEMY_ENGINE_OPTIONS = {'pool_pre_ping': True}
 
     LOG_FOLDER = "/var/log/gopublish/"
+    # Errors emailed to MAIL_ADMIN: at most one email, then one digest, for each error location during this delay (in seconds)
+    LOG_MAIL_WINDOW = 600
 
     # Token validity duration (in hours)
     TOKEN_DURATION = 6
+    # Maximum number of verified tokens kept in each process (0 to verify each request)
+    TOKEN_CACHE_SIZE = 1024
 
     ADMIN_USERS = []
     ADMIN_API_KEYS = []
     PROXY_PREFIX = ""
 
+    # Maximum number of (anonymous) LDAP connections kept by each process
+    LDAP_POOL_SIZE = 5
+    # Lifetime (in seconds) of cached user ids and groups, and of cached unknown users
+    LDAP_CACHE_TTL = 300
+    LDAP_NEGATIVE_CACHE_TTL = 60
+
+    # Delay (in seconds) between two checks of the repositories configuration file for changes (0 to disable)
+    REPOS_RELOAD_INTERVAL = 10
+
+    # Maximum number of files in a bulk publishing request
+    PUBLISH_BULK_MAX = 1000
+
+    # Size (in bytes) of the buffers used by the publish tasks to copy and hash files
+    PUBLISH_CHUNK_SIZE = 8 * 1024 * 1024
+
+    # Maximum number of files in a batch view request, and number of threads checking them on the filesystem
+    VIEW_BATCH_MAX = 5000
+    VIEW_BATCH_THREADS = 16
+
+    # Delay (in seconds) between two checks of the public folders, updating the status of the files (0 to disable)
+    STATUS_RECONCILE_INTERVAL = 60
+    # Lifetime (in seconds) of the cached size of files being pulled, checked by /api/view (0 to wait for the status check)
+    PULLING_STAT_CACHE = 5
+
+    # Read tag counts from the tag_count table instead of aggregating file_tag
+    TAG_COUNT_CACHE = False
+
+    # Redis url used to buffer download counts (defaults to CELERY_BROKER_URL if it is a redis url)
+    # Set to "" to buffer in each web process instead
+    DOWNLOAD_COUNTER_URL = None
+    # Delay (in seconds) between writes of the buffered download counts to the database
+    DOWNLOAD_FLUSH_INTERVAL = 30
+    # Cache lifetime (in seconds) of published files (their content never changes)
+    DOWNLOAD_MAX_AGE = 31536000
+
+    # Redis url where workers record their heartbeats (defaults to CELERY_BROKER_URL if it is a redis url)
+    # Set to "" to ping the workers instead
+    WORKER_STATUS_URL = None
+    # Workers without heartbeat for this long (in seconds) are considered dead
+    WORKER_HEARTBEAT_TTL = 30
+    # Delay (in seconds) between two checks of the workers status in each web process
+    WORKER_STATUS_CACHE = 5
+
+    # Celery queue of the 'send_mails' task (consumed by a dedicated worker, or along the default 'celery' queue)
+    MAIL_QUEUE = "mail"
+    # Redis url where notifications are buffered (defaults to CELERY_BROKER_URL if it is a redis url)
+    # Set to "" to send each notification separately
+    MAIL_QUEUE_URL = None
+    # Notifications to the same recipient within this delay (in seconds) are merged into one email
+    MAIL_BATCH_WINDOW = 30
+    # Failed deliveries are retried after MAIL_RETRY_DELAY seconds, the delay doubling on each retry
+    MAIL_MAX_RETRIES = 5
+    MAIL_RETRY_DELAY = 60
+
+    # Expose Prometheus metrics on /metrics
+    # Set the PROMETHEUS_MULTIPROC_DIR environment variable (to an empty directory) to aggregate the metrics of all uwsgi processes
+    METRICS_ENABLED = True
+    # Port where each celery worker exposes its metrics (0 to disable)
+    METRICS_WORKER_PORT = 0
+
+    # Let nginx send the files (X-Accel-Redirect)
+    USE_X_SENDFILE = False
+    # Internal nginx location, prefixing the public_folder of repositories (unless set with x_accel_location in the repository conf)
+    X_ACCEL_LOCATION = "/_gopublish"
+
 
 class DevelopmentConfig(BaseConfig):
     DEBUG = True
@@ -52,6 +121,8 @@ class TestingConfig(BaseConfig):
     ADMIN_USERS = ["adminuser"]
     ADMIN_API_KEYS = ["fakeapikey"]
 
+    REPOS_RELOAD_INTERVAL = 0
+
 
 class ProdConfig(BaseConfig):
     DEBUG = False
@@ -1,6 +1,7 @@
 import uuid
 from datetime import datetime
 
+from sqlalchemy import DDL, event, func
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.schema import Table
 from .base import Base
@@ -17,6 +18,10 @@ junction_table = Table(
 
 class PublishedFile(db.Model):
     __tablename__ = 'published_file'
+    __table_args__ = (
+        # Keyset pagination on (publishing_date, id) for /api/list and /api/search
+        db.Index('ix_published_file_publishing_date_id', 'publishing_date', 'id'),
+    )
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, unique=True)
     task_id = db.Column(db.String(255), index=True)
     # Maybe store it as text? Or encoded?
@@ -36,15 +41,90 @@ class PublishedFile(db.Model):
     downloads = db.Column(db.Integer, index=True, default=0)
     error = db.Column(db.Text())
     tags = db.relationship("Tag", secondary=junction_table, backref="files")
+    digests = db.relationship("FileDigest", cascade="all, delete-orphan", backref="file")
+    publish_metrics = db.relationship("PublishMetrics", uselist=False, cascade="all, delete-orphan", backref="file")
 
     def __repr__(self):
         return '<PublishedFile {}>'.format(self.id)
 
 
+# Trigram index for substring and fuzzy search on file names (plain expression index on other backends)
+db.Index(
+    'ix_published_file_file_name_trgm',
+    func.lower(PublishedFile.file_name).label('file_name_lower'),
+    postgresql_using='gin',
+    postgresql_ops={'file_name_lower': 'gin_trgm_ops'}
+)
+
+event.listen(
+    PublishedFile.__table__,
+    'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql')
+)
+
+
 class Tag(db.Model):
     __tablename__ = 'tag'
+    __table_args__ = (
+        # Prefix search on tags (LIKE 'xxx%')
+        db.Index('ix_tag_tag_pattern', 'tag', postgresql_ops={'tag': 'varchar_pattern_ops'}),
+    )
     id = db.Column(db.Integer, primary_key=True, unique=True)
     tag = db.Column(db.String(255), index=True)
 
     def __repr__(self):
         return self.tag
+
+
+class TagCount(db.Model):
+    # Number of non-unpublished files for each tag, maintained along file_tag
+    __tablename__ = 'tag_count'
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<TagCount {}: {}>'.format(self.tag_id, self.count)
+
+
+class FileDigest(db.Model):
+    # Digests of the published file content, computed by the publish task
+    __tablename__ = 'file_digest'
+    __table_args__ = (
+        # Lookup of files by digest
+        db.Index('ix_file_digest_algorithm_digest', 'algorithm', 'digest'),
+    )
+    file_id = db.Column(UUID(as_uuid=True), db.ForeignKey('published_file.id', ondelete='CASCADE'), primary_key=True)
+    algorithm = db.Column(db.String(32), primary_key=True)
+    digest = db.Column(db.String(128), nullable=False)
+
+    def __repr__(self):
+        return '<FileDigest {} {}: {}>'.format(self.file_id, self.algorithm, self.digest)
+
+
+class PublishMetrics(db.Model):
+    # Timings of the publish task of a file, in seconds (null when the phase did not run)
+    __tablename__ = 'publish_metrics'
+    __table_args__ = (
+        # Per-repo aggregates over a time range
+        db.Index('ix_publish_metrics_repo_path_published', 'repo_path', 'published'),
+    )
+    file_id = db.Column(UUID(as_uuid=True), db.ForeignKey('published_file.id', ondelete='CASCADE'), primary_key=True)
+    repo_path = db.Column(db.String(255), nullable=False)
+    method = db.Column(db.String(32), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False, default=0)
+    published = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
+    # From the publish request to the start of the task
+    queue_seconds = db.Column(db.Float)
+    # Copy, or rename (and copy across filesystems)
+    transfer_seconds = db.Column(db.Float)
+    # Hashing after a rename, or time the copy waited for the hashing threads
+    hash_seconds = db.Column(db.Float)
+    # Permissions (and symlink when moving)
+    chmod_seconds = db.Column(db.Float)
+    notification_seconds = db.Column(db.Float)
+    # Whole task, notification excluded
+    total_seconds = db.Column(db.Float)
+    bytes_per_second = db.Column(db.Float)
+
+    def __repr__(self):
+        return '<PublishMetrics {}: {}s>'.format(self.file_id, self.total_seconds)
@@ -2,7 +2,7 @@ from gopublish.utils import is_valid_uuid, validate_token
 
 from functools import wraps
 
-from flask import (jsonify, request, current_app, session)
+from flask import (g, jsonify, request, current_app)
 
 
 def token_required(f):
@@ -18,11 +18,12 @@ def token_required(f):
             return jsonify({'error': 'Invalid "X-Auth-Token" header: must start with "Bearer "'}), 401
 
         token = auth.split("Bearer ")[-1]
-        user_data = validate_token(token, current_app.config)
+        user_data = validate_token(token, current_app.config, cache=current_app.token_cache)
         if not user_data['valid']:
             return jsonify({'error': user_data['error']}), 401
 
-        session["user"] = user_data
+        # Request-scoped: no session cookie to sign and send back
+        g.user = user_data
         return f(*args, **kwargs)
 
     return decorated_function
@@ -33,8 +34,9 @@ def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         """Login required decorator"""
-        if 'user' in session:
-            if session['user']['is_admin']:
+        user = get_current_user()
+        if user:
+            if user['is_admin']:
                 return f(*args, **kwargs)
             return jsonify({"error": True, "errorMessage": "Admin required"}), 401
         return jsonify({"error": True, "errorMessage": "Token required"}), 401
@@ -42,6 +44,11 @@ def admin_required(f):
     return decorated_function
 
 
+def get_current_user():
+    """User data of the current request, set by token_required"""
+    return g.get("user")
+
+
 def is_valid_uid(f):
     """Login required function"""
     @wraps(f)
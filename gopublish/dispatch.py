@@ -0,0 +1,49 @@
+from flask import current_app
+
+from gopublish.extensions import db
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Key of the pending tasks in Session.info
+PENDING_TASKS = "gopublish_pending_tasks"
+
+
+def send_task_on_commit(name, args=()):
+    """Send a celery task once the current transaction is committed
+
+    The task is dropped if the transaction is rolled back: workers never see rows that do not exist (yet)
+    """
+
+    _on_commit(name, lambda: current_app.celery.send_task(name, args))
+
+
+def apply_on_commit(name, signature):
+    """Same as send_task_on_commit, for a celery signature (ie a group or a chord)"""
+
+    _on_commit(name, signature.apply_async)
+
+
+def _on_commit(name, send):
+    session = db.session()
+    if not session.in_transaction():
+        # So that a rollback without any query still drops the task
+        session.begin()
+    session.info.setdefault(PENDING_TASKS, []).append((name, send))
+
+
+@event.listens_for(Session, "after_commit")
+def _send_pending_tasks(session):
+    tasks = session.info.pop(PENDING_TASKS, [])
+    for name, send in tasks:
+        send()
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _drop_pending_tasks(session, transaction):
+    # Called after _send_pending_tasks on commit: only tasks of rolled back transactions are left
+    if transaction.parent is not None:
+        return
+    tasks = session.info.pop(PENDING_TASKS, [])
+    if tasks:
+        current_app.logger.warning("Transaction rolled back, dropping tasks: %s" % ", ".join(name for name, send in tasks))
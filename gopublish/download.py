@@ -0,0 +1,218 @@
+import base64
+import binascii
+import mimetypes
+import os
+import uuid
+from datetime import timezone
+from urllib.parse import quote
+
+from flask import Response, current_app, request
+
+from werkzeug.http import http_date, parse_range_header, quote_etag
+
+# Chunk size used to stream files (and ranges) from disk
+CHUNK_SIZE = 1024 * 1024
+
+# Ignore Range headers with more ranges than this, and send the whole file
+MAX_RANGES = 16
+
+
+def send_published_file(path, datafile):
+    """Send a published file, with conditional GET, (multi) range requests and immutable caching
+
+    Published files never change once hashed: the stored md5 is used as a strong ETag
+    Returns the response, and whether it should be counted as a download
+    (full downloads and ranges starting at the beginning of the file)
+    """
+
+    size = os.path.getsize(path)
+    etag = _get_etag(datafile)
+    last_modified = datafile.publishing_date.replace(microsecond=0)
+    digest = _get_digest(etag)
+
+    mimetype = _get_mimetype(datafile)
+    is_get = request.method == "GET"
+
+    headers = _get_headers(datafile, etag, last_modified, digest)
+
+    if _is_not_modified(etag, last_modified):
+        return Response(status=304, headers=headers), False
+
+    ranges = None
+    if request.headers.get("Range") and _if_range_matches(etag, last_modified):
+        ranges = parse_range_header(request.headers.get("Range"))
+
+    if not ranges or len(ranges.ranges) > MAX_RANGES:
+        if digest:
+            headers["Content-MD5"] = digest
+        headers["Content-Length"] = str(size)
+        return Response(_read_range(path, 0, size), status=200, headers=headers, mimetype=mimetype, direct_passthrough=True), is_get
+
+    byte_ranges = _get_byte_ranges(ranges.ranges, size)
+    if not byte_ranges:
+        headers["Content-Range"] = "bytes */%s" % size
+        return Response(status=416, headers=headers), False
+
+    is_download = is_get and byte_ranges[0][0] == 0
+
+    if len(byte_ranges) == 1:
+        start, stop = byte_ranges[0]
+        headers["Content-Range"] = "bytes %s-%s/%s" % (start, stop - 1, size)
+        headers["Content-Length"] = str(stop - start)
+        return Response(_read_range(path, start, stop), status=206, headers=headers, mimetype=mimetype, direct_passthrough=True), is_download
+
+    boundary = uuid.uuid4().hex
+    parts = []
+    length = 0
+    for start, stop in byte_ranges:
+        part_header = ("\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %s-%s/%s\r\n\r\n" % (boundary, mimetype, start, stop - 1, size)).encode()
+        parts.append((part_header, start, stop))
+        length += len(part_header) + stop - start
+    closing = ("\r\n--%s--\r\n" % boundary).encode()
+    length += len(closing)
+
+    headers["Content-Length"] = str(length)
+    return Response(_read_multipart(path, parts, closing), status=206, headers=headers, mimetype="multipart/byteranges; boundary=%s" % boundary, direct_passthrough=True), is_download
+
+
+def send_x_accel(datafile, location):
+    """Offload a published file to nginx with X-Accel-Redirect, without touching the file
+
+    Headers only come from the database. nginx sends the body, and handles range requests
+    Returns the response, and whether it should be counted as a download
+    """
+
+    etag = _get_etag(datafile)
+    last_modified = datafile.publishing_date.replace(microsecond=0)
+
+    headers = _get_headers(datafile, etag, last_modified, _get_digest(etag))
+
+    if _is_not_modified(etag, last_modified):
+        return Response(status=304, headers=headers), False
+
+    headers["X-Accel-Redirect"] = location
+
+    is_download = request.method == "GET"
+    if request.headers.get("Range") and _if_range_matches(etag, last_modified):
+        ranges = parse_range_header(request.headers.get("Range"))
+        if ranges and not ranges.ranges[0][0] == 0:
+            is_download = False
+
+    return Response(status=200, headers=headers, mimetype=_get_mimetype(datafile)), is_download
+
+
+def _get_headers(datafile, etag, last_modified, digest):
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Last-Modified": http_date(last_modified.replace(tzinfo=timezone.utc)),
+        "Content-Disposition": _content_disposition(datafile.file_name)
+    }
+
+    if etag:
+        headers["ETag"] = quote_etag(etag)
+        headers["Cache-Control"] = "public, max-age=%s, immutable" % current_app.config.get("DOWNLOAD_MAX_AGE")
+        if digest:
+            headers["Digest"] = "md5=%s" % digest
+
+    return headers
+
+
+def _get_mimetype(datafile):
+    return mimetypes.guess_type(datafile.file_name)[0] or "application/octet-stream"
+
+
+def _content_disposition(file_name):
+    try:
+        file_name.encode("ascii")
+    except UnicodeEncodeError:
+        return "attachment; filename*=UTF-8''%s" % quote(file_name, safe="")
+    return "attachment; filename=\"%s\"" % file_name.replace('"', '').replace('\\', '')
+
+
+def _get_etag(datafile):
+    # The hash is only set once the file is fully published
+    if datafile.status == "available" and datafile.hash and len(datafile.hash) == 32:
+        return datafile.hash
+    return None
+
+
+def _get_digest(etag):
+    if not etag:
+        return None
+    try:
+        return base64.b64encode(binascii.unhexlify(etag)).decode()
+    except (binascii.Error, ValueError):
+        return None
+
+
+def _to_naive_utc(date):
+    if date.tzinfo:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def _is_not_modified(etag, last_modified):
+    # No validator until the file is hashed: its content may still change
+    if not etag:
+        return False
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return last_modified <= _to_naive_utc(request.if_modified_since)
+    return False
+
+
+def _if_range_matches(etag, last_modified):
+    if_range = request.headers.get("If-Range")
+    if not if_range:
+        return True
+    if_range = request.if_range
+    if if_range.etag:
+        # Strong comparison only
+        return bool(etag) and if_range.etag == etag
+    if if_range.date:
+        return last_modified <= _to_naive_utc(if_range.date)
+    return False
+
+
+def _get_byte_ranges(ranges, size):
+    # Convert (start, stop) with negative start (suffix) or open stop into actual byte ranges
+    # Unsatisfiable ranges are dropped, overlapping or adjacent ones are merged
+    byte_ranges = []
+    for start, stop in ranges:
+        if start < 0:
+            start = max(size + start, 0)
+            stop = size
+        elif stop is None or stop > size:
+            stop = size
+        if start >= size or start >= stop:
+            continue
+        byte_ranges.append([start, stop])
+
+    merged = []
+    for byte_range in sorted(byte_ranges):
+        if merged and byte_range[0] <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], byte_range[1])
+        else:
+            merged.append(byte_range)
+
+    return [tuple(byte_range) for byte_range in merged]
+
+
+def _read_range(path, start, stop):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _read_multipart(path, parts, closing):
+    for part_header, start, stop in parts:
+        yield part_header
+        yield from _read_range(path, start, stop)
+    yield closing
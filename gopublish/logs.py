@@ -0,0 +1,151 @@
+import logging
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, SMTPHandler
+
+
+class FingerprintQueueHandler(QueueHandler):
+    """Send records to a LogListener, without blocking the caller
+
+    The fingerprint of each record (logger, level, location and exception type) is computed before the message
+    is formatted, for DigestSMTPHandler
+    """
+
+    def __init__(self, log_queue, listener):
+        super().__init__(log_queue)
+        self.listener = listener
+
+    def prepare(self, record):
+        exc_type = record.exc_info[0].__name__ if record.exc_info and record.exc_info[0] else None
+        record.fingerprint = (record.name, record.levelno, record.pathname, record.lineno, exc_type)
+        return super().prepare(record)
+
+    def enqueue(self, record):
+        self.listener.ensure_started()
+        super().enqueue(record)
+
+
+class LogListener(QueueListener):
+    """QueueListener started in each process using it: threads do not survive the uwsgi and celery forks"""
+
+    def __init__(self, log_queue, *handlers):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if not self._pid == os.getpid():
+                self._thread = None
+                self.start()
+                self._pid = os.getpid()
+
+    def stop(self):
+        # Writes the queued records
+        with self._lock:
+            if self._pid == os.getpid():
+                super().stop()
+            self._pid = None
+
+
+class DigestSMTPHandler(SMTPHandler):
+    """SMTPHandler sending at most one email per fingerprint every window seconds
+
+    The first record of a fingerprint is sent right away. The next ones are counted (and the first max_samples kept),
+    and sent as a single digest at the end of the window
+    The windows opened before a fork are dropped in the child process: their timers do not survive it
+    """
+
+    def __init__(self, *args, window=600, max_samples=10, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.window = window
+        self.max_samples = max_samples
+        self._windows = {}
+        self._pid = os.getpid()
+
+    def emit(self, record):
+        key = getattr(record, "fingerprint", None) or (record.name, record.levelno, record.pathname, record.lineno, None)
+
+        # Called with the handler lock held
+        self._reset_after_fork()
+        pending = self._windows.get(key)
+        if pending is not None:
+            pending["count"] += 1
+            if len(pending["samples"]) < self.max_samples:
+                pending["samples"].append(self.format(record))
+            return
+
+        timer = threading.Timer(self.window, self.close_window, args=(key,))
+        timer.daemon = True
+        self._windows[key] = {"count": 0, "samples": [], "record": record, "timer": timer}
+        timer.start()
+        self.send(record)
+
+    def close_window(self, key):
+        """Send the digest of a fingerprint, if more records were received"""
+
+        self.acquire()
+        try:
+            pending = self._windows.pop(key, None)
+        finally:
+            self.release()
+
+        if not pending:
+            return
+        pending["timer"].cancel()
+        if not pending["count"]:
+            return
+
+        first = pending["record"]
+        body = "The following error occurred {count} more times in the last {window} seconds{shown}:\n\n{samples}".format(
+            count=pending["count"],
+            window=self.window,
+            shown=" (first %s shown)" % len(pending["samples"]) if pending["count"] > len(pending["samples"]) else "",
+            samples="\n\n".join(pending["samples"])
+        )
+        digest = logging.makeLogRecord({
+            "name": first.name,
+            "levelno": first.levelno,
+            "levelname": first.levelname,
+            "pathname": first.pathname,
+            "lineno": first.lineno,
+            "msg": body
+        })
+        self.send(digest)
+
+    def send(self, record):
+        super().emit(record)
+
+    def _reset_after_fork(self):
+        # The parent process sends the digests of its windows
+        if self._pid != os.getpid():
+            self._windows = {}
+            self._pid = os.getpid()
+
+    def flush(self):
+        self.acquire()
+        try:
+            self._reset_after_fork()
+        finally:
+            self.release()
+        for key in list(self._windows):
+            self.close_window(key)
+
+    def close(self):
+        self.flush()
+        super().close()
+
+
+def setup_queue_logging(logger, handlers):
+    """Route the records of logger to handlers through a queue, handled on a background thread
+
+    Returns the listener (to be stopped at exit)
+    """
+
+    log_queue = queue.Queue(-1)
+    listener = LogListener(log_queue, *handlers)
+    logger.addHandler(FingerprintQueueHandler(log_queue, listener))
+    return listener
@@ -0,0 +1,136 @@
+import atexit
+import os
+import time
+
+from flask import g, request
+
+import prometheus_client
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+import redis
+
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+# Metrics are shared by the uwsgi (or celery) processes if PROMETHEUS_MULTIPROC_DIR is set (a directory emptied at startup)
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+REQUESTS = Counter("gopublish_http_requests_total", "HTTP requests", ["endpoint", "method", "status"])
+REQUEST_DURATION = Histogram("gopublish_http_request_duration_seconds", "HTTP request duration", ["endpoint", "method"])
+
+TASK_DURATION = Histogram("gopublish_task_duration_seconds", "Celery task duration", ["task", "state"],
+                          buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, float("inf")))
+PUBLISHED_BYTES = Counter("gopublish_published_bytes_total", "Bytes copied or moved (and hashed) by the publish tasks", ["method"])
+
+DB_CONNECTIONS = Gauge("gopublish_db_pool_connections", "Open database connections", multiprocess_mode="livesum")
+DB_CHECKED_OUT = Gauge("gopublish_db_pool_checked_out", "Database connections in use", multiprocess_mode="livesum")
+
+
+class QueueLengthCollector():
+    """Number of messages waiting in the celery queues, read from the redis broker at scrape time"""
+
+    def __init__(self, redis_url, queues):
+        self.redis = redis.Redis.from_url(redis_url, socket_timeout=1)
+        self.queues = queues
+
+    def collect(self):
+        try:
+            pipe = self.redis.pipeline()
+            for queue in self.queues:
+                pipe.llen(queue)
+            lengths = pipe.execute()
+        except redis.RedisError:
+            return
+        metric = GaugeMetricFamily("gopublish_celery_queue_length", "Messages waiting in the celery queues", labels=["queue"])
+        for queue, length in zip(self.queues, lengths):
+            metric.add_metric([queue], length)
+        yield metric
+
+
+def init_metrics(app, broker_url=None):
+    """Record the requests of app, and expose them on /metrics (if METRICS_ENABLED)"""
+
+    app.queue_length_collector = None
+    if broker_url:
+        app.queue_length_collector = QueueLengthCollector(broker_url, ["celery", app.config.get("MAIL_QUEUE", "mail")])
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop("request_start", None)
+        if start is not None:
+            endpoint = request.endpoint or "none"
+            REQUEST_DURATION.labels(endpoint, request.method).observe(time.perf_counter() - start)
+            REQUESTS.labels(endpoint, request.method, response.status_code).inc()
+        return response
+
+    _listen_pool_events()
+    if MULTIPROCESS:
+        atexit.register(mark_process_dead)
+
+
+def render_metrics(app):
+    """Get the text exposition of all metrics, and its content type"""
+
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    output = generate_latest(registry)
+
+    if app.queue_length_collector:
+        queues = CollectorRegistry()
+        queues.register(app.queue_length_collector)
+        output += generate_latest(queues)
+
+    return output, CONTENT_TYPE_LATEST
+
+
+def task_started(task_id):
+    _task_starts[task_id] = time.perf_counter()
+
+
+def task_finished(task_id, task_name, state):
+    start = _task_starts.pop(task_id, None)
+    if start is not None:
+        TASK_DURATION.labels(task_name, state or "UNKNOWN").observe(time.perf_counter() - start)
+
+
+def start_worker_server(port):
+    """Expose the metrics of a celery worker (and of its pool processes) on port"""
+
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        prometheus_client.start_http_server(port, registry=registry)
+    else:
+        prometheus_client.start_http_server(port)
+
+
+# Start times of the running tasks (prerun and postrun are sent by the process running the task)
+_task_starts = {}
+
+_pool_events = False
+
+
+def _listen_pool_events():
+    global _pool_events
+    if _pool_events:
+        return
+    _pool_events = True
+    event.listen(Pool, "connect", lambda dbapi_connection, record: DB_CONNECTIONS.inc())
+    event.listen(Pool, "close", lambda dbapi_connection, record: DB_CONNECTIONS.dec())
+    event.listen(Pool, "checkout", lambda dbapi_connection, record, proxy: DB_CHECKED_OUT.inc())
+    event.listen(Pool, "checkin", lambda dbapi_connection, record: DB_CHECKED_OUT.dec())
+
+
+def mark_process_dead(*args, **kwargs):
+    """Drop the live gauges of the current process (at exit, or when a celery pool process stops)"""
+
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
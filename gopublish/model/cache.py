@@ -0,0 +1,56 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache():
+    """Thread-safe LRU cache, with a lifetime for each entry
+
+    Least recently used entries are evicted once max_size is reached
+    """
+
+    def __init__(self, max_size=1024, ttl=300):
+
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store value for ttl seconds (defaults to the cache ttl)"""
+
+        if ttl is None:
+            ttl = self.ttl
+        if self.max_size <= 0 or ttl <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """Remove an entry, or all of them"""
+
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
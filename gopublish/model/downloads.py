@@ -0,0 +1,176 @@
+import atexit
+import os
+import threading
+import time
+from collections import defaultdict
+from uuid import UUID
+
+from flask import current_app
+
+from gopublish.db_models import PublishedFile
+from gopublish.extensions import db
+
+import redis
+
+from sqlalchemy import func
+
+
+class DownloadCounter():
+    """Write-behind download counter
+
+    Increments are buffered in a redis hash (shared by all processes) if redis_url is set,
+    else in a per-process buffer. flush() writes them to the database in bulk
+    (the 'flush_downloads' task does it periodically for redis, and a background thread of each process for its
+    local buffer: processes forked after start (ie uwsgi workers) need to call ensure_started() to get their own thread)
+    The local buffer is also written at exit
+    """
+
+    REDIS_KEY = "gopublish:downloads"
+
+    def __init__(self, app, redis_url=None, flush_interval=30):
+
+        self.redis = None
+        if redis_url:
+            self.redis = redis.Redis.from_url(redis_url)
+
+        self.app = app
+        self.flush_interval = flush_interval
+
+        self._pending = defaultdict(int)
+        self._lock = threading.Lock()
+        self._pid = None
+
+        # Inherited by the forked processes
+        atexit.register(self._flush_at_exit)
+
+    def ensure_started(self):
+        # Threads do not survive a fork
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._run, name="gopublish-download-counter", daemon=True)
+            thread.start()
+
+    def increment(self, file_id, count=1):
+        if self.redis:
+            try:
+                self.redis.hincrby(self.REDIS_KEY, str(file_id), count)
+                return
+            except redis.RedisError as err:
+                current_app.logger.warning("Could not buffer download in redis, using local buffer: %s", err)
+
+        with self._lock:
+            self._pending[str(file_id)] += count
+
+    def pending(self, file_ids):
+        """Get the counts not yet written to the database"""
+
+        file_ids = [str(file_id) for file_id in file_ids]
+        if not file_ids:
+            return {}
+
+        with self._lock:
+            counts = {file_id: self._pending[file_id] for file_id in file_ids if file_id in self._pending}
+
+        if self.redis:
+            try:
+                values = self.redis.hmget(self.REDIS_KEY, file_ids)
+            except redis.RedisError as err:
+                current_app.logger.warning("Could not get pending downloads from redis: %s", err)
+                values = []
+            for file_id, value in zip(file_ids, values):
+                if value:
+                    counts[file_id] = counts.get(file_id, 0) + int(value)
+
+        return counts
+
+    def flush(self, local_only=False):
+        """Write the pending counts to the database. Returns the number of updated files
+
+        local_only skips the counts buffered in redis
+        """
+
+        with self._lock:
+            local_counts = self._pending
+            self._pending = defaultdict(int)
+
+        redis_counts = {}
+        if self.redis and not local_only:
+            try:
+                # Atomically take the whole hash
+                pipe = self.redis.pipeline()
+                pipe.hgetall(self.REDIS_KEY)
+                pipe.delete(self.REDIS_KEY)
+                redis_counts = pipe.execute()[0]
+            except redis.RedisError as err:
+                current_app.logger.warning("Could not get pending downloads from redis: %s", err)
+
+        redis_counts = {file_id.decode(): int(value) for file_id, value in redis_counts.items()}
+
+        counts = defaultdict(int, local_counts)
+        for file_id, value in redis_counts.items():
+            counts[file_id] += value
+
+        if not counts:
+            return 0
+
+        try:
+            self._write(counts)
+        except Exception:
+            db.session.rollback()
+            # Put back the counts for the next flush, where they came from: worker processes (ie the
+            # 'flush_downloads' task) have no flush thread, and their local buffer is not seen by the web processes
+            self._restore(local_counts, redis_counts)
+            raise
+
+        return len(counts)
+
+    def _restore(self, local_counts, redis_counts):
+        if redis_counts:
+            try:
+                pipe = self.redis.pipeline()
+                for file_id, value in redis_counts.items():
+                    pipe.hincrby(self.REDIS_KEY, file_id, value)
+                pipe.execute()
+                redis_counts = {}
+            except redis.RedisError as err:
+                current_app.logger.warning("Could not put back pending downloads in redis, using local buffer: %s", err)
+
+        with self._lock:
+            for counts in (local_counts, redis_counts):
+                for file_id, value in counts.items():
+                    self._pending[file_id] += value
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self._flush_local()
+
+    def _flush_at_exit(self):
+        self._flush_local()
+
+    def _flush_local(self):
+        if not self._pending:
+            return
+        with self.app.app_context():
+            try:
+                self.flush(local_only=True)
+            except Exception as err:
+                self.app.logger.error("Could not write download counts: %s", err)
+
+    def _write(self, counts):
+        # One UPDATE per distinct increment value (most files are downloaded once or twice between flushes)
+        by_value = defaultdict(list)
+        for file_id, value in counts.items():
+            by_value[value].append(UUID(file_id))
+
+        for value, file_ids in by_value.items():
+            PublishedFile.query.filter(PublishedFile.id.in_(file_ids)).update(
+                {PublishedFile.downloads: func.coalesce(PublishedFile.downloads, 0) + value},
+                synchronize_session=False
+            )
+        db.session.commit()
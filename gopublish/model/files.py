@@ -0,0 +1,180 @@
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from gopublish.db_models import FileDigest, PublishedFile, Tag, junction_table
+from gopublish.extensions import db
+
+from sqlalchemy import or_
+
+# Statuses depending on the presence of the published copy
+RECONCILED_STATUSES = ["available", "pulling", "unavailable"]
+
+
+def get_files_details(file_ids, max_workers=1):
+    """Get the details of several files (as in /api/view), with one query for each kind of data
+
+    Returns {file_id (str): details}. Unknown ids are left out
+    Read-only: statuses are updated by reconcile_statuses. Files being pulled are checked on the filesystem
+    (with max_workers threads, the sizes being cached for PULLING_STAT_CACHE seconds) to report them available right away
+    """
+
+    files = PublishedFile.query.filter(PublishedFile.id.in_(file_ids)).all()
+    if not files:
+        return {}
+    ids = [datafile.id for datafile in files]
+
+    paths = {}
+    repos = {}
+    for datafile in files:
+        if datafile.repo_path not in repos:
+            repos[datafile.repo_path] = current_app.repos.get_repo(datafile.repo_path)
+        repo = repos[datafile.repo_path]
+        paths[datafile.id] = os.path.join(repo.public_folder, str(datafile.id)) if repo else None
+
+    statuses = _current_statuses(files, paths, max_workers)
+
+    tags = defaultdict(list)
+    for file_id, tag in db.session.query(junction_table.c.file_id, Tag.tag).join(Tag, Tag.id == junction_table.c.tag_id).filter(junction_table.c.file_id.in_(ids)):
+        tags[file_id].append(tag)
+
+    digests = defaultdict(dict)
+    for digest in FileDigest.query.filter(FileDigest.file_id.in_(ids)):
+        digests[digest.file_id][digest.algorithm] = digest.digest
+
+    siblings = _get_siblings(files, statuses)
+    downloads = current_app.download_counter.pending(ids)
+
+    return {str(datafile.id): {
+        "contact": datafile.contact,
+        "owner": datafile.owner,
+        "status": statuses[datafile.id],
+        "path": paths[datafile.id],
+        "file_name": datafile.file_name,
+        "version": datafile.version,
+        "size": datafile.size,
+        "hash": datafile.hash,
+        "digests": digests[datafile.id],
+        "downloads": (datafile.downloads or 0) + downloads.get(str(datafile.id), 0),
+        "publishing_date": datafile.publishing_date.strftime('%Y-%m-%d'),
+        "siblings": siblings[datafile.id],
+        "tags": tags[datafile.id]
+    } for datafile in files}
+
+
+def reconcile_statuses(repo, batch_size=1000):
+    """Update the status of the files of a repository from the content of its public folder
+
+    The folder is listed once, and the transitions are written with one UPDATE per batch_size files
+    Returns the number of updated files
+    """
+
+    try:
+        with os.scandir(repo.public_folder) as entries:
+            published = {entry.name: entry for entry in entries if entry.is_file()}
+    except FileNotFoundError:
+        # ie an unmounted share: better not mark every file as unavailable
+        current_app.logger.warning("Public folder %s of repository %s not found, skipping status check", repo.public_folder, repo.local_path)
+        return 0
+
+    rows = db.session.query(PublishedFile.id, PublishedFile.status, PublishedFile.size) \
+        .filter(PublishedFile.repo_path == repo.local_path, PublishedFile.status.in_(RECONCILED_STATUSES))
+
+    transitions = defaultdict(list)
+    for row in rows.yield_per(batch_size):
+        entry = published.get(str(row.id))
+        if entry is None:
+            file_size = None
+        elif row.status == "pulling":
+            file_size = entry.stat().st_size
+        else:
+            # Only the size of files being pulled matters
+            file_size = row.size
+        status = file_status(row, file_size, repo.has_baricadr)
+        if status != row.status:
+            transitions[(row.status, status)].append(row.id)
+
+    updated = 0
+    for (old_status, status), ids in transitions.items():
+        for i in range(0, len(ids), batch_size):
+            # The status may have changed since the listing (ie a pull request)
+            updated += PublishedFile.query.filter(PublishedFile.id.in_(ids[i:i + batch_size]), PublishedFile.status == old_status) \
+                .update({PublishedFile.status: status}, synchronize_session=False)
+    db.session.commit()
+
+    return updated
+
+
+def file_status(datafile, file_size, has_baricadr):
+    """Status of a file, given the size of its published copy (None if missing)"""
+
+    if file_size is not None:
+        # We don't know the status of Baricadr, so, check the size for completion
+        if datafile.status == "pulling" and file_size == datafile.size:
+            return "available"
+        # Should not happen: for testing/dev purposes
+        if datafile.status == "unavailable":
+            return "available"
+    elif datafile.status == "available":
+        # TODO : Add baricadr check if the file exists
+        return "pullable" if has_baricadr else "unavailable"
+    return datafile.status
+
+
+def _current_statuses(files, paths, max_workers):
+    statuses = {datafile.id: datafile.status for datafile in files}
+
+    pulling = [datafile for datafile in files if datafile.status == "pulling" and paths[datafile.id]]
+    if not pulling or not current_app.config.get("PULLING_STAT_CACHE"):
+        return statuses
+
+    # No app context in the threads
+    cache = current_app.pulling_cache
+    pulling_paths = [paths[datafile.id] for datafile in pulling]
+    if max_workers > 1 and len(pulling) > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(pulling))) as executor:
+            sizes = list(executor.map(lambda path: _cached_size(cache, path), pulling_paths))
+    else:
+        sizes = [_cached_size(cache, path) for path in pulling_paths]
+
+    for datafile, size in zip(pulling, sizes):
+        statuses[datafile.id] = file_status(datafile, size, False)
+    return statuses
+
+
+def _cached_size(cache, path):
+    size = cache.get(path)
+    if size is None:
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            size = -1
+        cache.set(path, size)
+    return size if size >= 0 else None
+
+
+def _get_siblings(files, statuses):
+    # Other versions of each file: the original file first, then the other versions
+    # Statuses just checked take precedence over the database
+    main_ids = set(datafile.version_of_id or datafile.id for datafile in files)
+    versions = db.session.query(PublishedFile.id, PublishedFile.version_of_id, PublishedFile.version, PublishedFile.status, PublishedFile.publishing_date) \
+        .filter(or_(PublishedFile.id.in_(main_ids), PublishedFile.version_of_id.in_(main_ids))) \
+        .order_by(PublishedFile.version)
+
+    mains = {}
+    subversions = defaultdict(list)
+    for version in versions:
+        sibling = {"uri": version.id, "version": version.version, "status": statuses.get(version.id, version.status), "publishing_date": version.publishing_date.strftime('%Y-%m-%d')}
+        if version.version_of_id:
+            subversions[version.version_of_id].append(sibling)
+        else:
+            mains[version.id] = sibling
+
+    siblings = {}
+    for datafile in files:
+        main_id = datafile.version_of_id or datafile.id
+        family = ([mains[main_id]] if datafile.version_of_id and main_id in mains else []) + subversions[main_id]
+        siblings[datafile.id] = [sibling for sibling in family if sibling["uri"] != datafile.id]
+    return siblings
@@ -0,0 +1,186 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+from gopublish.model.cache import TTLCache
+
+from ldap3 import Connection, NONE, SYNC, Server
+from ldap3.core.exceptions import LDAPException
+from ldap3.utils.conv import escape_filter_chars
+
+
+class LdapClient():
+    """LDAP lookups over a bounded pool of anonymous connections, with a cache of user data
+
+    User data (uidNumber, dn and groups) is cached for cache_ttl seconds, unknown users for negative_ttl seconds
+    Passwords are checked with a dedicated connection, and never cached
+    """
+
+    def __init__(self, host, port=389, base_query="", pool_size=5, pool_timeout=10, cache_ttl=300, negative_ttl=60, cache_size=1024, client_strategy=SYNC):
+
+        self.server = Server(host, int(port), get_info=NONE)
+        self.base_query = base_query
+        self.client_strategy = client_strategy
+
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self._pool = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        # Connections are not shared with forked processes (ie uwsgi workers)
+        self._pid = os.getpid()
+
+        self.cache = TTLCache(max_size=cache_size, ttl=cache_ttl)
+        self.negative_ttl = negative_ttl
+
+    def check(self):
+        # Called before uwsgi forks: the connection is not kept in the pool
+        conn = Connection(self.server, client_strategy=self.client_strategy)
+        try:
+            return conn.bind()
+        except LDAPException:
+            return False
+        finally:
+            conn.unbind()
+
+    def get_user_data(self, username, refresh=False):
+        """Get the uidNumber, dn and groups of a user (the returned dict is shared: do not modify it)
+
+        "error" is set if the user does not exist
+        refresh=True skips the cache
+        """
+
+        if not refresh:
+            data = self.cache.get(username)
+            if data is not None:
+                return data
+
+        data = {"user_id": None, "user_dn": None, "user_group_names": [], "user_group_ids": [], "error": None}
+        escaped = escape_filter_chars(username)
+
+        users = self._search('(uid=%s)' % escaped, ['uidNumber'], size_limit=1)
+        if not users:
+            data['error'] = "Could not find user %s in LDAP" % username
+            self.cache.set(username, data, ttl=self.negative_ttl)
+            return data
+
+        data['user_id'] = users[0]['uidNumber'].values[0]
+        data['user_dn'] = users[0].entry_dn
+
+        for group in self._search('(memberuid=%s)' % escaped, ['gidNumber', 'cn']):
+            data['user_group_names'].append(group['cn'][0])
+            data['user_group_ids'].append(group['gidNumber'][0])
+
+        self.cache.set(username, data)
+        return data
+
+    def authenticate(self, username, password):
+        # An empty password would be an anonymous bind, and succeed
+        if not password:
+            return False
+
+        data = self.get_user_data(username)
+        if data["error"]:
+            return False
+
+        if self._bind(data["user_dn"], password):
+            return True
+
+        # The cached dn may be outdated
+        fresh_data = self.get_user_data(username, refresh=True)
+        if not fresh_data["error"] and not fresh_data["user_dn"] == data["user_dn"]:
+            return self._bind(fresh_data["user_dn"], password)
+        return False
+
+    def invalidate(self, username=None):
+        """Forget the cached data of a user, or of all users"""
+
+        self.cache.invalidate(username)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+    def _bind(self, dn, password):
+        conn = Connection(self.server, user=dn, password=password, client_strategy=self.client_strategy)
+        try:
+            return conn.bind()
+        except LDAPException:
+            return False
+        finally:
+            conn.unbind()
+
+    def _search(self, search_filter, attributes, size_limit=0):
+        try:
+            return self._do_search(search_filter, attributes, size_limit)
+        except LDAPException:
+            # Pooled connections may have been closed by the server (ie idle timeout): drop them all, and retry once with a new one
+            self.close()
+            return self._do_search(search_filter, attributes, size_limit)
+
+    def _do_search(self, search_filter, attributes, size_limit):
+        with self._connection() as conn:
+            conn.search(self.base_query, search_filter, attributes=attributes, size_limit=size_limit, time_limit=10)
+            return list(conn.entries)
+
+    @contextmanager
+    def _connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        except Exception:
+            # The connection may be broken
+            self._discard(conn)
+            raise
+        self._pool.put(conn)
+
+    def _acquire(self):
+        if not self._pid == os.getpid():
+            self._reset_after_fork()
+
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self._created < self.pool_size
+            if create:
+                self._created += 1
+
+        if create:
+            try:
+                conn = Connection(self.server, client_strategy=self.client_strategy)
+                if not conn.bind():
+                    raise LDAPException("Could not bind to the LDAP: %s" % conn.result)
+                return conn
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._pool.get(timeout=self.pool_timeout)
+        except queue.Empty:
+            raise LDAPException("No LDAP connection available after %s seconds" % self.pool_timeout)
+
+    def _discard(self, conn):
+        with self._lock:
+            self._created -= 1
+        try:
+            conn.unbind()
+        except LDAPException:
+            pass
+
+    def _reset_after_fork(self):
+        # The inherited sockets belong to the parent process: forget them without unbinding
+        with self._lock:
+            if not self._pid == os.getpid():
+                self._pool = queue.LifoQueue()
+                self._created = 0
+                self._pid = os.getpid()
@@ -0,0 +1,155 @@
+from collections import namedtuple
+
+from gopublish.db_models import PublishedFile, Tag, junction_table
+from gopublish.extensions import db
+from gopublish.utils import encode_cursor, estimate_count, is_valid_uuid
+
+from sqlalchemy import desc, func, or_, select, tuple_
+
+# Separator used to aggregate tag names on backends without array_agg
+TAG_SEPARATOR = "\x1f"
+
+COUNT_MODES = ["exact", "estimate", "none"]
+
+SEARCH_MODES = ["substring", "fuzzy"]
+
+SEARCH_ORDERS = ["date", "relevance"]
+
+FileRow = namedtuple("FileRow", ["uri", "file_name", "size", "version", "status", "downloads", "publishing_date", "tags"])
+
+
+def get_files_page(filters, limit, offset=0, cursor=None, count_mode="exact", order_by=None, facets=True):
+    """Get a page of published files, their tags, and the tag facets of the whole result set
+
+    Files are returned as FileRow tuples, not ORM entities
+    The page itself is fetched with a single statement
+    A custom order_by (ie relevance) disables the keyset cursor
+    Tag facets are None if facets is False
+    """
+
+    files = db.session.query(
+        PublishedFile.id.label("uri"),
+        PublishedFile.file_name,
+        PublishedFile.size,
+        PublishedFile.version,
+        PublishedFile.status,
+        PublishedFile.downloads,
+        PublishedFile.publishing_date,
+        _file_tags().label("tags")
+    ).filter(*filters)
+
+    keyset = not order_by
+    if keyset:
+        files = files.order_by(desc(PublishedFile.publishing_date), desc(PublishedFile.id))
+    else:
+        files = files.order_by(*order_by, desc(PublishedFile.publishing_date), desc(PublishedFile.id))
+
+    # Keyset pagination on (publishing_date, id), served by ix_published_file_publishing_date_id
+    # The cursor takes precedence over the offset
+    if keyset and cursor:
+        files = files.filter(tuple_(PublishedFile.publishing_date, PublishedFile.id) < tuple_(*cursor))
+    else:
+        files = files.offset(offset)
+
+    # One more row than the limit, to know if there is a next page
+    rows = [_to_file_row(row) for row in files.limit(limit + 1)]
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = None
+    if keyset and has_next and rows:
+        next_cursor = encode_cursor(rows[-1].publishing_date, rows[-1].uri)
+
+    return {
+        "files": rows,
+        "total": count_files(filters, count_mode),
+        "tags": get_tag_facets(filters) if facets else None,
+        "next_cursor": next_cursor
+    }
+
+
+def count_files(filters, count_mode="exact"):
+    if count_mode == "none":
+        return None
+
+    files = db.session.query(PublishedFile.id).filter(*filters)
+    if count_mode == "estimate":
+        return estimate_count(db.session, files)
+    return files.count()
+
+
+def get_tag_facets(filters):
+    """Count tags over all the files matching the filters, most used first"""
+
+    matching = db.session.query(PublishedFile.id).filter(*filters).subquery()
+    count = func.count(junction_table.c.file_id)
+
+    facets = db.session.query(Tag.tag, count) \
+        .join(junction_table, junction_table.c.tag_id == Tag.id) \
+        .join(matching, matching.c.id == junction_table.c.file_id) \
+        .group_by(Tag.tag) \
+        .order_by(desc(count), Tag.tag)
+
+    return [{"tag": tag, "count": count} for tag, count in facets]
+
+
+def search_filters(file_name, tag_list, mode="substring"):
+    """Filters of a search: published files with all the tags of tag_list (Tag entities), matching file_name"""
+
+    filters = [*[PublishedFile.tags.contains(t) for t in tag_list], PublishedFile.status != "unpublished"]
+    if file_name and is_valid_uuid(file_name):
+        filters.append(PublishedFile.id != file_name)
+    else:
+        filters.append(file_name_filter(file_name, mode))
+    return filters
+
+
+def file_name_filter(term, mode="substring"):
+    """Filter on file names, served by the ix_published_file_file_name_trgm trigram index on postgresql
+
+    The fuzzy mode also matches names with typos (pg_trgm word similarity)
+    Other backends only support substring matching
+    """
+
+    term = term.lower()
+    substring = func.lower(PublishedFile.file_name).contains(term, autoescape=True)
+
+    if mode == "fuzzy" and _is_postgresql():
+        return or_(substring, func.lower(PublishedFile.file_name).op("%>")(term))
+    return substring
+
+
+def file_name_relevance(term):
+    """Order clause, best matches first"""
+
+    if _is_postgresql():
+        return desc(func.word_similarity(term.lower(), func.lower(PublishedFile.file_name)))
+    # Fallback: shortest matching names first
+    return func.length(PublishedFile.file_name)
+
+
+def _is_postgresql():
+    return db.session.get_bind().dialect.name == "postgresql"
+
+
+def _file_tags():
+    # Correlated aggregate, only evaluated for the rows of the page
+    if _is_postgresql():
+        aggregate = func.array_agg(Tag.tag)
+    else:
+        aggregate = func.group_concat(Tag.tag, TAG_SEPARATOR)
+
+    return select(aggregate) \
+        .select_from(junction_table.join(Tag, Tag.id == junction_table.c.tag_id)) \
+        .where(junction_table.c.file_id == PublishedFile.id) \
+        .correlate(PublishedFile) \
+        .scalar_subquery()
+
+
+def _to_file_row(row):
+    tags = row.tags
+    if not tags:
+        tags = []
+    elif isinstance(tags, str):
+        tags = tags.split(TAG_SEPARATOR)
+    return FileRow(*row[:7], tags)
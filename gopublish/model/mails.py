@@ -0,0 +1,98 @@
+import json
+import smtplib
+
+from flask import current_app
+
+from flask_mail import Message
+
+from gopublish.extensions import mail
+
+import redis
+
+
+class MailQueue():
+    """Outgoing notifications, sent by the 'send_mails' task on a dedicated celery queue
+
+    If redis_url is set, notifications are buffered in a redis list, and the first one of a window schedules
+    the task window seconds later: notifications to the same recipient within the window are merged into one email.
+    Without redis (or if redis fails), each notification is sent by its own task
+    """
+
+    REDIS_KEY = "gopublish:mails"
+    SCHEDULED_KEY = "gopublish:mails:scheduled"
+
+    def __init__(self, redis_url=None, queue="mail", window=30):
+
+        self.redis = None
+        if redis_url:
+            self.redis = redis.Redis.from_url(redis_url)
+
+        self.queue = queue
+        self.window = window
+
+    def push(self, celery, recipients, subject, body):
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        notification = {"recipients": list(recipients), "subject": subject, "body": body}
+
+        if self.redis:
+            try:
+                self.redis.rpush(self.REDIS_KEY, json.dumps(notification))
+                # The key expires in case the task is lost, so that the next notification schedules a new one
+                if self.redis.set(self.SCHEDULED_KEY, 1, nx=True, ex=self.window + 300):
+                    celery.send_task("send_mails", countdown=self.window, queue=self.queue)
+                return
+            except redis.RedisError as err:
+                current_app.logger.warning("Could not buffer notification in redis, sending it right away: %s", err)
+
+        celery.send_task("send_mails", args=([notification],), queue=self.queue)
+
+    def pop(self):
+        """Take all the buffered notifications, and let the next notification schedule a new task"""
+
+        if not self.redis:
+            return []
+
+        pipe = self.redis.pipeline()
+        pipe.lrange(self.REDIS_KEY, 0, -1)
+        pipe.delete(self.REDIS_KEY)
+        pipe.delete(self.SCHEDULED_KEY)
+        notifications = pipe.execute()[0]
+        return [json.loads(notification) for notification in notifications]
+
+
+def send_notifications(notifications, sender):
+    """Send notifications over a single SMTP connection, with one email per recipient
+
+    Returns the notifications which could not be sent (one per recipient), and the error
+    """
+
+    digests = coalesce(notifications)
+    sent = 0
+    try:
+        with mail.connect() as connection:
+            for recipient, group in digests:
+                connection.send(digest_message(recipient, group, sender))
+                sent += 1
+    except (smtplib.SMTPException, OSError) as err:
+        unsent = [dict(notification, recipients=[recipient]) for recipient, group in digests[sent:] for notification in group]
+        return unsent, err
+
+    return [], None
+
+
+def coalesce(notifications):
+    # [(recipient, notifications)], in order of first notification
+    digests = {}
+    for notification in notifications:
+        for recipient in notification["recipients"]:
+            digests.setdefault(recipient, []).append(notification)
+    return list(digests.items())
+
+
+def digest_message(recipient, notifications, sender):
+    if len(notifications) == 1:
+        return Message(subject=notifications[0]["subject"], body=notifications[0]["body"], sender=sender, recipients=[recipient])
+
+    body = "\n----\n\n".join("{subject}\n\n{body}".format(**notification) for notification in notifications)
+    return Message(subject="Gopublish: {count} notifications".format(count=len(notifications)), body=body, sender=sender, recipients=[recipient])
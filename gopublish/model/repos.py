@@ -1,11 +1,19 @@
 import os
 import tempfile
+import threading
+import time
+import uuid
+
+from celery import chord
 
 from flask import current_app
 
-from gopublish.db_models import PublishedFile, Tag
+from gopublish.db_models import PublishedFile, junction_table
+from gopublish.dispatch import apply_on_commit, send_task_on_commit
 from gopublish.extensions import db
-from gopublish.utils import get_user_ldap_data
+from gopublish.model.tags import get_or_create_tags, update_tag_counts
+
+from sqlalchemy import insert
 
 import yaml
 
@@ -49,6 +57,12 @@ class Repo():
         if not type(self.allowed_users) == list:
             raise ValueError("allowed_users for path '%s' is not a list" % local_path)
 
+        # Internal nginx location serving public_folder, for X-Accel-Redirect downloads
+        self.x_accel_prefix = conf.get("x_accel_location")
+        if not self.x_accel_prefix:
+            self.x_accel_prefix = current_app.config.get("X_ACCEL_LOCATION", "/_gopublish").rstrip("/") + os.path.join(os.path.abspath(self.public_folder), "")
+        self.x_accel_prefix = os.path.join(self.x_accel_prefix, "")
+
     def is_in_repo(self, path):
         path = os.path.join(path, "")
 
@@ -56,40 +70,32 @@ class Repo():
 
     def check_publish_file(self, file_path, user_data):
 
-        username = user_data["username"]
-        is_admin = user_data["is_admin"]
-
         if not os.path.exists(file_path):
             return {"available": False, "error": "Target file %s does not exists" % file_path}
 
+        return self.check_publish_access(str(os.stat(file_path).st_uid), user_data)
+
+    def check_publish_access(self, file_uid, user_data):
+        """Check if the user can publish files owned by file_uid in this repository"""
+
+        username = user_data["username"]
+        is_admin = user_data["is_admin"]
+
         # Check is user is in allowed groups
         # Check if user is in allowed users
         # If no allowed groups and no allowed_users: check if is owner
 
         if current_app.config['GOPUBLISH_RUN_MODE'] == "prod":
-            user_data = get_user_ldap_data(username, current_app.config)
-
-            if user_data["error"]:
-                return {"available": False, "error": "%s" % user_data["error"]}
-
-            has_access = False
-
-            if is_admin:
-                has_access = True
+            ldap_data = current_app.ldap.get_user_data(username)
+            has_access = self._has_access(file_uid, username, is_admin, ldap_data)
 
-            if (set(self.allowed_groups) & set(user_data["user_group_ids"])):
-                has_access = True
-            if (set(self.allowed_groups) & set(user_data["user_group_names"])):
-                has_access = True
+            if not has_access and not ldap_data["error"]:
+                # Cached groups may be outdated (ie: user just added to a group)
+                ldap_data = current_app.ldap.get_user_data(username, refresh=True)
+                has_access = self._has_access(file_uid, username, is_admin, ldap_data)
 
-            if username in self.allowed_users:
-                has_access = True
-            if user_data['user_id'] in self.allowed_users:
-                has_access = True
-
-            # If no restriction on user and groups, check is owner
-            if not (self.allowed_users and self.allowed_groups) and str(os.stat(file_path).st_uid) == user_data['user_id']:
-                has_access = True
+            if ldap_data["error"]:
+                return {"available": False, "error": "%s" % ldap_data["error"]}
 
             if not has_access:
                 return {"available": False, "error": "User %s does not have permission to publish this file on this repository" % username}
@@ -97,6 +103,30 @@ class Repo():
 
         return {"available": True, "error": ""}
 
+    def _has_access(self, file_uid, username, is_admin, ldap_data):
+
+        if ldap_data["error"]:
+            return False
+
+        if is_admin:
+            return True
+
+        if (set(self.allowed_groups) & set(ldap_data["user_group_ids"])):
+            return True
+        if (set(self.allowed_groups) & set(ldap_data["user_group_names"])):
+            return True
+
+        if username in self.allowed_users:
+            return True
+        if ldap_data['user_id'] in self.allowed_users:
+            return True
+
+        # If no restriction on user and groups, check is owner
+        if not (self.allowed_users and self.allowed_groups) and file_uid == ldap_data['user_id']:
+            return True
+
+        return False
+
     def publish_file(self, file_path, user_data, version=1, email="", contact="", linked_to=None, tags=set()):
         username = user_data["username"]
         # Send task to copy file
@@ -106,24 +136,15 @@ class Repo():
 
         pf = PublishedFile(file_name=file_name, repo_path=self.local_path, version=version, owner=username, size=size, version_of=linked_to)
         if tags:
-            missing_tag = False
-            tag_list = []
-            for tag in tags:
-                tag_entity = Tag.query.filter_by(tag=tag).first()
-                if not tag_entity:
-                    missing_tag = True
-                    tag_entity = Tag(tag=tag)
-                    db.session.add(tag_entity)
-                tag_list.append(tag_entity)
-            if missing_tag:
-                db.session.commit()
-            pf.tags = tag_list
+            pf.tags = get_or_create_tags(tags)
 
         if contact:
             pf.contact = contact
         db.session.add(pf)
+        db.session.flush()
+        update_tag_counts([tag.id for tag in pf.tags], 1)
+        send_task_on_commit("publish", (pf.id, file_path, email))
         db.session.commit()
-        current_app.celery.send_task("publish", (pf.id, file_path, email))
         return pf.id
 
     def list_files(self):
@@ -131,6 +152,9 @@ class Repo():
         files = PublishedFile.query.filter(PublishedFile.repo_path == self.local_path)
         return files
 
+    def x_accel_location(self, file_id):
+        return self.x_accel_prefix + str(file_id)
+
     def relative_path(self, path):
         return path[len(self.local_path) + 1:]
 
@@ -161,41 +185,132 @@ class Repos():
 
         self.config_file = config_file
 
+        self._signature = None
+        self._lock = threading.Lock()
+
         self.read_conf(config_file)
 
+    @property
+    def repos(self):
+        return self._state[0]
+
     def read_conf(self, path):
 
+        signature = self._get_signature(path)
         with open(path, 'r') as stream:
-            self.repos = self.do_read_conf(stream.read())
+            self._set_repos(self.do_read_conf(stream.read()))
+        self._signature = signature
 
     def read_conf_from_str(self, content):
 
-        self.repos = self.do_read_conf(content)
+        self._set_repos(self.do_read_conf(content))
+
+    def reload(self, force=False):
+        """Reload the configuration file if it changed (or if force is set). Returns True if reloaded
+
+        The new configuration is fully loaded and validated before replacing the current one, which stays in use meanwhile
+        On error, the current configuration is kept, and the file is not read again until it changes
+        """
+
+        with self._lock:
+            signature = self._get_signature(self.config_file)
+            if signature == self._signature and not force:
+                return False
+
+            try:
+                with open(self.config_file, 'r') as stream:
+                    repos = self.do_read_conf(stream.read())
+            finally:
+                self._signature = signature
+
+            self._set_repos(repos)
+
+        current_app.logger.info("Reloaded repositories from %s: %s" % (self.config_file, ", ".join(repos)))
+        return True
+
+    def _get_signature(self, path):
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
 
     def do_read_conf(self, content):
 
-        repos = {}
         repos_conf = yaml.safe_load(content)
         if not repos_conf:
             raise ValueError("Malformed repository definition '%s'" % content)
 
+        paths = {}
         for repo in repos_conf:
             # We use realpath instead of abspath to resolve symlinks and be sure the user is not doing strange things
             repo_abs = os.path.realpath(repo)
             if not os.path.exists(repo_abs):
                 current_app.logger.warning("Directory '%s' does not exist, creating it" % repo_abs)
                 os.makedirs(repo_abs)
-            if repo_abs in repos:
+            if repo_abs in paths:
                 raise ValueError('Could not load duplicate repository for path "%s"' % repo_abs)
+            paths[repo_abs] = repo
 
-            for known in repos:
-                if self._is_subdir_of(repo_abs, known):
-                    raise ValueError('Could not load repository for path "%s", conflicting with "%s"' % (repo_abs, known))
+        # Once sorted (with a trailing slash), a path is directly followed by its subdirectories, if any
+        sorted_paths = sorted(paths, key=lambda path: os.path.join(path, ""))
+        for known, repo_abs in zip(sorted_paths, sorted_paths[1:]):
+            if self._is_subdir_of(repo_abs, known):
+                raise ValueError('Could not load repository for path "%s", conflicting with "%s"' % (repo_abs, known))
 
+        repos = {}
+        for repo_abs, repo in paths.items():
             repos[repo_abs] = Repo(repo_abs, repos_conf[repo])
 
         return repos
 
+    def publish_files(self, files, user_data, email=None, contact=None, tags=set()):
+        """Register several files in one transaction, and publish them with a celery chord
+
+        files is a list of (repo, path, size). Returns the list of file ids
+        Once all files are processed, a single summary email is sent to email (if set)
+        """
+
+        username = user_data["username"]
+        tag_ids = [tag.id for tag in get_or_create_tags(tags)]
+
+        rows = []
+        for repo, file_path, size in files:
+            rows.append({
+                "id": uuid.uuid4(),
+                "file_name": os.path.basename(file_path),
+                "repo_path": repo.local_path,
+                "version": 1,
+                "owner": username,
+                "size": size,
+                "contact": contact
+            })
+
+        # Bulk inserts (executemany) instead of one ORM object per file
+        db.session.execute(insert(PublishedFile), rows)
+        if tag_ids:
+            db.session.execute(insert(junction_table), [{"file_id": row["id"], "tag_id": tag_id} for row in rows for tag_id in tag_ids])
+            update_tag_counts(tag_ids, len(rows))
+
+        header = [current_app.celery.signature("publish_bulk_item", args=(str(row["id"]), file_path)) for row, (repo, file_path, size) in zip(rows, files)]
+        summary = current_app.celery.signature("publish_bulk_summary", args=(email,))
+        apply_on_commit("publish_bulk (%s files)" % len(rows), chord(header, summary, app=current_app.celery))
+        db.session.commit()
+
+        return [row["id"] for row in rows]
+
+    def _set_repos(self, repos):
+
+        # Single assignment: concurrent lookups see either the old or the new configuration
+        self._state = (repos, self._build_index(repos))
+
+    def _build_index(self, repos):
+        # Trie of path components, the repository being stored under the None key
+        index = {}
+        for local_path, repo in repos.items():
+            node = index
+            for part in local_path.split("/"):
+                node = node.setdefault(part, {})
+            node[None] = repo
+        return index
+
     def _is_subdir_of(self, path1, path2):
 
         path1 = os.path.join(path1, "")
@@ -215,10 +330,64 @@ class Repos():
 
     def get_repo(self, path):
 
-        path = os.path.join(path, "")
-
-        for repo in self.repos:
-            if self.repos[repo].is_in_repo(path):
-                return self.repos[repo]
-
-        return False
+        repos, index = self._state
+
+        # Paths coming from the database (PublishedFile.repo_path) are repository roots
+        repo = repos.get(path)
+        if repo:
+            return repo
+
+        # Longest matching prefix, one path component at a time
+        repo = False
+        node = index
+        for part in path.split("/"):
+            node = node.get(part)
+            if node is None:
+                break
+            repo = node.get(None, repo)
+
+        return repo
+
+
+class ReposWatcher():
+    """Poll the repositories configuration file from a background thread, and reload it when it changes
+
+    Processes forked after start() (ie uwsgi workers) need to call ensure_started() to get their own thread
+    on_reload is called (in the app context) after each successful reload
+    """
+
+    def __init__(self, app, interval=10, on_reload=None):
+
+        self.app = app
+        self.interval = interval
+        self.on_reload = on_reload
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        # Threads do not survive a fork
+        if self._pid == os.getpid() or not self.interval:
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._run, name="gopublish-repos-watcher", daemon=True)
+            thread.start()
+
+    def check(self, force=False):
+        with self.app.app_context():
+            try:
+                reloaded = self.app.repos.reload(force=force)
+            except Exception as err:
+                self.app.logger.error("Could not reload repositories from %s, keeping the current configuration: %s" % (self.app.repos.config_file, err))
+                return False
+            if reloaded and self.on_reload:
+                self.on_reload(self.app)
+            return reloaded
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.check()
@@ -0,0 +1,160 @@
+from flask import current_app
+
+from gopublish.db_models import PublishedFile, Tag, TagCount, junction_table
+from gopublish.extensions import db
+
+from sqlalchemy import and_, case, delete, desc, exists, func, insert, select, true
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+
+def get_tag_counts(limit=None, prefix=None):
+    """Count non-unpublished files for each tag, most used first
+
+    Read from the tag_count table if TAG_COUNT_CACHE is set, else aggregated from file_tag
+    """
+
+    if current_app.config.get("TAG_COUNT_CACHE"):
+        count = func.coalesce(func.sum(TagCount.count), 0)
+        tags = db.session.query(Tag.tag, count).outerjoin(TagCount, TagCount.tag_id == Tag.id)
+    else:
+        count = func.count(PublishedFile.id)
+        tags = db.session.query(Tag.tag, count) \
+            .outerjoin(junction_table, junction_table.c.tag_id == Tag.id) \
+            .outerjoin(PublishedFile, and_(PublishedFile.id == junction_table.c.file_id, PublishedFile.status != "unpublished"))
+
+    if prefix:
+        tags = tags.filter(Tag.tag.startswith(prefix.strip().lower(), autoescape=True))
+
+    tags = tags.group_by(Tag.tag).order_by(desc(count), Tag.tag)
+
+    if limit:
+        tags = tags.limit(limit)
+
+    return [{"tag": tag, "count": count} for tag, count in tags]
+
+
+def get_or_create_tags(tag_names):
+    """Get the Tag entities for tag_names, creating the missing ones in the current transaction (one query)"""
+
+    tag_names = set(tag_names)
+    if not tag_names:
+        return []
+
+    tags = Tag.query.filter(Tag.tag.in_(tag_names)).all()
+    missing = tag_names - set(tag.tag for tag in tags)
+    if missing:
+        new_tags = [Tag(tag=tag_name) for tag_name in sorted(missing)]
+        db.session.add_all(new_tags)
+        db.session.flush()
+        tags += new_tags
+
+    return tags
+
+
+def add_file_tags(filters, tag_ids):
+    """Add tag_ids to all the files matching filters, in the current transaction (set-based, whatever the number of files)
+
+    Returns the number of newly tagged files for each tag id
+    """
+
+    tag_ids = list(set(tag_ids))
+    if not tag_ids:
+        return {}
+
+    matching = _matching_files(filters)
+    pairs = select(matching.c.id, Tag.id).select_from(matching.join(Tag, true())).where(Tag.id.in_(tag_ids))
+    is_tagged = exists().where(junction_table.c.file_id == matching.c.id, junction_table.c.tag_id == Tag.id)
+
+    counts = _count_by_tag(Tag.id, matching.join(Tag, true()), matching, Tag.id.in_(tag_ids), ~is_tagged)
+
+    if db.session.get_bind().dialect.name == "postgresql":
+        stmt = pg_insert(junction_table).from_select(["file_id", "tag_id"], pairs).on_conflict_do_nothing()
+    else:
+        stmt = insert(junction_table).from_select(["file_id", "tag_id"], pairs.where(~is_tagged))
+    db.session.execute(stmt)
+
+    return _apply_counts(counts, 1)
+
+
+def remove_file_tags(filters, tag_ids):
+    """Remove tag_ids from all the files matching filters, in the current transaction
+
+    Tags left without any file are deleted. Returns the number of untagged files for each tag id
+    """
+
+    tag_ids = list(set(tag_ids))
+    if not tag_ids:
+        return {}
+
+    matching = _matching_files(filters)
+    counts = _count_by_tag(junction_table.c.tag_id, junction_table.join(matching, matching.c.id == junction_table.c.file_id), matching, junction_table.c.tag_id.in_(tag_ids))
+
+    db.session.execute(delete(junction_table).where(junction_table.c.tag_id.in_(tag_ids), junction_table.c.file_id.in_(select(matching.c.id))))
+    # Counters first: the counters of deleted tags are deleted with them
+    removed = _apply_counts(counts, -1)
+    delete_orphan_tags(tag_ids)
+
+    return removed
+
+
+def delete_orphan_tags(tag_ids):
+    """Delete the tags (among tag_ids) without any file, in one statement"""
+
+    db.session.execute(delete(Tag.__table__).where(Tag.id.in_(tag_ids), ~exists().where(junction_table.c.tag_id == Tag.id)))
+
+
+def _matching_files(filters):
+    return select(PublishedFile.id, PublishedFile.status).where(*filters).subquery()
+
+
+def _count_by_tag(tag_column, from_clause, matching, *where):
+    # {tag_id: (files, non-unpublished files)}
+    published = func.count(case((matching.c.status != "unpublished", 1)))
+    counts = select(tag_column, func.count(), published).select_from(from_clause).where(*where).group_by(tag_column)
+    return {tag_id: (count, published_count) for tag_id, count, published_count in db.session.execute(counts)}
+
+
+def _apply_counts(counts, sign):
+    # One counter update per distinct value
+    deltas = {}
+    for tag_id, (count, published_count) in counts.items():
+        if published_count:
+            deltas.setdefault(sign * published_count, []).append(tag_id)
+    for delta, tag_ids in deltas.items():
+        update_tag_counts(tag_ids, delta)
+
+    return {tag_id: count for tag_id, (count, published_count) in counts.items()}
+
+
+def update_tag_counts(tag_ids, delta):
+    """Add delta to the counters of tag_ids, in the current transaction
+
+    Must be called whenever a non-unpublished file gains or loses tags, or is (un)published
+    """
+
+    tag_ids = list(set(tag_ids))
+    if not tag_ids:
+        return
+
+    if db.session.get_bind().dialect.name == "postgresql":
+        stmt = pg_insert(TagCount.__table__).values([{"tag_id": tag_id, "count": delta} for tag_id in tag_ids])
+        stmt = stmt.on_conflict_do_update(index_elements=["tag_id"], set_={"count": TagCount.__table__.c.count + stmt.excluded.count})
+        db.session.execute(stmt)
+        return
+
+    for tag_id in tag_ids:
+        updated = TagCount.query.filter_by(tag_id=tag_id).update({TagCount.count: TagCount.count + delta}, synchronize_session=False)
+        if not updated:
+            db.session.add(TagCount(tag_id=tag_id, count=delta))
+
+
+def rebuild_tag_counts():
+    """Recompute every counter from file_tag (ie before enabling TAG_COUNT_CACHE on an existing database)"""
+
+    TagCount.query.delete(synchronize_session=False)
+    counts = db.session.query(junction_table.c.tag_id, func.count()) \
+        .join(PublishedFile, PublishedFile.id == junction_table.c.file_id) \
+        .filter(PublishedFile.status != "unpublished") \
+        .group_by(junction_table.c.tag_id)
+    db.session.add_all([TagCount(tag_id=tag_id, count=count) for tag_id, count in counts])
+    db.session.commit()
@@ -0,0 +1,80 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from gopublish.db_models import PublishMetrics
+from gopublish.extensions import db
+
+from sqlalchemy import Float, func, type_coerce
+from sqlalchemy.dialects.postgresql import ARRAY, array
+
+# Columns of publish_metrics aggregated in percentiles
+TIMINGS = ["queue_seconds", "transfer_seconds", "hash_seconds", "chmod_seconds", "notification_seconds", "total_seconds", "bytes_per_second"]
+
+PERCENTILES = [0.5, 0.9, 0.99]
+
+
+def publish_percentiles(repo_path=None, days=None):
+    """Aggregate the publish timings by repository and publish method
+
+    Returns {repo_path: {method: {"files", "bytes", <timing>: {"p50", "p90", "p99"}}}}
+    Percentiles are null when no file has a value (ie no notification sent)
+    Computed by postgresql (percentile_cont), or in python on other backends
+    """
+
+    filters = []
+    if repo_path:
+        filters.append(PublishMetrics.repo_path == repo_path)
+    if days:
+        filters.append(PublishMetrics.published >= datetime.utcnow() - timedelta(days=days))
+
+    if db.session.get_bind().dialect.name == "postgresql":
+        rows = _pg_percentiles(filters)
+    else:
+        rows = _python_percentiles(filters)
+
+    repos = defaultdict(dict)
+    for repo, method, files, size, percentiles in rows:
+        stats = {"files": files, "bytes": int(size or 0)}
+        for timing, values in zip(TIMINGS, percentiles):
+            stats[timing] = {_label(percentile): value for percentile, value in zip(PERCENTILES, values or [None] * len(PERCENTILES))}
+        repos[repo][method] = stats
+    return dict(repos)
+
+
+def _pg_percentiles(filters):
+    # percentile_cont(ARRAY[...]) returns an array of percentiles
+    columns = [type_coerce(func.percentile_cont(array(PERCENTILES)).within_group(getattr(PublishMetrics, timing)), ARRAY(Float)) for timing in TIMINGS]
+    query = db.session.query(PublishMetrics.repo_path, PublishMetrics.method, func.count(), func.sum(PublishMetrics.size), *columns) \
+        .filter(*filters) \
+        .group_by(PublishMetrics.repo_path, PublishMetrics.method)
+    return [(row[0], row[1], row[2], row[3], row[4:]) for row in query]
+
+
+def _python_percentiles(filters):
+    columns = [getattr(PublishMetrics, timing) for timing in TIMINGS]
+    query = db.session.query(PublishMetrics.repo_path, PublishMetrics.method, PublishMetrics.size, *columns).filter(*filters)
+
+    groups = defaultdict(list)
+    for row in query:
+        groups[(row[0], row[1])].append(row[2:])
+
+    rows = []
+    for (repo, method), values in groups.items():
+        percentiles = []
+        for index in range(len(TIMINGS)):
+            timings = sorted(value[index + 1] for value in values if value[index + 1] is not None)
+            percentiles.append([_percentile(timings, percentile) for percentile in PERCENTILES] if timings else None)
+        rows.append((repo, method, len(values), sum(value[0] for value in values), percentiles))
+    return rows
+
+
+def _percentile(values, percentile):
+    # Linear interpolation between the closest ranks, as percentile_cont
+    position = (len(values) - 1) * percentile
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def _label(percentile):
+    return "p%s" % ("%g" % (percentile * 100)).replace(".", "_")
@@ -0,0 +1,115 @@
+import threading
+import time
+
+from flask import current_app
+
+import redis
+
+
+class WorkerTracker():
+    """Celery worker liveness, without broadcasting to the workers on each request
+
+    Each worker refreshes its heartbeat in a redis sorted set (hostname scored by timestamp) if redis_url is set.
+    Heartbeats older than ttl are considered dead.
+    Without redis (or if redis fails), falls back to control.inspect().ping()
+    snapshot() is served from a per-process copy, refreshed at most every cache_ttl seconds
+    """
+
+    REDIS_KEY = "gopublish:workers"
+
+    def __init__(self, redis_url=None, ttl=30, cache_ttl=5):
+
+        self.redis = None
+        if redis_url:
+            self.redis = redis.Redis.from_url(redis_url)
+
+        self.ttl = ttl
+        self.cache_ttl = cache_ttl
+
+        self._snapshot = None
+        self._snapshot_time = 0
+        self._lock = threading.Lock()
+
+    def beat(self, hostname):
+        """Record a heartbeat for a worker (called from the worker)"""
+
+        if self.redis:
+            self.redis.zadd(self.REDIS_KEY, {hostname: time.time()})
+
+    def remove(self, hostname):
+        if self.redis:
+            self.redis.zrem(self.REDIS_KEY, hostname)
+
+    def snapshot(self, celery):
+        """Get {"available", "workers", "checked"}, "checked" being the timestamp of the last actual check"""
+
+        with self._lock:
+            if self._snapshot and time.monotonic() - self._snapshot_time < self.cache_ttl:
+                return self._snapshot
+
+        workers = None
+        if self.redis:
+            workers = self._read_heartbeats()
+        if workers is None:
+            workers = self._ping(celery)
+
+        snapshot = {"available": bool(workers), "workers": workers, "checked": time.time()}
+        with self._lock:
+            self._snapshot = snapshot
+            self._snapshot_time = time.monotonic()
+
+        return snapshot
+
+    def is_available(self, celery):
+        return self.snapshot(celery)["available"]
+
+    def _read_heartbeats(self):
+        oldest = time.time() - self.ttl
+        try:
+            pipe = self.redis.pipeline()
+            pipe.zremrangebyscore(self.REDIS_KEY, "-inf", oldest)
+            pipe.zrangebyscore(self.REDIS_KEY, oldest, "+inf")
+            workers = pipe.execute()[1]
+        except redis.RedisError as err:
+            current_app.logger.warning("Could not get worker heartbeats from redis, pinging workers: %s", err)
+            return None
+        return sorted(worker.decode() for worker in workers)
+
+    def _ping(self, celery):
+        availability = celery.control.inspect().ping()
+        if not availability:
+            return []
+        return sorted(availability.keys())
+
+
+class WorkerHeartbeat():
+    """Thread refreshing the heartbeat of a worker every ttl / 3 seconds"""
+
+    def __init__(self, tracker, hostname, logger):
+
+        self.tracker = tracker
+        self.hostname = hostname
+        self.logger = logger
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="gopublish-heartbeat", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+        try:
+            self.tracker.remove(self.hostname)
+        except redis.RedisError:
+            pass
+
+    def _run(self):
+        interval = max(self.tracker.ttl / 3, 1)
+        while True:
+            try:
+                self.tracker.beat(self.hostname)
+            except redis.RedisError as err:
+                self.logger.warning("Could not send worker heartbeat to redis: %s", err)
+            if self._stop.wait(interval):
+                return
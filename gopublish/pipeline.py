@@ -0,0 +1,145 @@
+import errno
+import hashlib
+import mmap
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Size of the buffers used to copy and hash files
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Digests computed for each published file. md5 is also stored in PublishedFile.hash
+DIGESTS = ["md5", "sha256", "blake2b"]
+
+
+class MultiHasher():
+    """Feed the same chunks to several hashlib objects, with one thread per digest
+
+    hashlib releases the GIL when updating with large chunks, so the digests are computed in parallel
+    update() returns immediately: the chunk must not be modified until the next update() or hexdigests()
+    memoryview chunks are released once hashed
+    waited is the time spent waiting for the hashing threads (ie how much the hashing slowed the reads down)
+    """
+
+    def __init__(self, algorithms=DIGESTS):
+
+        self.hashes = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+        self._executor = ThreadPoolExecutor(max_workers=len(self.hashes), thread_name_prefix="hasher")
+        self._pending = []
+        self._chunk = None
+        self.waited = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._executor.shutdown()
+
+    def update(self, chunk):
+        # Chunks must be hashed in order: wait for the previous one
+        self.wait()
+        self._chunk = chunk
+        self._pending = [self._executor.submit(hash.update, chunk) for hash in self.hashes.values()]
+
+    def wait(self):
+        if self._pending:
+            start = time.monotonic()
+            for future in self._pending:
+                future.result()
+            self.waited += time.monotonic() - start
+        self._pending = []
+        # The worker threads may still reference the chunk: release it so the buffer (or mmap) can be reused or closed
+        if isinstance(self._chunk, memoryview):
+            self._chunk.release()
+        self._chunk = None
+
+    def hexdigests(self):
+        self.wait()
+        return {algorithm: hash.hexdigest() for algorithm, hash in self.hashes.items()}
+
+
+def copy_and_hash(src, dst, chunk_size=CHUNK_SIZE, algorithms=DIGESTS):
+    """Copy src to dst and compute its digests in a single read
+
+    Two buffers are allocated and reused: the next chunk is read while the previous one is hashed
+    Returns {"digests", "size", "seconds", "method", "transfer_seconds", "hash_seconds"}
+    hash_seconds is the time the copy waited for the hashing
+    """
+
+    start = time.monotonic()
+    size = 0
+
+    views = [memoryview(bytearray(chunk_size)), memoryview(bytearray(chunk_size))]
+    current = 0
+    with MultiHasher(algorithms) as hasher, open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        while True:
+            read = fsrc.readinto(views[current])
+            if not read:
+                break
+            chunk = views[current][:read]
+            hasher.update(chunk)
+            fdst.write(chunk)
+            size += read
+            current = 1 - current
+        digests = hasher.hexdigests()
+
+    seconds = time.monotonic() - start
+    return {"digests": digests, "size": size, "seconds": seconds, "method": "copy", "transfer_seconds": seconds, "hash_seconds": hasher.waited}
+
+
+def move_and_hash(src, dst, chunk_size=CHUNK_SIZE, algorithms=DIGESTS):
+    """Move src to dst and compute its digests
+
+    A rename on the same filesystem does not read the data: the file is then hashed with mmap
+    Across filesystems, the file is copied and hashed in a single read, then removed
+    """
+
+    start = time.monotonic()
+    try:
+        os.rename(src, dst)
+    except OSError as err:
+        if not err.errno == errno.EXDEV:
+            raise
+        result = copy_and_hash(src, dst, chunk_size=chunk_size, algorithms=algorithms)
+        shutil.copystat(src, dst)
+        os.remove(src)
+        result["seconds"] = result["transfer_seconds"] = time.monotonic() - start
+        result["method"] = "move (copy)"
+        return result
+
+    renamed = time.monotonic()
+    result = hash_file(dst, chunk_size=chunk_size, algorithms=algorithms)
+    result["seconds"] = time.monotonic() - start
+    result["transfer_seconds"] = renamed - start
+    result["hash_seconds"] = result["seconds"] - result["transfer_seconds"]
+    result["method"] = "move (rename)"
+    return result
+
+
+def hash_file(path, chunk_size=CHUNK_SIZE, algorithms=DIGESTS):
+    """Compute the digests of a file through mmap (no copy of the data in python)"""
+
+    start = time.monotonic()
+
+    with MultiHasher(algorithms) as hasher, open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, "madvise"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mapped) as view:
+                    for offset in range(0, size, chunk_size):
+                        hasher.update(view[offset:offset + chunk_size])
+                    hasher.wait()
+        digests = hasher.hexdigests()
+
+    return {"digests": digests, "size": size, "seconds": time.monotonic() - start, "method": "hash"}
+
+
+def throughput(result):
+    """Bytes per second of a copy/move/hash result"""
+
+    if not result["seconds"]:
+        return 0
+    return result["size"] / result["seconds"]
@@ -40,7 +40,9 @@ class GopublishNavigation extends Component {
               query: this.state.term,
               tags: this.state.tags,
               pageCount: Math.ceil(response.data.total / this.props.config.perPage),
-              total: response.data.total
+              total: response.data.total,
+              nextCursor: response.data.next_cursor,
+              nextOffset: this.props.config.perPage
             }
           });
         })
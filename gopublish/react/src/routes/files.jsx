@@ -20,6 +20,8 @@ export default class Files extends Component {
       total: 0,
       tags: [],
       selectedTags: [],
+      nextCursor: null,
+      nextOffset: null,
     }
     this.utils = new Utils()
     this.listFiles = this.listFiles.bind(this)
@@ -45,17 +47,25 @@ export default class Files extends Component {
     })
   }
 
-  listFiles(offset=0) {
+  listFiles(offset=0, cursor=null) {
 
     let requestUrl = '/api/list'
-    axios.get(requestUrl, { baseURL: this.props.config.proxyPath, cancelToken: new axios.CancelToken((c) => { this.cancelRequest = c }), params:{offset: offset, limit: this.props.config.perPage, tags: this.state.selectedTags}})
+    // Only count on the first page, the total does not change while browsing
+    let params = {offset: offset, limit: this.props.config.perPage, tags: this.state.selectedTags, count: offset === 0 ? "exact" : "none"}
+    if (cursor) {
+      params.cursor = cursor
+    }
+    axios.get(requestUrl, { baseURL: this.props.config.proxyPath, cancelToken: new axios.CancelToken((c) => { this.cancelRequest = c }), params: params})
       .then(response => {
+        let total = response.data.total === null ? this.state.total : response.data.total
         this.setState({
           isLoading: false,
           files: response.data.files,
-          pageCount: Math.ceil(response.data.total / this.props.config.perPage),
-          total: response.data.total,
-          tags: response.data.tags
+          pageCount: Math.ceil(total / this.props.config.perPage),
+          total: total,
+          tags: response.data.tags,
+          nextCursor: response.data.next_cursor,
+          nextOffset: offset + this.props.config.perPage
         })
       })
       .catch(error => {
@@ -86,7 +96,7 @@ export default class Files extends Component {
         <TagsTable config={this.props.config} tags={this.state.tags} selectedTags={this.state.selectedTags} updateList={this.filterTags}/>
 	</Col>
 	<Col xs="10">
-        <FilesTable config={this.props.config} files={this.state.files} total={this.state.total} getData={this.listFiles} pageCount={this.state.pageCount}/>
+        <FilesTable config={this.props.config} files={this.state.files} total={this.state.total} getData={this.listFiles} pageCount={this.state.pageCount} nextCursor={this.state.nextCursor} nextOffset={this.state.nextOffset}/>
 	</Col>
 	</Row>
         </div>
@@ -18,7 +18,9 @@ export default class FilesTable extends Component {
   handlePageClick(data) {
     let selected = data.selected;
     let offset = Math.ceil(selected * this.props.config.perPage);
-    this.props.getData(offset);
+    // Going to the next page: use the keyset cursor, which costs the same at any depth
+    let cursor = offset === this.props.nextOffset ? this.props.nextCursor : null;
+    this.props.getData(offset, cursor);
   };
 
   render () {
@@ -109,5 +111,7 @@ FilesTable.propTypes = {
   files: PropTypes.array,
   total: PropTypes.number,
   pageCount: PropTypes.number,
+  nextCursor: PropTypes.string,
+  nextOffset: PropTypes.number,
   getData: PropTypes.func
 }
@@ -22,6 +22,8 @@ class Search extends Component {
       offset: 0,
       total: 0,
       pageCount: 1,
+      nextCursor: null,
+      nextOffset: null,
       query: ""
     }
     this.utils = new Utils()
@@ -35,7 +37,9 @@ class Search extends Component {
         tags: this.props.location.state.tags,
         query: this.props.location.state.query,
         total: this.props.location.state.total,
-        pageCount: this.props.location.state.pageCount
+        pageCount: this.props.location.state.pageCount,
+        nextCursor: this.props.location.state.nextCursor,
+        nextOffset: this.props.location.state.nextOffset
     }, () => {console.log(this.state)})
   }
 
@@ -48,6 +52,8 @@ class Search extends Component {
         query: this.props.location.state.query,
         total: this.props.location.state.total,
         pageCount: this.props.location.state.pageCount,
+        nextCursor: this.props.location.state.nextCursor,
+        nextOffset: this.props.location.state.nextOffset,
       }, () => {console.log(this.state)})
     }
   }
@@ -67,15 +73,23 @@ class Search extends Component {
     })
   }
 
-  search(offset=0) {
+  search(offset=0, cursor=null) {
     let url = '/api/search?file=' + encodeURI(this.state.query);
-    axios.get(url, { baseURL: this.props.config.proxyPath, cancelToken: new axios.CancelToken((c) => { this.cancelRequest = c }), params: {offset: offset, limit: this.props.config.perPage, tags: this.state.selectedTags}})
+    // Only count on the first page, the total does not change while browsing
+    let params = {offset: offset, limit: this.props.config.perPage, tags: this.state.selectedTags, count: offset === 0 ? "exact" : "none"}
+    if (cursor) {
+      params.cursor = cursor
+    }
+    axios.get(url, { baseURL: this.props.config.proxyPath, cancelToken: new axios.CancelToken((c) => { this.cancelRequest = c }), params: params})
       .then(response => {
+        let total = response.data.total === null ? this.state.total : response.data.total
         let data = {
           files: response.data.files,
-          pageCount: Math.ceil(response.data.total / this.props.config.perPage),
+          pageCount: Math.ceil(total / this.props.config.perPage),
           tags: response.data.tags,
-          total: response.data.total
+          total: total,
+          nextCursor: response.data.next_cursor,
+          nextOffset: offset + this.props.config.perPage
         };
         this.setState(data);
       })
@@ -90,7 +104,7 @@ class Search extends Component {
             <TagsTable config={this.props.config} tags={this.state.tags} selectedTags={this.state.selectedTags} updateList={this.filterTags}/>
     	</Col>
     	<Col xs="10">
-            <FilesTable config={this.props.config} files={this.state.files} total={this.state.total} getData={this.search}  pageCount={this.state.pageCount}  />
+            <FilesTable config={this.props.config} files={this.state.files} total={this.state.total} getData={this.search}  pageCount={this.state.pageCount} nextCursor={this.state.nextCursor} nextOffset={this.state.nextOffset} />
         </Col>
         </Row>
         </div>
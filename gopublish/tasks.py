@@ -1,16 +1,20 @@
-import hashlib
 import os
 import shutil
 import time
+from datetime import datetime
 
-from celery.signals import task_postrun
-
-from flask_mail import Message
+from celery.signals import task_postrun, task_prerun, worker_process_shutdown, worker_ready, worker_shutdown
+from celery.worker.control import control_command
 
 from gopublish.app import create_app, create_celery
-from gopublish.db_models import PublishedFile
+from gopublish.db_models import FileDigest, PublishedFile, PublishMetrics
 from gopublish.extensions import db
-from gopublish.extensions import mail
+from gopublish.metrics import PUBLISHED_BYTES, mark_process_dead, start_worker_server, task_finished, task_started
+from gopublish.model.files import reconcile_statuses
+from gopublish.model.mails import send_notifications
+from gopublish.model.workers import WorkerHeartbeat
+from gopublish.pipeline import copy_and_hash, move_and_hash, throughput
+from gopublish.utils import human_readable_size
 
 import requests
 
@@ -34,11 +38,7 @@ Your publishing request on file '{path}' failed, with the following error:
 Contact the administrator for more info.
 Cheers
 """
-        msg = Message(subject="Gopublish: Publishing task on {path} failed".format(path=args[1]),
-                      body=body.format(path=args[1], error=str(exc)),
-                      sender=app.config.get('MAIL_SENDER', 'from@example.com'),
-                      recipients=args[2])
-        mail.send(msg)
+        app.mail_queue.push(celery, args[2], "Gopublish: Publishing task on {path} failed".format(path=args[1]), body.format(path=args[1], error=str(exc)))
 
     p_file.status = 'failed'
     db.session.commit()
@@ -49,10 +49,67 @@ def publish_file(self, file_id, old_path, email=""):
     # Send task to copy file
     # (Copy file, create symlink)
 
-    # Wait a bit in case the tasks begin just before it is recorded in the db
-    time.sleep(2)
+    p_file = _publish(self, file_id, old_path)
+
+    if email:
+        start = time.monotonic()
+        body = """Hello,
+Your publishing request on file '{path}' succeded.
+Your file should be available here : {file_url}
+Cheers
+"""
+        app.mail_queue.push(celery, email, "Gopublish: Publishing task on {path} succeded".format(path=old_path), body.format(path=old_path, file_url="%s/data/%s" % (app.config.get("BASE_URL"), p_file.id)))
+        p_file.publish_metrics.notification_seconds = time.monotonic() - start
+        db.session.commit()
+
+
+@celery.task(bind=True, name="publish_bulk_item")
+def publish_bulk_item(self, file_id, old_path):
+    # Part of a bulk publish chord: errors are returned instead of raised, so that the summary is always sent
+    try:
+        _publish(self, file_id, old_path)
+    except Exception as exc:
+        app.logger.warning("Task %s failed. Exception raised: %s" % (self.request.id, str(exc)))
+        db.session.rollback()
+        p_file = PublishedFile.query.filter_by(id=file_id).one()
+        p_file.error = str(exc)
+        p_file.status = 'failed'
+        db.session.commit()
+        return {"file_id": str(file_id), "path": old_path, "error": str(exc)}
+
+    return {"file_id": str(file_id), "path": old_path, "error": None}
+
+
+@celery.task(bind=True, name="publish_bulk_summary")
+def publish_bulk_summary(self, results, email=None):
+    # Chord callback of a bulk publish: one email for all the files
+    failed = [result for result in results if result["error"]]
+    app.logger.info("Bulk publish: %s files published, %s failed" % (len(results) - len(failed), len(failed)))
+
+    if email:
+        lines = []
+        for result in results:
+            if result["error"]:
+                lines.append("- {path}: failed ({error})".format(path=result["path"], error=result["error"]))
+            else:
+                lines.append("- {path}: {file_url}".format(path=result["path"], file_url="%s/data/%s" % (app.config.get("BASE_URL"), result["file_id"])))
+
+        body = """Hello,
+Your bulk publishing request is over: {published} files published, {failed} failed.
+{files}
+Cheers
+"""
+        app.mail_queue.push(celery, email, "Gopublish: Bulk publishing task on {count} files over".format(count=len(results)), body.format(published=len(results) - len(failed), failed=len(failed), files="\n".join(lines)))
+
+    return {"published": len(results) - len(failed), "failed": len(failed)}
+
+
+def _publish(task, file_id, old_path):
+    start = time.monotonic()
     p_file = PublishedFile.query.filter_by(id=file_id).one()
-    p_file.task_id = self.request.id
+    # publishing_date is set when the publish request is received
+    queue_seconds = max((datetime.utcnow() - p_file.publishing_date).total_seconds(), 0)
+    p_file.task_id = task.request.id
     p_file.status = 'starting'
     db.session.commit()
     # Copy or move?
@@ -60,40 +117,50 @@ def publish_file(self, file_id, old_path, email=""):
 
     new_path = os.path.join(repo.public_folder, str(file_id))
 
+    p_file.status = 'hashing'
+    db.session.commit()
+
+    # The file is hashed (all digests at once) while copied, or after a rename
     if repo.copy_files:
-        shutil.copy(old_path, new_path)
+        result = copy_and_hash(old_path, new_path, chunk_size=app.config["PUBLISH_CHUNK_SIZE"])
+        chmod_start = time.monotonic()
+        shutil.copymode(old_path, new_path)
     else:
-        shutil.move(old_path, new_path)
+        result = move_and_hash(old_path, new_path, chunk_size=app.config["PUBLISH_CHUNK_SIZE"])
+        chmod_start = time.monotonic()
         os.symlink(new_path, old_path)
 
     os.chmod(new_path, 0o0744)
-
-    p_file.status = 'hashing'
-    db.session.commit()
-
-    file_md5 = md5(new_path)
-    p_file.hash = file_md5
+    chmod_seconds = time.monotonic() - chmod_start
+
+    app.logger.info("Published %s (%s): %s in %.2fs with %s (%s/s)" % (old_path, file_id, human_readable_size(result["size"]), result["seconds"], result["method"], human_readable_size(throughput(result))))
+
+    PUBLISHED_BYTES.labels(result["method"]).inc(result["size"])
+
+    p_file.hash = result["digests"]["md5"]
+    p_file.digests = [FileDigest(algorithm=algorithm, digest=digest) for algorithm, digest in result["digests"].items()]
+    p_file.publish_metrics = PublishMetrics(
+        repo_path=p_file.repo_path,
+        method=result["method"],
+        size=result["size"],
+        queue_seconds=queue_seconds,
+        transfer_seconds=result["transfer_seconds"],
+        hash_seconds=result["hash_seconds"],
+        chmod_seconds=chmod_seconds,
+        total_seconds=time.monotonic() - start,
+        bytes_per_second=throughput(result)
+    )
     p_file.status = 'available'
     db.session.commit()
 
-    if email:
-        body = """Hello,
-Your publishing request on file '{path}' succeded.
-Your file should be available here : {file_url}
-Cheers
-"""
-        msg = Message(subject="Gopublish: Publishing task on {path} succeded".format(path=old_path),
-                      body=body.format(path=old_path, file_url="%s/data/%s" % (app.config.get("BASE_URL"), p_file.id)),
-                      sender=app.config.get('MAIL_SENDER', 'from@example.com'),
-                      recipients=email)
-        mail.send(msg)
+    return p_file
 
 
 @celery.task(bind=True, name="pull")
 def pull_file(self, file_id, email=""):
     # Task to pull file from baricadr
     p_file = PublishedFile.query.filter_by(id=file_id).one()
-    p_file.status == "pulling"
+    p_file.status = "pulling"
     db.session.commit()
     repo = app.repos.get_repo(p_file.repo_path)
     path = os.path.join(repo.public_folder, str(p_file.id))
@@ -118,6 +185,48 @@ def delete_file(self, path, delete=False):
             os.chmod(path, 0o0700)
 
 
+@celery.task(bind=True, name="send_mails")
+def send_mails(self, notifications=None):
+    # Runs on the mail queue, so that a slow mail server does not hold the publishing workers
+    # Buffered notifications are taken from redis, unless given (ie without redis, or when retrying)
+    if notifications is None:
+        notifications = app.mail_queue.pop()
+    if not notifications:
+        return 0
+
+    unsent, err = send_notifications(notifications, app.config.get('MAIL_SENDER', 'from@example.com'))
+    if unsent:
+        countdown = app.config.get("MAIL_RETRY_DELAY") * 2 ** self.request.retries
+        app.logger.warning("Could not send %s notifications, retrying in %s seconds: %s" % (len(unsent), countdown, err))
+        raise self.retry(args=(unsent,), exc=err, countdown=countdown, max_retries=app.config.get("MAIL_MAX_RETRIES"))
+
+    return len(notifications)
+
+
+@celery.task(bind=True, name="flush_downloads")
+def flush_downloads(self):
+    # Write buffered download counts to the database
+    updated = app.download_counter.flush()
+    if updated:
+        app.logger.info("Flushed download counts of %s files" % updated)
+
+
+celery.add_periodic_task(app.config.get("DOWNLOAD_FLUSH_INTERVAL"), flush_downloads.s(), name="flush_downloads")
+
+
+@celery.task(bind=True, name="reconcile_statuses")
+def reconcile_file_statuses(self):
+    # Update the status of published files from the content of the public folders (instead of checking on each view)
+    for repo in app.repos.repos.values():
+        updated = reconcile_statuses(repo)
+        if updated:
+            app.logger.info("Updated the status of %s files in %s" % (updated, repo.local_path))
+
+
+if app.config.get("STATUS_RECONCILE_INTERVAL"):
+    celery.add_periodic_task(app.config.get("STATUS_RECONCILE_INTERVAL"), reconcile_file_statuses.s(), name="reconcile_statuses")
+
+
 @task_postrun.connect
 def close_session(*args, **kwargs):
     # Flask SQLAlchemy will automatically create new sessions for you from
@@ -127,6 +236,59 @@ def close_session(*args, **kwargs):
     db.session.remove()
 
 
+heartbeat = None
+
+
+@worker_ready.connect
+def start_heartbeat(sender=None, **kwargs):
+    # Let the web app know this worker is alive, without broadcasting ping requests
+    global heartbeat
+    if app.worker_tracker.redis:
+        heartbeat = WorkerHeartbeat(app.worker_tracker, sender.hostname, app.logger)
+        heartbeat.start()
+
+
+@worker_shutdown.connect
+def stop_heartbeat(*args, **kwargs):
+    if heartbeat:
+        heartbeat.stop()
+
+
+@worker_ready.connect
+def start_metrics(*args, **kwargs):
+    if app.config.get("METRICS_WORKER_PORT"):
+        start_worker_server(int(app.config.get("METRICS_WORKER_PORT")))
+
+
+# Pool processes exit without running the atexit hooks
+worker_process_shutdown.connect(mark_process_dead)
+
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    task_started(task_id)
+
+
+@task_postrun.connect
+def record_task(task_id=None, task=None, state=None, **kwargs):
+    task_finished(task_id, task.name, state)
+
+
+@control_command(args=[('force', bool)], signature='[force]')
+def reload_repos(state, force=False):
+    # Broadcasted by the web processes when the repositories configuration changed
+    # Runs in the main worker process: prefork children check the file themselves before each task
+    return {"ok": "reloaded" if app.repos_watcher.check(force=force) else "unchanged"}
+
+
+@task_prerun.connect
+def check_repos(*args, **kwargs):
+    # Only a stat of the file, unless it changed
+    if not app.config.get("REPOS_RELOAD_INTERVAL"):
+        return
+    app.repos_watcher.check()
+
+
 def pull_from_baricadr(file_path, email=""):
     url = "%s/pull" % app.config.get("BARICADR_URL")
     data = {"path": file_path}
@@ -134,11 +296,3 @@ def pull_from_baricadr(file_path, email=""):
         data['email'] = email
     requests.post(url, auth=(app.config.get("BARICADR_USER"), app.config.get("BARICADR_PASSWORD")), json=data)
     # How do we manage failure? Mail admin?
-
-
-def md5(fname):
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(8192), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
@@ -1,19 +1,19 @@
+import base64
+import binascii
+import hashlib
+import time
+from datetime import datetime
 from uuid import UUID
 
 import jwt
 
-from ldap3 import Connection, NONE, Server
 
-
-def get_celery_worker_status(app):
-    i = app.control.inspect()
-    availability = i.ping()
-    # stats = i.stats()
-    result = {
-        'availability': availability,
-        # 'stats': stats,
-    }
-    return result
+def broadcast_repos_reload(app, force=False):
+    # Handled by the 'reload_repos' control command in gopublish/tasks.py
+    try:
+        app.celery.control.broadcast("reload_repos", arguments={"force": force})
+    except Exception as err:
+        app.logger.error("Could not notify the workers of the repositories reload: %s" % err)
 
 
 def get_celery_tasks(app):
@@ -64,56 +64,61 @@ def is_valid_uuid(uuid_to_test, version=4):
     return str(uuid_obj) == uuid_to_test
 
 
-def authenticate_user(username, password, api_key, config):
+def authenticate_user(username, password, api_key, config, ldap_client):
     if api_key and api_key in config.get("ADMIN_API_KEYS"):
         return True
 
-    server = Server(config.get("LDAP_HOST"), config.get("LDAP_PORT", 389), get_info=NONE)
-    conn = Connection(server, auto_bind=True)
-    user = conn.search(config.get("LDAP_BASE_QUERY"), '(uid=%s)' % username, attributes=['uidNumber'], size_limit=1, time_limit=10)
-    if not user:
-        return False
-    full_dn = conn.entries[0].entry_dn
-    # Check password
-    logged_in = conn.rebind(user=full_dn, password=password)
-    conn.unbind()
-    return logged_in
+    return ldap_client.authenticate(username, password)
+
 
+def validate_token(token, config, cache=None):
+    # Verified tokens are cached (by digest) until they expire
+    key = None
+    if cache is not None:
+        key = hashlib.sha256(token.encode()).hexdigest()
+        user_data = cache.get(key)
+        if user_data:
+            return user_data
 
-def validate_token(token, config):
     try:
         payload = jwt.decode(token, config['SECRET_KEY'], algorithms=["HS256"])
     except jwt.exceptions.ExpiredSignatureError:
         return {"valid": False, "error": "Expired token"}
     except jwt.exceptions.InvalidTokenError:
         return {"valid": False, "error": "Invalid token"}
-    return {"valid": True, "username": payload['username'], "is_admin": payload['username'] in config.get('ADMIN_USERS')}
-
-
-def get_user_ldap_data(username, config):
-    data = {"user_id": None, "user_group_names": [], "user_group_ids": [], "error": None}
-    server = Server(config.get("LDAP_HOST"), config.get("LDAP_PORT", 389), get_info=NONE)
-    conn = Connection(server, auto_bind=True)
-    # Basic query to see if it works
-    user = conn.search(config.get("LDAP_BASE_QUERY"), '(uid=%s)' % username, attributes=['uidNumber'], size_limit=1, time_limit=10)
-    if not user:
-        data['error'] = "Could not find user %s in LDAP" % username
-        return data
-    data['user_id'] = conn.entries[0]['uidNumber'].values[0]
-    conn.search(config.get("LDAP_BASE_QUERY"), '(memberuid=%s)' % username, attributes=['gidNumber', 'cn'], time_limit=10)
-    for group in conn.entries:
-        data['user_group_names'].append(group['cn'][0])
-        data['user_group_ids'].append(group['gidNumber'][0])
-
-    conn.unbind()
-    return data
-
-
-def get_or_create(session, model, **kwargs):
-    instance = session.query(model).filter_by(**kwargs).first()
-    if instance:
-        return instance
-    else:
-        instance = model(**kwargs)
-        session.add(instance)
-        return instance
+    user_data = {"valid": True, "username": payload['username'], "is_admin": payload['username'] in config.get('ADMIN_USERS')}
+
+    if key and payload.get("exp"):
+        cache.set(key, user_data, ttl=payload["exp"] - time.time())
+
+    return user_data
+
+
+def encode_cursor(publishing_date, file_id):
+    # Opaque keyset cursor: the (publishing_date, id) of the last row sent
+    raw = "%s|%s" % (publishing_date.isoformat(), file_id)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        date, file_id = raw.split("|")
+        # isoformat() omits the microseconds when they are 0 (no fromisoformat on python 3.6)
+        date = datetime.strptime(date, "%Y-%m-%dT%H:%M:%S.%f" if "." in date else "%Y-%m-%dT%H:%M:%S")
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        return None
+    if not is_valid_uuid(file_id):
+        return None
+    return (date, UUID(file_id))
+
+
+def estimate_count(session, query):
+    # Planner estimate on postgresql (cheap, but approximate), exact count elsewhere
+    if session.get_bind().dialect.name != "postgresql":
+        return query.order_by(None).count()
+
+    statement = query.order_by(None).statement
+    compiled = statement.compile(dialect=session.get_bind().dialect)
+    plan = session.connection().exec_driver_sql("EXPLAIN (FORMAT JSON) %s" % compiled, compiled.params).scalar()
+    return int(plan[0]["Plan"]["Plan Rows"])
@@ -0,0 +1,25 @@
+"""empty message
+
+Revision ID: 7d3a2c90e4b1
+Revises: 0c1f5e7b9a2d
+Create Date: 2026-10-18 10:03:47.918254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d3a2c90e4b1'
+down_revision = '0c1f5e7b9a2d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_published_file_file_name_trgm', 'published_file', [sa.text('lower(file_name) gin_trgm_ops')], unique=False, postgresql_using='gin')
+
+
+def downgrade():
+    op.drop_index('ix_published_file_file_name_trgm', table_name='published_file')
@@ -26,4 +26,11 @@ fi
 # Make sure the db schema is up-to-date
 flask db upgrade
 
+# Metrics shared by the uwsgi processes, cleaned at each start
+: ${PROMETHEUS_MULTIPROC_DIR:='/tmp/gopublish_metrics'}
+export PROMETHEUS_MULTIPROC_DIR
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+chown nginx:nginx "$PROMETHEUS_MULTIPROC_DIR"
+
 /usr/bin/supervisord
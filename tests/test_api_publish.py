@@ -2,6 +2,7 @@ import os
 import shutil
 from time import sleep
 
+from gopublish.db_models import PublishMetrics
 from gopublish.extensions import db
 
 from . import GopublishTestCase
@@ -236,6 +237,21 @@ class TestApiPublish(GopublishTestCase):
         assert not os.path.islink(public_file)
         assert self.md5(published_file) == self.md5(public_file)
 
+        # Timings are saved along the 'available' status
+        wait = 0
+        while wait < 60:
+            db.session.remove()
+            metrics = PublishMetrics.query.get(file_id)
+            if metrics:
+                break
+            sleep(1)
+            wait += 1
+
+        assert metrics.method == "copy"
+        assert metrics.repo_path == "/repos/myrepo_copy"
+        assert metrics.size == os.path.getsize(published_file)
+        assert metrics.total_seconds >= metrics.transfer_seconds
+
     def test_update_malformed_id(self, app, client):
         public_file = "/repos/myrepo_copy/my_file_to_publish.txt"
 
@@ -313,3 +329,110 @@ class TestApiPublish(GopublishTestCase):
         assert os.path.exists(published_file)
         assert os.path.islink(public_file)
         assert os.readlink(public_file) == published_file
+
+    def test_publish_bulk_missing_paths(self, app, client):
+        token = self.create_mock_token(app)
+        response = client.post('/api/publish/bulk', json={'tags': ['tag']}, headers={'X-Auth-Token': 'Bearer ' + token})
+
+        assert response.status_code == 400
+        assert response.json == {'error': 'Missing paths or directory'}
+
+    def test_publish_bulk_too_many(self, app, client):
+        client.application.config['PUBLISH_BULK_MAX'] = 2
+        data = {
+            'paths': ["/repos/myrepo/a", "/repos/myrepo/b", "/repos/myrepo/c"]
+        }
+        token = self.create_mock_token(app)
+        response = client.post('/api/publish/bulk', json=data, headers={'X-Auth-Token': 'Bearer ' + token})
+
+        assert response.status_code == 400
+        assert response.json == {'error': 'Too many files (3), the maximum is 2'}
+
+    def test_publish_bulk_nothing_valid(self, app, client):
+        os.mkdir("/repos/myrepo/myfolder")
+        data = {
+            'paths': ["/foo/bar", "/repos/myrepo/myfolder"]
+        }
+        token = self.create_mock_token(app)
+        response = client.post('/api/publish/bulk', json=data, headers={'X-Auth-Token': 'Bearer ' + token})
+
+        assert response.status_code == 400
+        assert response.json == {'error': 'No file can be published', 'results': [
+            {'path': "/foo/bar", 'error': 'File not found at path /foo/bar'},
+            {'path': "/repos/myrepo/myfolder", 'error': 'Path must not be a folder or a symlink'}
+        ]}
+
+    def test_publish_bulk_glob_outside_directory(self, app, client):
+        data = {
+            'directory': "/repos/myrepo",
+            'glob': "../myrepo_copy/*"
+        }
+        token = self.create_mock_token(app)
+        response = client.post('/api/publish/bulk', json=data, headers={'X-Auth-Token': 'Bearer ' + token})
+
+        assert response.status_code == 400
+        assert response.json == {'error': 'glob must be a relative pattern'}
+
+    def test_publish_bulk_success(self, app, client):
+        """
+        Publish a list of files, with a missing one
+        """
+        for name in ["first.txt", "second.txt"]:
+            shutil.copy("/repos/myrepo/my_file_to_publish.txt", os.path.join("/repos/myrepo", name))
+
+        paths = ["/repos/myrepo/first.txt", "/repos/myrepo/second.txt", "/repos/myrepo/missing.txt"]
+        data = {
+            'paths': paths,
+            'tags': ['bulk']
+        }
+        token = self.create_mock_token(app)
+        response = client.post('/api/publish/bulk', json=data, headers={'X-Auth-Token': 'Bearer ' + token})
+
+        assert response.status_code == 200
+        data = response.json
+        assert data['message'] == "2 files registering. They should be ready soon"
+        assert [result['path'] for result in data['results']] == paths
+        assert data['results'][2] == {'path': "/repos/myrepo/missing.txt", 'error': 'File not found at path /repos/myrepo/missing.txt'}
+
+        for path, result in zip(paths[:2], data['results'][:2]):
+            published_file = os.path.join("/repos/myrepo/public/", result['file_id'])
+
+            wait = 0
+            while wait < 60:
+                sleep(2)
+
+                if os.path.exists(published_file):
+                    break
+                wait += 1
+
+            assert os.path.exists(published_file)
+            assert os.readlink(path) == published_file
+
+        response = client.get('/api/list?tags=bulk')
+        assert response.json['total'] == 2
+
+    def test_publish_bulk_glob(self, app, client):
+        """
+        Publish the files of a directory matching a glob pattern
+        """
+        os.mkdir("/repos/myrepo_copy/sub")
+        for name in ["sub/first.txt", "sub/second.txt", "sub/other.csv"]:
+            shutil.copy("/repos/myrepo_copy/my_file_to_publish.txt", os.path.join("/repos/myrepo_copy", name))
+
+        data = {
+            'directory': "/repos/myrepo_copy",
+            'glob': "**/*.txt"
+        }
+        token = self.create_mock_token(app)
+        response = client.post('/api/publish/bulk', json=data, headers={'X-Auth-Token': 'Bearer ' + token})
+
+        assert response.status_code == 200
+        results = response.json['results']
+        assert [result['path'] for result in results] == [
+            "/repos/myrepo_copy/my_file_to_publish.txt",
+            "/repos/myrepo_copy/public/my_file_to_publish_v2.txt",
+            "/repos/myrepo_copy/sub/first.txt",
+            "/repos/myrepo_copy/sub/second.txt"
+        ]
+        assert results[1]['error'] == 'File /repos/myrepo_copy/public/my_file_to_publish_v2.txt is already in the public folder of the repository'
+        assert all('file_id' in result for result in results[:1] + results[2:])
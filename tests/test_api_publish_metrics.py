@@ -0,0 +1,97 @@
+import os
+import shutil
+from datetime import datetime, timedelta
+
+from gopublish.db_models import PublishMetrics, PublishedFile
+from gopublish.extensions import db
+
+from . import GopublishTestCase
+
+
+class TestApiPublishMetrics(GopublishTestCase):
+    template_repo = "/gopublish/test-data/test-repo/"
+    testing_repo = "/repos/myrepo"
+
+    def setup_method(self):
+        if os.path.exists(self.testing_repo):
+            shutil.rmtree(self.testing_repo)
+        shutil.copytree(self.template_repo, self.testing_repo)
+
+    def teardown_method(self):
+        if os.path.exists(self.testing_repo):
+            shutil.rmtree(self.testing_repo)
+        db.session.remove()
+        db.drop_all()
+
+    def create_metrics(self, repo_path, method, total_seconds, published=None, notification_seconds=None):
+        pf = PublishedFile(file_name="file.txt", repo_path=repo_path, version=1, size=100, status="available", owner="root")
+        pf.publish_metrics = PublishMetrics(
+            repo_path=repo_path,
+            method=method,
+            size=100,
+            published=published or datetime.utcnow(),
+            queue_seconds=0.5,
+            transfer_seconds=total_seconds,
+            hash_seconds=0,
+            chmod_seconds=0.001,
+            notification_seconds=notification_seconds,
+            total_seconds=total_seconds,
+            bytes_per_second=100 / total_seconds
+        )
+        db.session.add(pf)
+        db.session.commit()
+        return pf
+
+    def test_publish_metrics_admin_only(self, app, client):
+        token = self.create_mock_token(app)
+        response = client.get('/api/publish/metrics', headers={'X-Auth-Token': 'Bearer ' + token})
+
+        assert response.status_code == 401
+
+    def test_publish_metrics_bad_days(self, app, client):
+        token = self.create_mock_token(app, user="adminuser")
+        response = client.get('/api/publish/metrics?days=-1', headers={'X-Auth-Token': 'Bearer ' + token})
+
+        assert response.status_code == 400
+
+    def test_publish_metrics_percentiles(self, app, client):
+        for seconds in range(1, 11):
+            self.create_metrics("/repos/myrepo", "copy", seconds, notification_seconds=0.1 if seconds == 1 else None)
+        self.create_metrics("/repos/myrepo", "move (rename)", 0.01)
+        self.create_metrics("/repos/other", "copy", 20)
+        # Out of the time range
+        self.create_metrics("/repos/myrepo", "copy", 100, published=datetime.utcnow() - timedelta(days=60))
+
+        token = self.create_mock_token(app, user="adminuser")
+        response = client.get('/api/publish/metrics', headers={'X-Auth-Token': 'Bearer ' + token})
+
+        assert response.status_code == 200
+        data = response.json
+        assert data["days"] == 30
+        assert set(data["repos"]) == {"/repos/myrepo", "/repos/other"}
+
+        copy = data["repos"]["/repos/myrepo"]["copy"]
+        assert copy["files"] == 10
+        assert copy["bytes"] == 1000
+        assert copy["total_seconds"]["p50"] == 5.5
+        assert round(copy["total_seconds"]["p90"], 2) == 9.1
+        assert round(copy["total_seconds"]["p99"], 2) == 9.91
+        assert copy["notification_seconds"] == {"p50": 0.1, "p90": 0.1, "p99": 0.1}
+        assert data["repos"]["/repos/myrepo"]["move (rename)"]["files"] == 1
+        assert data["repos"]["/repos/myrepo"]["move (rename)"]["notification_seconds"] == {"p50": None, "p90": None, "p99": None}
+
+        response = client.get('/api/publish/metrics?days=0&repo=/repos/myrepo', headers={'X-Auth-Token': 'Bearer ' + token})
+
+        assert response.status_code == 200
+        data = response.json
+        assert list(data["repos"]) == ["/repos/myrepo"]
+        assert data["repos"]["/repos/myrepo"]["copy"]["files"] == 11
+
+    def test_publish_metrics_deleted_with_file(self, app, client):
+        pf = self.create_metrics("/repos/myrepo", "copy", 1)
+        file_id = pf.id
+
+        db.session.delete(pf)
+        db.session.commit()
+
+        assert PublishMetrics.query.get(file_id) is None
@@ -3,6 +3,8 @@ import shutil
 
 from gopublish.extensions import db
 
+import pytest
+
 from . import GopublishTestCase
 
 
@@ -96,3 +98,59 @@ class TestApiSearch(GopublishTestCase):
             'status': "available",
             "tags": ["tag1"]
         }
+
+    def test_search_cursor(self, app, client):
+        file_ids = [self.create_mock_published_file("available") for i in range(3)]
+
+        url = "/api/search"
+        response = client.get(url, query_string={'file': 'my_file_to_publish', 'limit': 2, 'count': 'estimate'})
+
+        assert response.status_code == 200
+        assert response.json['total'] > 0
+        assert len(response.json['files']) == 2
+
+        first_page = [file['uri'] for file in response.json['files']]
+
+        response = client.get(url, query_string={'file': 'my_file_to_publish', 'limit': 2, 'cursor': response.json['next_cursor']})
+
+        assert response.status_code == 200
+        assert response.json['total'] == 3
+        assert len(response.json['files']) == 1
+
+        second_page = [file['uri'] for file in response.json['files']]
+
+        assert sorted(first_page + second_page) == sorted(file_ids)
+
+    def test_search_wrong_mode(self, app, client):
+        url = "/api/search"
+        response = client.get(url, query_string={'file': 'my_file_to_publish', 'mode': 'blabla'})
+
+        assert response.status_code == 400
+        assert response.json == {'error': 'mode must be one of substring or fuzzy'}
+
+    def test_search_relevance(self, app, client):
+        file_id = self.create_mock_published_file("available")
+
+        url = "/api/search"
+        response = client.get(url, query_string={'file': 'my_file_to_publish', 'mode': 'fuzzy', 'order': 'relevance'})
+
+        assert response.status_code == 200
+        assert [file['uri'] for file in response.json['files']] == [file_id]
+        assert response.json['next_cursor'] is None
+
+    def test_search_fuzzy_typo(self, app, client):
+        if not db.engine.dialect.name == "postgresql":
+            pytest.skip("Fuzzy matching requires pg_trgm")
+
+        file_id = self.create_mock_published_file("available")
+
+        url = "/api/search"
+        response = client.get(url, query_string={'file': 'my_fle_to_pubish', 'mode': 'fuzzy'})
+
+        assert response.status_code == 200
+        assert [file['uri'] for file in response.json['files']] == [file_id]
+
+        response = client.get(url, query_string={'file': 'my_fle_to_pubish'})
+
+        assert response.status_code == 200
+        assert response.json['files'] == []
@@ -1,8 +1,12 @@
 import os
 import shutil
+import sqlite3
 
+from gopublish.db_models import TagCount
 from gopublish.extensions import db
 
+from sqlalchemy import event
+
 from . import GopublishTestCase
 
 
@@ -88,3 +92,173 @@ class TestApiTag(GopublishTestCase):
         # Assert tag removal
         assert response.status_code == 200
         assert response.json == {"tags": []}
+
+    def test_untag_last_file_foreign_keys(self, app, client):
+        # Foreign keys are always enforced by postgresql, only on demand by sqlite
+        def enable_foreign_keys(dbapi_connection, connection_record):
+            if isinstance(dbapi_connection, sqlite3.Connection):
+                dbapi_connection.execute("PRAGMA foreign_keys=ON")
+
+        # The client has its own app (and engine)
+        with client.application.app_context():
+            engines = [db.engine]
+        engines.append(db.engine)
+        for engine in engines:
+            event.listen(engine, "connect", enable_foreign_keys)
+            engine.dispose()
+        try:
+            file_id = self.create_mock_published_file("available", tags=['my_tag'])
+            token = self.create_mock_token(app)
+
+            url = "/api/tag/remove/" + file_id
+            response = client.put(url, json={'tags': ['my_tag']}, headers={'X-Auth-Token': 'Bearer ' + token})
+
+            assert response.status_code == 200
+            assert response.json['file']['tags'] == []
+            assert TagCount.query.count() == 0
+
+            response = client.get("/api/tag/list")
+
+            assert response.json == {"tags": []}
+        finally:
+            db.session.remove()
+            for engine in engines:
+                event.remove(engine, "connect", enable_foreign_keys)
+                engine.dispose()
+
+    def test_list_tags_unpublished(self, app, client):
+        self.create_mock_published_file("available", tags=['my_tag'])
+        self.create_mock_published_file("unpublished", tags=['my_other_tag'])
+
+        url = "/api/tag/list"
+        response = client.get(url)
+
+        assert response.status_code == 200
+        assert response.json == {"tags": [{"tag": "my_tag", "count": 1}, {"tag": "my_other_tag", "count": 0}]}
+
+    def test_list_tags_prefix_limit(self, app, client):
+        self.create_mock_tag("my_tag")
+        self.create_mock_tag("my_other_tag")
+        self.create_mock_tag("tag")
+
+        url = "/api/tag/list"
+        response = client.get(url, query_string={'prefix': 'my_'})
+
+        assert response.status_code == 200
+        assert response.json == {"tags": [{"tag": "my_other_tag", "count": 0}, {"tag": "my_tag", "count": 0}]}
+
+        response = client.get(url, query_string={'limit': 1})
+
+        assert response.status_code == 200
+        assert len(response.json['tags']) == 1
+
+    def test_list_tags_cache(self, app, client):
+        client.application.config['TAG_COUNT_CACHE'] = True
+        file_id = self.create_mock_published_file("available")
+        token = self.create_mock_token(app)
+
+        url = "/api/tag/add/" + file_id
+        response = client.put(url, json={'tags': ['my_tag']}, headers={'X-Auth-Token': 'Bearer ' + token})
+        assert response.status_code == 200
+
+        url = "/api/tag/list"
+        response = client.get(url)
+
+        assert response.status_code == 200
+        assert response.json == {"tags": [{"tag": "my_tag", "count": 1}]}
+
+        url = "/api/unpublish/" + file_id
+        response = client.delete(url, headers={'X-Auth-Token': 'Bearer ' + token})
+        assert response.status_code == 200
+
+        url = "/api/tag/list"
+        response = client.get(url)
+
+        assert response.status_code == 200
+        assert response.json == {"tags": [{"tag": "my_tag", "count": 0}]}
+
+    def test_tag_token_cache(self, app, client):
+        file_id = self.create_mock_published_file("available")
+        token = self.create_mock_token(app)
+
+        for tag in ['my_tag', 'my_other_tag']:
+            url = "/api/tag/add/" + file_id
+            response = client.put(url, json={'tags': [tag]}, headers={'X-Auth-Token': 'Bearer ' + token})
+
+            assert response.status_code == 200
+            # The user is kept in the request context, not in a session cookie
+            assert 'Set-Cookie' not in response.headers
+
+        assert len(client.application.token_cache) == 1
+
+    def test_batch_tag_files(self, app, client):
+        client.application.config['TAG_COUNT_CACHE'] = True
+        file_ids = [self.create_mock_published_file("available", tags=['old_tag']) for i in range(3)]
+        unpublished_id = self.create_mock_published_file("unpublished")
+        missing_id = "f2ecc13f-3038-4f78-8c84-ab881a0b567d"
+        token = self.create_mock_token(app)
+
+        data = {
+            'files': file_ids + [unpublished_id, missing_id],
+            'add': ['new_tag', 'other_tag'],
+            'remove': 'old_tag'
+        }
+        response = client.put("/api/tag/batch", json=data, headers={'X-Auth-Token': 'Bearer ' + token})
+
+        assert response.status_code == 200
+        assert response.json == {'files': 4, 'missing': [missing_id], 'added': {'new_tag': 4, 'other_tag': 4}, 'removed': {'old_tag': 3}}
+
+        # Already tagged files are skipped
+        response = client.put("/api/tag/batch", json={'files': file_ids, 'add': ['new_tag']}, headers={'X-Auth-Token': 'Bearer ' + token})
+        assert response.json['added'] == {}
+
+        response = client.get("/api/tag/list")
+        assert response.json == {"tags": [{"tag": "new_tag", "count": 3}, {"tag": "other_tag", "count": 3}]}
+
+        client.application.config['TAG_COUNT_CACHE'] = False
+        response = client.get("/api/tag/list")
+        assert response.json == {"tags": [{"tag": "new_tag", "count": 3}, {"tag": "other_tag", "count": 3}]}
+
+    def test_batch_tag_query(self, app, client):
+        self.create_mock_published_file("available", tags=['my_tag'])
+        self.create_mock_published_file("available")
+        token = self.create_mock_token(app)
+
+        data = {
+            'query': {'file': 'file_to_publish'},
+            'add': ['new_tag']
+        }
+        response = client.put("/api/tag/batch", json=data, headers={'X-Auth-Token': 'Bearer ' + token})
+
+        assert response.status_code == 200
+        assert response.json == {'files': 2, 'added': {'new_tag': 2}, 'removed': {}}
+
+        data = {
+            'query': {'tags': ['new_tag', 'my_tag']},
+            'remove': ['new_tag']
+        }
+        response = client.put("/api/tag/batch", json=data, headers={'X-Auth-Token': 'Bearer ' + token})
+
+        assert response.status_code == 200
+        assert response.json == {'files': 1, 'added': {}, 'removed': {'new_tag': 1}}
+
+        response = client.get("/api/tag/list")
+        assert response.json == {"tags": [{"tag": "my_tag", "count": 1}, {"tag": "new_tag", "count": 1}]}
+
+    def test_batch_tag_wrong_owner(self, app, client):
+        file_id = self.create_mock_published_file("available")
+        token = self.create_mock_token(app, user="jdoe")
+
+        response = client.put("/api/tag/batch", json={'files': [file_id], 'add': ['my_tag']}, headers={'X-Auth-Token': 'Bearer ' + token})
+
+        assert response.status_code == 200
+        assert response.json == {'files': 0, 'missing': [file_id], 'added': {}, 'removed': {}}
+
+    def test_batch_tag_add_and_remove(self, app, client):
+        file_id = self.create_mock_published_file("available")
+        token = self.create_mock_token(app)
+
+        response = client.put("/api/tag/batch", json={'files': [file_id], 'add': ['my_tag'], 'remove': ['My_Tag']}, headers={'X-Auth-Token': 'Bearer ' + token})
+
+        assert response.status_code == 400
+        assert response.json == {'error': 'Tags my_tag cannot be both added and removed'}
@@ -1,3 +1,9 @@
+import time
+from datetime import datetime, timedelta
+
+from gopublish.model.cache import TTLCache
+from gopublish.utils import validate_token
+
 import jwt
 
 from . import GopublishTestCase
@@ -69,3 +75,16 @@ class TestApiToken(GopublishTestCase):
 
         payload = jwt.decode(response.json.get("token"), app.config['SECRET_KEY'], algorithms=["HS256"])
         assert payload['username'] == "adminuser"
+
+    def test_validate_token_cache(self, app):
+        cache = TTLCache()
+        expire_at = datetime.utcnow() + timedelta(seconds=2)
+        token = jwt.encode({"username": "adminuser", "exp": expire_at}, app.config['SECRET_KEY'], algorithm="HS256")
+
+        assert validate_token(token, app.config, cache=cache) == {"valid": True, "username": "adminuser", "is_admin": True}
+        assert len(cache) == 1
+        assert validate_token(token, app.config, cache=cache)["valid"]
+
+        # Cached entries do not outlive the token
+        time.sleep(2.1)
+        assert validate_token(token, app.config, cache=cache) == {"valid": False, "error": "Expired token"}
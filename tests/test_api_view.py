@@ -1,8 +1,16 @@
 import os
 import shutil
 import tempfile
+import time
+import uuid
+from datetime import datetime
 
+from gopublish.db_models import FileDigest, PublishedFile
 from gopublish.extensions import db
+from gopublish.model.downloads import DownloadCounter
+from gopublish.model.files import reconcile_statuses
+
+import pytest
 
 from . import GopublishTestCase
 
@@ -70,6 +78,8 @@ class TestApiView(GopublishTestCase):
             "version": 1,
             "size": size,
             "hash": hash,
+            "digests": {},
+            "downloads": 0,
             "siblings": [],
             "tags": []
         }
@@ -98,6 +108,8 @@ class TestApiView(GopublishTestCase):
             "version": 1,
             "size": size,
             "hash": hash,
+            "digests": {},
+            "downloads": 0,
             "siblings": [
                 {
                     "uri": file_ids[1],
@@ -126,6 +138,8 @@ class TestApiView(GopublishTestCase):
             "version": 2,
             "size": size,
             "hash": hash,
+            "digests": {},
+            "downloads": 0,
             "siblings": [
                 {
                     "uri": file_ids[0],
@@ -136,6 +150,139 @@ class TestApiView(GopublishTestCase):
             "tags": []
         }
 
+    def test_view_digests(self, app, client):
+        file_id = self.create_mock_published_file("available")
+        published_file = os.path.join("/repos/myrepo/public/", file_id)
+        hash = self.md5(published_file)
+
+        pf = PublishedFile.query.get(file_id)
+        pf.digests = [FileDigest(algorithm="md5", digest=hash), FileDigest(algorithm="sha256", digest="ab" * 32)]
+        db.session.commit()
+
+        response = client.get("/api/view/" + file_id)
+
+        assert response.status_code == 200
+        assert response.json['file']['digests'] == {"md5": hash, "sha256": "ab" * 32}
+
+    def test_view_batch(self, app, client):
+        file_id = self.create_mock_published_file("available", tags=['my_tag'])
+        removed_id = self.create_mock_published_file("available")
+        os.remove(os.path.join("/repos/myrepo/public/", removed_id))
+        version = PublishedFile(file_name="my_file_to_publish.txt", repo_path="/repos/myrepo", version=2, size=0, status="available", owner="root", version_of_id=file_id)
+        db.session.add(version)
+        db.session.commit()
+        version_id = str(version.id)
+        missing_id = "f2ecc13f-3038-4f78-8c84-ab881a0b567d"
+
+        response = client.post("/api/view", json={'files': [file_id, removed_id, version_id, missing_id]})
+
+        assert response.status_code == 200
+        files = response.json['files']
+        assert response.json['missing'] == [missing_id]
+        assert sorted(files.keys()) == sorted([file_id, removed_id, version_id])
+
+        assert files[file_id]['tags'] == ['my_tag']
+        assert [sibling['uri'] for sibling in files[file_id]['siblings']] == [version_id]
+        assert [sibling['uri'] for sibling in files[version_id]['siblings']] == [file_id]
+        # Read-only: the status is updated by the reconciliation task
+        assert files[removed_id]['status'] == "available"
+
+        # Same payload as /api/view/<file_id>
+        for uri, data in files.items():
+            assert client.get("/api/view/" + uri).json['file'] == data
+
+    def test_view_pulling(self, app, client):
+        file_id = self.create_mock_published_file("pulling")
+        published_file = os.path.join("/repos/myrepo/public/", file_id)
+        with open(published_file, "r+") as f:
+            content = f.read()
+            f.truncate(2)
+
+        response = client.get("/api/view/" + file_id)
+        assert response.json['file']['status'] == "pulling"
+
+        with open(published_file, "w") as f:
+            f.write(content)
+
+        # The size of files being pulled is cached
+        response = client.get("/api/view/" + file_id)
+        assert response.json['file']['status'] == "pulling"
+
+        client.application.pulling_cache.invalidate()
+        response = client.get("/api/view/" + file_id)
+        assert response.json['file']['status'] == "available"
+        assert PublishedFile.query.get(file_id).status == "pulling"
+
+    def test_reconcile_statuses(self, app, client):
+        available_id = self.create_mock_published_file("available")
+        removed_id = self.create_mock_published_file("available")
+        os.remove(os.path.join("/repos/myrepo/public/", removed_id))
+        pulled_id = self.create_mock_published_file("pulling")
+        pulling_id = self.create_mock_published_file("pulling")
+        with open(os.path.join("/repos/myrepo/public/", pulling_id), "w") as f:
+            f.write("x")
+        unpublished_id = self.create_mock_published_file("unpublished")
+        os.remove(os.path.join("/repos/myrepo/public/", unpublished_id))
+
+        updated = reconcile_statuses(client.application.repos.get_repo("/repos/myrepo"), batch_size=1)
+
+        assert updated == 2
+        assert dict(db.session.query(PublishedFile.id, PublishedFile.status)) == {
+            uuid.UUID(available_id): "available",
+            uuid.UUID(removed_id): "unavailable",
+            uuid.UUID(pulled_id): "available",
+            uuid.UUID(pulling_id): "pulling",
+            uuid.UUID(unpublished_id): "unpublished"
+        }
+
+    def test_reconcile_missing_folder(self, app, client):
+        removed_id = self.create_mock_published_file("available")
+        shutil.rmtree("/repos/myrepo/public/")
+
+        assert reconcile_statuses(client.application.repos.get_repo("/repos/myrepo")) == 0
+        assert PublishedFile.query.get(removed_id).status == "available"
+
+    def test_view_batch_wrong_ids(self, app, client):
+        response = client.post("/api/view", json={'files': ["XXX"]})
+
+        assert response.status_code == 400
+        assert response.json == {'error': 'files must be a list of file ids'}
+
+        client.application.config['VIEW_BATCH_MAX'] = 1
+        response = client.post("/api/view", json={'files': ["f2ecc13f-3038-4f78-8c84-ab881a0b567d", "f2ecc13f-3038-4f78-8c84-ab881a0b567e"]})
+
+        assert response.status_code == 400
+        assert response.json == {'error': 'Too many files (2), the maximum is 1'}
+
+    def test_lookup_digest(self, app, client):
+        file_id = self.create_mock_published_file("available")
+
+        pf = PublishedFile.query.get(file_id)
+        pf.digests = [FileDigest(algorithm="sha256", digest="ab" * 32)]
+        db.session.commit()
+
+        response = client.get("/api/digest/sha256/" + "AB" * 32)
+
+        assert response.status_code == 200
+        assert response.json['total'] == 1
+        assert response.json['files'][0]['uri'] == file_id
+
+        response = client.get("/api/digest/sha256/" + "cd" * 32)
+
+        assert response.status_code == 200
+        assert response.json['total'] == 0
+
+        response = client.get("/api/digest/sha1/" + "ab" * 20)
+
+        assert response.status_code == 400
+
+    def test_lookup_malformed_digest(self, app, client):
+        for digest in ["0x" + "ab" * 31, "ab_" * 21 + "a", " " + "ab" * 31 + "a", "ab" * 31, "ab" * 33, "gh" * 32]:
+            response = client.get("/api/digest/sha256/" + digest)
+
+            assert response.status_code == 400
+            assert response.json == {'error': 'Malformed digest'}
+
     def test_download_existing_file(self, app, client):
         file_id = self.create_mock_published_file("available")
         published_file = os.path.join("/repos/myrepo/public/", file_id)
@@ -151,6 +298,141 @@ class TestApiView(GopublishTestCase):
 
             assert self.md5(local_file) == self.md5(published_file)
 
+    def test_download_count(self, app, client):
+        file_id = self.create_mock_published_file("available")
+
+        response = client.get("/api/download/" + file_id)
+        assert response.status_code == 200
+
+        # Pending count, not yet in the database
+        response = client.get("/api/view/" + file_id)
+        assert response.status_code == 200
+        assert response.json['file']['downloads'] == 1
+
+        with client.application.app_context():
+            client.application.download_counter.flush()
+
+        response = client.get("/api/list")
+        assert response.status_code == 200
+        assert response.json['files'][0]['downloads'] == 1
+
+        assert PublishedFile.query.get(file_id).downloads == 1
+
+    def test_download_count_background_flush(self, app, client):
+        file_id = self.create_mock_published_file("available")
+        counter = DownloadCounter(client.application, flush_interval=1)
+
+        # Written without any further download
+        counter.increment(file_id)
+        counter.ensure_started()
+        for i in range(30):
+            time.sleep(0.1)
+            db.session.remove()
+            if PublishedFile.query.get(file_id).downloads == 1:
+                break
+
+        assert PublishedFile.query.get(file_id).downloads == 1
+
+        # And at exit
+        counter.increment(file_id)
+        counter._flush_at_exit()
+        db.session.remove()
+
+        assert PublishedFile.query.get(file_id).downloads == 2
+
+    def test_download_count_failed_flush(self, app, client):
+        fakeredis = pytest.importorskip("fakeredis")
+
+        class FailingCounter(DownloadCounter):
+            def _write(self, counts):
+                raise Exception("Database is down")
+
+        file_id = self.create_mock_published_file("available")
+        local_id = self.create_mock_published_file("available")
+        counter = FailingCounter(client.application)
+        counter.redis = fakeredis.FakeRedis()
+
+        counter.increment(file_id, 2)
+        with counter._lock:
+            counter._pending[local_id] += 1
+
+        with client.application.app_context():
+            with pytest.raises(Exception):
+                counter.flush()
+
+        # Redis counts go back to the shared hash, local ones to the local buffer
+        assert counter.redis.hgetall(DownloadCounter.REDIS_KEY) == {file_id.encode(): b"2"}
+        assert dict(counter._pending) == {local_id: 1}
+
+    def test_download_conditional(self, app, client):
+        file_id = self.create_mock_published_file("available")
+        published_file = os.path.join("/repos/myrepo/public/", file_id)
+        hash = self.md5(published_file)
+
+        url = "/api/download/" + file_id
+        response = client.get(url)
+
+        assert response.status_code == 200
+        assert response.headers['ETag'] == '"%s"' % hash
+        assert "immutable" in response.headers['Cache-Control']
+        assert response.headers['Digest'].startswith("md5=")
+
+        response = client.get(url, headers={'If-None-Match': '"%s"' % hash})
+
+        assert response.status_code == 304
+        assert response.data == b""
+
+    def test_download_range(self, app, client):
+        file_id = self.create_mock_published_file("available")
+        published_file = os.path.join("/repos/myrepo/public/", file_id)
+        hash = self.md5(published_file)
+        with open(published_file, "rb") as f:
+            content = f.read()
+        size = len(content)
+
+        url = "/api/download/" + file_id
+        response = client.get(url, headers={'Range': 'bytes=2-5'})
+
+        assert response.status_code == 206
+        assert response.headers['Content-Range'] == "bytes 2-5/%s" % size
+        assert response.data == content[2:6]
+
+        response = client.get(url, headers={'Range': 'bytes=0-1,-2'})
+
+        assert response.status_code == 206
+        assert response.mimetype == "multipart/byteranges"
+        assert int(response.headers['Content-Length']) == len(response.data)
+        assert content[0:2] in response.data
+        assert content[-2:] in response.data
+
+        # Outdated If-Range: whole file
+        response = client.get(url, headers={'Range': 'bytes=2-5', 'If-Range': '"xxx"'})
+
+        assert response.status_code == 200
+        assert response.data == content
+
+        response = client.get(url, headers={'Range': 'bytes=2-5', 'If-Range': '"%s"' % hash})
+
+        assert response.status_code == 206
+
+        response = client.get(url, headers={'Range': 'bytes=%s-' % (size + 10)})
+
+        assert response.status_code == 416
+        assert response.headers['Content-Range'] == "bytes */%s" % size
+
+    def test_download_x_accel(self, app, client):
+        client.application.config['USE_X_SENDFILE'] = True
+        file_id = self.create_mock_published_file("available")
+        published_file = os.path.join("/repos/myrepo/public/", file_id)
+
+        url = "/api/download/" + file_id
+        response = client.get(url)
+
+        assert response.status_code == 200
+        assert response.data == b""
+        assert response.headers['X-Accel-Redirect'] == "/_gopublish" + published_file
+        assert response.headers['ETag'] == '"%s"' % self.md5(published_file)
+
     def test_download_unpublished_file(self, app, client):
         file_id = self.create_mock_published_file("unpublished")
 
@@ -183,3 +465,81 @@ class TestApiView(GopublishTestCase):
             'status': "available",
             "tags": []
         }
+
+    def test_list_cursor(self, app, client):
+        file_ids = [self.create_mock_published_file("available") for i in range(3)]
+
+        url = "/api/list"
+        response = client.get(url, query_string={'limit': 2})
+
+        assert response.status_code == 200
+        assert response.json['total'] == 3
+        assert len(response.json['files']) == 2
+        assert response.json['next_cursor']
+
+        first_page = [file['uri'] for file in response.json['files']]
+
+        response = client.get(url, query_string={'limit': 2, 'cursor': response.json['next_cursor'], 'count': 'none'})
+
+        assert response.status_code == 200
+        assert response.json['total'] is None
+        assert len(response.json['files']) == 1
+        assert response.json['next_cursor'] is None
+
+        second_page = [file['uri'] for file in response.json['files']]
+
+        assert sorted(first_page + second_page) == sorted(file_ids)
+
+    def test_list_cursor_last_page(self, app, client):
+        [self.create_mock_published_file("available") for i in range(2)]
+
+        url = "/api/list"
+        response = client.get(url, query_string={'limit': 2})
+
+        assert response.status_code == 200
+        assert len(response.json['files']) == 2
+        assert response.json['next_cursor'] is None
+
+    def test_list_cursor_round_microseconds(self, app, client):
+        file_id = self.create_mock_published_file("available")
+        older_id = self.create_mock_published_file("available")
+        with client.application.app_context():
+            p_file = PublishedFile.query.get(file_id)
+            p_file.publishing_date = datetime(2021, 1, 2, 3, 4, 5)
+            older = PublishedFile.query.get(older_id)
+            older.publishing_date = datetime(2021, 1, 1, 3, 4, 5, 123456)
+            db.session.commit()
+
+        url = "/api/list"
+        response = client.get(url, query_string={'limit': 1})
+
+        assert response.json['files'][0]['uri'] == file_id
+
+        response = client.get(url, query_string={'limit': 1, 'cursor': response.json['next_cursor']})
+
+        assert response.status_code == 200
+        assert [file['uri'] for file in response.json['files']] == [older_id]
+        assert response.json['next_cursor'] is None
+
+    def test_list_wrong_cursor(self, app, client):
+        url = "/api/list"
+        response = client.get(url, query_string={'cursor': 'blabla'})
+
+        assert response.status_code == 400
+        assert response.json == {'error': 'Invalid cursor'}
+
+    def test_list_tag_facets(self, app, client):
+        self.create_mock_published_file("available", tags=["tag1"])
+        self.create_mock_published_file("available", tags=["tag2"])
+
+        url = "/api/list"
+        response = client.get(url, query_string={'limit': 1})
+
+        assert response.status_code == 200
+        assert len(response.json['files']) == 1
+
+        # Facets are computed on every matching file, not only on the current page
+        assert sorted(response.json['tags'], key=lambda tag: tag['tag']) == [
+            {"tag": "tag1", "count": 1},
+            {"tag": "tag2", "count": 1}
+        ]
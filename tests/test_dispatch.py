@@ -0,0 +1,41 @@
+from gopublish.dispatch import send_task_on_commit
+from gopublish.extensions import db
+
+from . import GopublishTestCase
+
+
+class FakeCelery():
+
+    def __init__(self):
+        self.sent = []
+
+    def send_task(self, name, args):
+        self.sent.append((name, args))
+
+
+class TestDispatch(GopublishTestCase):
+
+    def teardown_method(self):
+        db.session.remove()
+
+    def test_send_after_commit(self, app):
+        app.celery = FakeCelery()
+
+        send_task_on_commit("unpublish", ("some_id",))
+        assert app.celery.sent == []
+
+        db.session.commit()
+        assert app.celery.sent == [("unpublish", ("some_id",))]
+
+        # Only sent once
+        db.session.commit()
+        assert len(app.celery.sent) == 1
+
+    def test_drop_on_rollback(self, app):
+        app.celery = FakeCelery()
+
+        send_task_on_commit("unpublish", ("some_id",))
+        db.session.rollback()
+        db.session.commit()
+
+        assert app.celery.sent == []
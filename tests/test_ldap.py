@@ -0,0 +1,118 @@
+import os
+import threading
+
+from gopublish.model.ldap_client import LdapClient
+
+from ldap3 import Connection, MOCK_SYNC
+
+
+class TestLdap():
+
+    base_query = "dc=example,dc=org"
+
+    def setup_method(self):
+        # In-process fake LDAP server: entries are stored on the ldap3 Server object
+        self.client = LdapClient("fake-ldap", base_query=self.base_query, pool_size=2, client_strategy=MOCK_SYNC)
+        self.admin = Connection(self.client.server, client_strategy=MOCK_SYNC)
+        self.admin.bind()
+        self.admin.strategy.add_entry("uid=jdoe,ou=users,dc=example,dc=org", {"uid": "jdoe", "uidNumber": 1001, "userPassword": "secret", "objectClass": "posixAccount"})
+        self.admin.strategy.add_entry("cn=genomics,ou=groups,dc=example,dc=org", {"cn": "genomics", "gidNumber": 2001, "memberUid": ["jdoe"], "objectClass": "posixGroup"})
+
+        self.searches = 0
+        do_search = self.client._do_search
+
+        def counting_search(*args):
+            self.searches += 1
+            return do_search(*args)
+
+        self.client._do_search = counting_search
+
+    def test_user_data(self):
+        data = self.client.get_user_data("jdoe")
+
+        assert data["error"] is None
+        assert data["user_id"] == "1001"
+        assert data["user_dn"] == "uid=jdoe,ou=users,dc=example,dc=org"
+        assert data["user_group_names"] == ["genomics"]
+        assert data["user_group_ids"] == ["2001"]
+
+    def test_cache(self):
+        for i in range(10):
+            self.client.get_user_data("jdoe")
+
+        assert self.searches == 2
+
+        self.client.invalidate("jdoe")
+        self.client.get_user_data("jdoe")
+
+        assert self.searches == 4
+
+    def test_negative_cache(self):
+        assert self.client.get_user_data("newuser")["error"]
+        assert self.searches == 1
+
+        self.admin.strategy.add_entry("uid=newuser,ou=users,dc=example,dc=org", {"uid": "newuser", "uidNumber": 1002, "objectClass": "posixAccount"})
+
+        # Still cached as unknown
+        assert self.client.get_user_data("newuser")["error"]
+        assert self.searches == 1
+
+        self.client.invalidate()
+        assert self.client.get_user_data("newuser")["user_id"] == "1002"
+
+    def test_escape_filter(self):
+        assert self.client.get_user_data("*")["error"]
+
+    def test_authenticate(self):
+        assert self.client.authenticate("jdoe", "secret")
+        assert not self.client.authenticate("jdoe", "wrong")
+        assert not self.client.authenticate("jdoe", "")
+        assert not self.client.authenticate("nobody", "secret")
+
+    def test_pool(self):
+        errors = []
+
+        def lookup(i):
+            try:
+                self.client.get_user_data("jdoe", refresh=True)
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=lookup, args=(i,)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert not errors
+        assert self.client._created <= 2
+        assert self.client.check()
+
+    def test_check_not_pooled(self):
+        assert self.client.check()
+        assert self.client._created == 0
+        assert self.client._pool.empty()
+
+    def test_stale_connections(self):
+        # Two pooled connections, closed by the server
+        connections = [self.client._acquire(), self.client._acquire()]
+        for conn in connections:
+            conn.unbind()
+            self.client._pool.put(conn)
+
+        data = self.client.get_user_data("jdoe", refresh=True)
+
+        assert not data["error"]
+        assert not any(conn in connections for conn in list(self.client._pool.queue))
+
+    def test_pool_after_fork(self):
+        self.client.get_user_data("jdoe", refresh=True)
+        inherited = list(self.client._pool.queue)
+        assert inherited
+
+        # As in a forked process
+        self.client._pid = os.getpid() + 1
+        self.client.get_user_data("jdoe", refresh=True)
+
+        assert self.client._pid == os.getpid()
+        assert not any(conn in inherited for conn in list(self.client._pool.queue))
@@ -0,0 +1,98 @@
+import logging
+
+from gopublish.logs import DigestSMTPHandler, setup_queue_logging
+
+
+class RecordingSMTPHandler(DigestSMTPHandler):
+
+    def __init__(self, **kwargs):
+        super().__init__("localhost", "from@example.com", ["admin@example.com"], "GOPUBLISH failed!", **kwargs)
+        self.sent = []
+
+    def send(self, record):
+        self.sent.append(self.format(record))
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def log_error(logger, value):
+    # Same location for each call
+    logger.error("Something failed with %s", value)
+
+
+class TestLogs():
+
+    def test_queue_logging(self):
+        logger = logging.getLogger("gopublish.test.queue")
+        logger.setLevel(logging.INFO)
+        target = ListHandler()
+        listener = setup_queue_logging(logger, [target])
+
+        logger.info("First %s", "message")
+        logger.debug("Skipped")
+        try:
+            raise ValueError("Wrong value")
+        except ValueError:
+            logger.exception("Second message")
+        listener.stop()
+
+        assert [record.getMessage().splitlines()[0] for record in target.records] == ["First message", "Second message"]
+        assert "ValueError: Wrong value" in target.records[1].getMessage()
+        assert target.records[1].fingerprint[-1] == "ValueError"
+
+        # Restarted on use (ie after a fork)
+        logger.info("Third message")
+        listener.stop()
+        assert target.records[-1].getMessage() == "Third message"
+
+    def test_digest_emails(self):
+        logger = logging.getLogger("gopublish.test.digest")
+        handler = RecordingSMTPHandler(window=600, max_samples=2)
+        listener = setup_queue_logging(logger, [handler])
+
+        for i in range(4):
+            log_error(logger, i)
+        logger.error("Another error")
+        listener.stop()
+
+        # The first error of each location is sent right away
+        assert handler.sent == ["Something failed with 0", "Another error"]
+
+        handler.flush()
+
+        assert len(handler.sent) == 3
+        assert handler.sent[2].startswith("The following error occurred 3 more times in the last 600 seconds (first 2 shown)")
+        assert "Something failed with 1" in handler.sent[2] and "Something failed with 2" in handler.sent[2]
+        assert "Something failed with 3" not in handler.sent[2]
+
+        # New window
+        log_error(logger, 4)
+        listener.stop()
+        assert handler.sent[3] == "Something failed with 4"
+        handler.close()
+
+    def test_digest_after_fork(self):
+        logger = logging.getLogger("gopublish.test.digest_fork")
+        handler = RecordingSMTPHandler(window=600)
+        listener = setup_queue_logging(logger, [handler])
+
+        log_error(logger, 0)
+        listener.stop()
+
+        # As in a forked process: the window of the parent has no timer anymore
+        handler._pid = -1
+        log_error(logger, 1)
+        listener.stop()
+
+        assert handler.sent == ["Something failed with 0", "Something failed with 1"]
+
+        handler.close()
+        assert len(handler.sent) == 2
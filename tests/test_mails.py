@@ -0,0 +1,167 @@
+import email
+import smtplib
+import socket
+import socketserver
+import threading
+
+from gopublish.extensions import mail
+from gopublish.model.mails import MailQueue, send_notifications
+
+import pytest
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    # Minimal SMTP server, keeping the messages in memory
+
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        sink = self.server.sink
+        sink["connections"] += 1
+        self.reply("220 sink")
+        data = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode().rstrip("\r\n")
+
+            if data is not None:
+                if line == ".":
+                    sink["messages"].append(email.message_from_string("\n".join(data)))
+                    data = None
+                    self.reply("250 OK")
+                else:
+                    data.append(line[1:] if line.startswith("..") else line)
+                continue
+
+            command = line[:4].upper()
+            if command in ("EHLO", "HELO"):
+                self.reply("250 sink")
+            elif command == "MAIL" and len(sink["messages"]) >= sink["accept"]:
+                self.reply("451 Try again later")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+@pytest.fixture
+def sink(app):
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), SMTPSinkHandler)
+    server.daemon_threads = True
+    server.sink = {"connections": 0, "messages": [], "accept": 100}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    app.config.update(MAIL_SERVER="127.0.0.1", MAIL_PORT=server.server_address[1], MAIL_SUPPRESS_SEND=False)
+    mail.init_app(app)
+
+    yield server.sink
+
+    server.shutdown()
+    server.server_close()
+
+
+class FakeCelery():
+
+    def __init__(self):
+        self.sent = []
+
+    def send_task(self, name, args=(), **kwargs):
+        self.sent.append((name, args, kwargs))
+
+
+def notification(recipients, subject):
+    return {"recipients": recipients, "subject": subject, "body": "Body of %s" % subject}
+
+
+class TestMails():
+
+    def test_send_single(self, app, sink):
+        unsent, err = send_notifications([notification(["jdoe@example.com"], "Publishing task over")], "gopublish@example.com")
+
+        assert unsent == [] and err is None
+        assert len(sink["messages"]) == 1
+        assert sink["messages"][0]["Subject"] == "Publishing task over"
+        assert sink["messages"][0]["To"] == "jdoe@example.com"
+
+    def test_send_digest(self, app, sink):
+        notifications = [
+            notification(["jdoe@example.com"], "First"),
+            notification(["jdoe@example.com", "jsmith@example.com"], "Second"),
+            notification(["jsmith@example.com"], "Third")
+        ]
+
+        unsent, err = send_notifications(notifications, "gopublish@example.com")
+
+        assert unsent == [] and err is None
+        # One connection, one email per recipient
+        assert sink["connections"] == 1
+        assert [(message["To"], message["Subject"]) for message in sink["messages"]] == [
+            ("jdoe@example.com", "Gopublish: 2 notifications"),
+            ("jsmith@example.com", "Gopublish: 2 notifications")
+        ]
+        body = sink["messages"][0].get_payload()
+        assert "Body of First" in body and "Body of Second" in body and "Third" not in body
+
+    def test_send_partial_failure(self, app, sink):
+        sink["accept"] = 1
+        notifications = [notification(["jdoe@example.com"], "First"), notification(["jsmith@example.com"], "Second")]
+
+        unsent, err = send_notifications(notifications, "gopublish@example.com")
+
+        assert len(sink["messages"]) == 1
+        assert isinstance(err, smtplib.SMTPException)
+        # Only the failed recipients are left to retry
+        assert unsent == [notification(["jsmith@example.com"], "Second")]
+
+    def test_send_no_server(self, app):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        app.config.update(MAIL_SERVER="127.0.0.1", MAIL_PORT=port, MAIL_SUPPRESS_SEND=False)
+        mail.init_app(app)
+        notifications = [notification(["jdoe@example.com"], "First")]
+
+        unsent, err = send_notifications(notifications, "gopublish@example.com")
+
+        assert unsent == notifications
+        assert isinstance(err, OSError)
+
+    def test_queue_without_redis(self, app):
+        queue = MailQueue(None, queue="mail")
+        celery = FakeCelery()
+
+        queue.push(celery, "jdoe@example.com", "First", "Body of First")
+
+        assert celery.sent == [("send_mails", ([notification(["jdoe@example.com"], "First")],), {"queue": "mail"})]
+        assert queue.pop() == []
+
+    def test_queue_window(self, app):
+        if not app.mail_queue.redis:
+            pytest.skip("Requires redis")
+        queue = MailQueue(None, queue="mail", window=10)
+        queue.redis = app.mail_queue.redis
+        # Not the keys of the running workers
+        queue.REDIS_KEY = "gopublish:test:mails"
+        queue.SCHEDULED_KEY = "gopublish:test:mails:scheduled"
+        queue.redis.delete(queue.REDIS_KEY, queue.SCHEDULED_KEY)
+        celery = FakeCelery()
+
+        queue.push(celery, ["jdoe@example.com"], "First", "Body of First")
+        queue.push(celery, ["jsmith@example.com"], "Second", "Body of Second")
+
+        # Only the first notification of the window schedules the task
+        assert celery.sent == [("send_mails", (), {"countdown": 10, "queue": "mail"})]
+        assert queue.pop() == [notification(["jdoe@example.com"], "First"), notification(["jsmith@example.com"], "Second")]
+        assert queue.pop() == []
+
+        queue.push(celery, ["jdoe@example.com"], "Third", "Body of Third")
+        assert len(celery.sent) == 2
+        queue.redis.delete(queue.REDIS_KEY, queue.SCHEDULED_KEY)
@@ -0,0 +1,46 @@
+from gopublish.metrics import task_finished, task_started
+
+from prometheus_client import REGISTRY
+
+
+class TestMetrics():
+
+    def get_value(self, name, labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_metrics_requests(self, app, client):
+        labels = {"endpoint": "file.list_files", "method": "GET", "status": "200"}
+        before = self.get_value("gopublish_http_requests_total", labels)
+
+        response = client.get("/api/list")
+        assert response.status_code == 200
+
+        assert self.get_value("gopublish_http_requests_total", labels) == before + 1
+        assert self.get_value("gopublish_http_request_duration_seconds_count", {"endpoint": "file.list_files", "method": "GET"}) >= 1
+
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["Content-Type"].startswith("text/plain")
+        body = response.get_data(as_text=True)
+        assert 'gopublish_http_requests_total{endpoint="file.list_files",method="GET",status="200"}' in body
+        assert "gopublish_db_pool_checked_out" in body
+
+    def test_metrics_disabled(self, app, client):
+        client.application.config["METRICS_ENABLED"] = False
+        try:
+            response = client.get("/metrics")
+        finally:
+            client.application.config["METRICS_ENABLED"] = True
+
+        assert response.status_code == 404
+
+    def test_metrics_tasks(self):
+        labels = {"task": "publish", "state": "SUCCESS"}
+        before = self.get_value("gopublish_task_duration_seconds_count", labels)
+
+        task_started("task-id")
+        task_finished("task-id", "publish", "SUCCESS")
+        # Unknown tasks (ie started before the signals were connected) are ignored
+        task_finished("other-id", "publish", "SUCCESS")
+
+        assert self.get_value("gopublish_task_duration_seconds_count", labels) == before + 1
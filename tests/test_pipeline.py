@@ -0,0 +1,53 @@
+import hashlib
+import os
+import tempfile
+
+from gopublish.pipeline import DIGESTS, copy_and_hash, hash_file, move_and_hash
+
+
+class TestPipeline():
+
+    def _write_file(self, folder, size):
+        path = os.path.join(folder, "source.bin")
+        data = os.urandom(size)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path, {algorithm: hashlib.new(algorithm, data).hexdigest() for algorithm in DIGESTS}
+
+    def test_copy_and_hash(self):
+        with tempfile.TemporaryDirectory() as folder:
+            src, digests = self._write_file(folder, 3 * 1024 + 17)
+            dst = os.path.join(folder, "dest.bin")
+
+            result = copy_and_hash(src, dst, chunk_size=1024)
+
+            assert result["digests"] == digests
+            assert result["size"] == 3 * 1024 + 17
+            assert result["transfer_seconds"] == result["seconds"]
+            assert 0 <= result["hash_seconds"] <= result["seconds"]
+            assert os.path.exists(src)
+            with open(src, "rb") as fsrc, open(dst, "rb") as fdst:
+                assert fsrc.read() == fdst.read()
+
+    def test_move_and_hash(self):
+        with tempfile.TemporaryDirectory() as folder:
+            src, digests = self._write_file(folder, 5000)
+            dst = os.path.join(folder, "dest.bin")
+
+            result = move_and_hash(src, dst, chunk_size=1024)
+
+            assert result["digests"] == digests
+            assert result["size"] == 5000
+            assert result["method"] == "move (rename)"
+            assert result["transfer_seconds"] + result["hash_seconds"] == result["seconds"]
+            assert not os.path.exists(src)
+            assert os.path.exists(dst)
+
+    def test_hash_empty_file(self):
+        with tempfile.TemporaryDirectory() as folder:
+            src, digests = self._write_file(folder, 0)
+
+            result = hash_file(src)
+
+            assert result["digests"] == digests
+            assert result["size"] == 0
@@ -2,6 +2,8 @@ import os
 import shutil
 import tempfile
 
+from gopublish.model.repos import Repos, ReposWatcher
+
 import pytest
 
 from . import GopublishTestCase
@@ -9,7 +11,7 @@ from . import GopublishTestCase
 
 class TestRepos(GopublishTestCase):
 
-    temp_paths = ["/foo/bar/", "/repos/some/local/path/"]
+    temp_paths = ["/foo/", "/repos/some/local/path/"]
 
     def setup_method(self):
         for path in self.temp_paths:
@@ -116,3 +118,91 @@ class TestRepos(GopublishTestCase):
 
             assert os.path.exists(local_path_not_exist)
             assert os.path.exists(local_path_not_exist + "/public")
+
+    def test_overlap_not_adjacent(self, app):
+        conf = {
+            '/foo/bar': {
+                'public_folder': "/repos/some/local/path/public"
+            },
+            '/foo/bar-baz': {
+                'public_folder': "/repos/some/local/path/public"
+            },
+            '/foo/bar/baz': {
+                'public_folder': "/repos/some/local/path/public"
+            }
+        }
+
+        with pytest.raises(ValueError):
+            app.repos.do_read_conf(str(conf))
+
+    def test_get_repo(self, app):
+        conf = {
+            '/foo/bar': {
+                'public_folder': "/repos/some/local/path/public"
+            },
+            '/foo/bar-baz': {
+                'public_folder': "/repos/some/local/path/public"
+            },
+            '/foo/baz/qux': {
+                'public_folder': "/repos/some/local/path/public"
+            }
+        }
+
+        app.repos.read_conf_from_str(str(conf))
+
+        assert app.repos.get_repo("/foo/bar").local_path == "/foo/bar"
+        assert app.repos.get_repo("/foo/bar/").local_path == "/foo/bar"
+        assert app.repos.get_repo("/foo/bar/some/file.txt").local_path == "/foo/bar"
+        assert app.repos.get_repo("/foo/bar-baz/file.txt").local_path == "/foo/bar-baz"
+        assert app.repos.get_repo("/foo/baz/qux/file.txt").local_path == "/foo/baz/qux"
+        assert not app.repos.get_repo("/foo/barbaz/file.txt")
+        assert not app.repos.get_repo("/foo/baz/file.txt")
+        assert not app.repos.get_repo("/foo")
+
+    def test_reload(self, app):
+        with tempfile.TemporaryDirectory() as local_path:
+            conf_file = os.path.join(local_path, "repos.yml")
+            with open(conf_file, "w") as f:
+                f.write("/foo/bar:\n    public_folder: /repos/some/local/path/public\n")
+
+            repos = Repos(conf_file)
+            old_repo = repos.get_repo("/foo/bar/file.txt")
+
+            assert not repos.reload()
+            assert repos.get_repo("/foo/bar/file.txt") is old_repo
+
+            with open(conf_file, "w") as f:
+                f.write("/foo/bar:\n    public_folder: /repos/some/local/path/public\n/foo/baz:\n    public_folder: /repos/some/local/path/public\n")
+
+            assert repos.reload()
+            assert repos.get_repo("/foo/baz/file.txt").local_path == "/foo/baz"
+
+    def test_reload_invalid(self, app):
+        with tempfile.TemporaryDirectory() as local_path:
+            conf_file = os.path.join(local_path, "repos.yml")
+            with open(conf_file, "w") as f:
+                f.write("/foo/bar:\n    public_folder: /repos/some/local/path/public\n")
+
+            app.repos = Repos(conf_file)
+            watcher = ReposWatcher(app, interval=0)
+
+            # Conflicting repositories
+            with open(conf_file, "w") as f:
+                f.write("/foo/baz:\n    public_folder: /repos/some/local/path/public\n/foo/baz/qux:\n    public_folder: /repos/some/local/path/public\n")
+
+            assert not watcher.check()
+            # The current configuration is kept
+            assert app.repos.get_repo("/foo/bar/file.txt").local_path == "/foo/bar"
+            assert not app.repos.get_repo("/foo/baz/file.txt")
+
+    def test_reload_api(self, app, client):
+        token = self.create_mock_token(app, user="jdoe")
+        response = client.post("/api/repos/reload", headers={'X-Auth-Token': 'Bearer ' + token})
+
+        assert response.status_code == 401
+
+        token = self.create_mock_token(app, user="adminuser")
+        response = client.post("/api/repos/reload", headers={'X-Auth-Token': 'Bearer ' + token})
+
+        assert response.status_code == 200
+        assert "/repos/myrepo" in response.json["repos"]
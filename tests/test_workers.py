@@ -0,0 +1,65 @@
+from gopublish.model.workers import WorkerTracker
+
+
+class FakeInspect():
+
+    def __init__(self, replies):
+        self.replies = replies
+
+    def ping(self):
+        self.replies["calls"] += 1
+        return self.replies["workers"]
+
+
+class FakeControl():
+
+    def __init__(self, replies):
+        self.replies = replies
+
+    def inspect(self):
+        return FakeInspect(self.replies)
+
+
+class FakeCelery():
+
+    def __init__(self, workers):
+        self.replies = {"workers": workers, "calls": 0}
+        self.control = FakeControl(self.replies)
+
+
+class TestWorkers():
+
+    def test_ping_fallback(self, app):
+        tracker = WorkerTracker(None, cache_ttl=60)
+        celery = FakeCelery({"celery@worker2": {"ok": "pong"}, "celery@worker1": {"ok": "pong"}})
+
+        snapshot = tracker.snapshot(celery)
+
+        assert snapshot["available"]
+        assert snapshot["workers"] == ["celery@worker1", "celery@worker2"]
+
+    def test_no_worker(self, app):
+        tracker = WorkerTracker(None, cache_ttl=60)
+        celery = FakeCelery(None)
+
+        assert not tracker.is_available(celery)
+
+    def test_snapshot_cache(self, app):
+        tracker = WorkerTracker(None, cache_ttl=60)
+        celery = FakeCelery({"celery@worker1": {"ok": "pong"}})
+
+        for i in range(5):
+            assert tracker.is_available(celery)
+
+        assert celery.replies["calls"] == 1
+
+        tracker.cache_ttl = 0
+        tracker.is_available(celery)
+
+        assert celery.replies["calls"] == 2
+
+    def test_status(self, app, client):
+        response = client.get("/api/status")
+
+        assert response.status_code == 200
+        assert "available" in response.json["workers"]